@@ -0,0 +1,77 @@
+import os
+import time
+import click
+from typing import List
+
+from utilities.encoding import PROFILES, format_available
+from utilities.watermark_engine import WatermarkEngine
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def read_corpus(directory: str, limit: int = 0) -> List[bytes]:
+    """
+    Read the images of a sample corpus, searching them recursively in `directory`.
+
+    Args:
+        directory (str): The directory of the corpus.
+        limit (int, optional): The maximum number of images to read, 0 reads all of them.
+    Returns:
+        List[bytes]: The content of the images.
+    """
+    imgs = []
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                with open(os.path.join(root, name), 'rb') as f:
+                    imgs.append(f.read())
+                if limit and len(imgs) >= limit:
+                    return imgs
+
+    return imgs
+
+
+@click.command()
+@click.option("-i", "--input_dir", type=click.Path(exists=True, file_okay=False, resolve_path=True), required=True, help="Directory with the sample images, searched recursively")
+@click.option("-p", "--profile", "profiles", type=click.Choice(list(PROFILES)), multiple=True, help="Encoding profile to benchmark, can be used multiple times (defaults to all the available profiles)")
+@click.option("-w", "--watermark", type=click.Path(exists=True, dir_okay=False, resolve_path=True), help="Path to a watermark image, applied to every image as the local engine does")
+@click.option("-n", "--limit", type=click.INT, default=0, help="Maximum number of images of the corpus to use, 0 uses all of them")
+@click.option("-r", "--rounds", type=click.INT, default=1, help="Number of times each image is processed per profile")
+def benchmark_encoding(input_dir, profiles, watermark, limit, rounds):
+    """
+    Compare the CPU time and the output bytes of the encoding profiles on a sample corpus.
+    """
+    imgs = read_corpus(input_dir, limit)
+    if not imgs:
+        raise click.UsageError(f"No images found in {input_dir}")
+
+    engine = None
+    if watermark:
+        engine = WatermarkEngine(watermark)
+        with open(watermark, 'rb') as f:
+            engine.load_content(f.read())
+
+    input_bytes = sum(map(len, imgs))
+    click.echo(f"{len(imgs)} images, {input_bytes / (1024 * 1024):.1f} MB\n")
+    click.echo(f"{'profile':<12}{'cpu ms/img':>12}{'wall ms/img':>13}{'output MB':>12}{'KB/img':>10}{'ratio':>8}")
+
+    for name in profiles or PROFILES:
+        profile = PROFILES[name]
+        if not format_available(profile.format):
+            click.echo(f"{name:<12}  skipped, the {profile.format} format is not available")
+            continue
+
+        output_bytes = 0
+        cpu_start, wall_start = time.process_time(), time.perf_counter()
+        for _ in range(rounds):
+            output_bytes = sum(len(profile.compress(img, engine)) for img in imgs)
+        n_processed = len(imgs) * rounds
+        cpu_ms = (time.process_time() - cpu_start) * 1000 / n_processed
+        wall_ms = (time.perf_counter() - wall_start) * 1000 / n_processed
+
+        click.echo(f"{name:<12}{cpu_ms:>12.1f}{wall_ms:>13.1f}{output_bytes / (1024 * 1024):>12.2f}"
+                   f"{output_bytes / len(imgs) / 1024:>10.1f}{output_bytes / input_bytes:>8.2f}")
+
+
+if __name__ == "__main__":
+    benchmark_encoding()
@@ -0,0 +1,213 @@
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from itertools import product
+from typing import List, Optional
+
+import click
+from PIL import Image
+
+from utilities.encoding import PROFILE_LEGACY, PROFILES
+from utilities.image_manager import ImageManager
+from utilities.pipeline import PipelineConfig
+from benchmarks.fake_storage import FakeStorage
+from benchmarks.fake_watermark import FakeWatermarkService
+from benchmarks.synthetic_tree import generate_tree
+
+DOWNLOAD_BUCKET = 'benchmark-download'
+UPLOAD_BUCKET = 'benchmark-upload'
+MARKS_BUCKET = 'benchmark-marks'
+BROKER = 'benchmark'
+
+
+def watermark_png(size: int = 300) -> bytes:
+    """
+    Create a semi-transparent watermark, like the logos of the brokers.
+
+    Args:
+        size (int, optional): The width of the watermark.
+    Returns:
+        bytes: The PNG image.
+    """
+    mark = Image.new('RGBA', (size, size // 3), (255, 255, 255, 140))
+    output = io.BytesIO()
+    mark.save(output, 'PNG')
+    return output.getvalue()
+
+
+def run_config(config: dict, results: multiprocessing.Queue) -> None:
+    """
+    Run the pipeline with a configuration against the stand-in servers, in a fresh process.
+
+    Args:
+        config (dict): The options of the run.
+        results (multiprocessing.Queue): Where the results of the run are put.
+    Returns:
+        None
+    """
+    from utilities.firebase_manager import FirebaseUploaderManager
+    from utilities.log_manager import LogManager
+    from utilities.inventory import Inventory
+    from utilities.pipeline import inventory_tasks
+    from utilities.metrics import METRICS
+    from utilities.brokers import Broker
+    from utilities.rate_control import ServiceControl
+
+    METRICS.reset()
+    pipeline_config = PipelineConfig(threads=config['threads'], process_mode=config['process_mode'],
+                                     max_inflight_mb=config['max_inflight_mb'], io_engine=config['io_engine'],
+                                     async_concurrency=config['async_concurrency'],
+                                     host_connections=config['host_connections'])
+
+    log_mng = LogManager(filename=os.path.join(config['log_dir'], 'benchmark.log'), progress_interval=0)
+    img_mng = ImageManager(log_mng=log_mng, pool_size=pipeline_config.fetch_workers)
+    fb_mng = FirebaseUploaderManager(DOWNLOAD_BUCKET, UPLOAD_BUCKET, None, img_mng,
+                                     pool_size=max(pipeline_config.upload_workers, pipeline_config.copy_workers))
+    broker_img_mng = ImageManager(log_mng=log_mng, watermark_url=config['watermark_url'], engine=config['engine'],
+                                  session=img_mng.session, service_control=ServiceControl(pipeline_config.service_concurrency),
+                                  encoding=PROFILES[config['encoding_profile']])
+    if broker_img_mng.watermark_engine:
+        broker_img_mng.watermark_engine.load()
+
+    started_at = time.perf_counter()
+    # The progress of every image is not part of the benchmark output
+    with contextlib.redirect_stdout(io.StringIO()):
+        n_uploaded = fb_mng.run_pipeline(inventory_tasks(Inventory().consume(fb_mng.iter_inventory())),
+                                         [Broker(BROKER, broker_img_mng)], config=pipeline_config)
+    duration = time.perf_counter() - started_at
+    log_mng.close()
+
+    report = METRICS.report()
+    results.put({
+        'n_uploaded': n_uploaded,
+        'duration_seconds': duration,
+        'images_per_second': n_uploaded / duration if duration else 0.0,
+        # ru_maxrss is in KB on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'peak_children_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        'stages': {stage: {'count': metrics['count'], 'errors': metrics['errors'], 'retries': metrics['retries'],
+                           'total_seconds': metrics['latency_seconds']['total'],
+                           'p95_seconds': metrics['latency_seconds']['p95']}
+                   for stage, metrics in report['stages'].items()},
+        'counters': report['counters'],
+    })
+
+
+def run_isolated(config: dict) -> Optional[dict]:
+    """
+    Run `run_config` in a new process.
+
+    Args:
+        config (dict): The options of the run.
+    Returns:
+        dict: The results of the run, or None if the process failed.
+    """
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    # Not a daemon, so the run can start its own pool of processes
+    process = context.Process(target=run_config, args=(config, results))
+    process.start()
+    try:
+        result = results.get(timeout=config['run_timeout'])
+    except Exception:
+        result = None
+    process.join()
+    return result
+
+
+@click.command()
+@click.option("-b", "--buildings", type=click.INT, default=2, help="Number of buildings of the synthetic tree")
+@click.option("-u", "--units", type=click.INT, default=5, help="Number of units per building")
+@click.option("-p", "--photos", type=click.INT, default=6, help="Number of photos per unit")
+@click.option("-bp", "--blueprints", type=click.INT, default=2, help="Number of blueprints per unit")
+@click.option("-sp", "--shared_photos", type=click.INT, default=0, help="Number of photos per unit shared by all the units of a building, which can be deduplicated")
+@click.option("-sz", "--size", type=click.STRING, default='1600x1200', help="Size of the synthetic images, as WIDTHxHEIGHT")
+@click.option("-t", "--threads", "threads_list", type=click.INT, multiple=True, help="Number of threads of a run, can be used multiple times (defaults to 5)")
+@click.option("-e", "--engine", "engines", type=click.Choice(ImageManager.ENGINES), multiple=True, help="Engine of a run, can be used multiple times (defaults to both)")
+@click.option("-pm", "--process_mode", "process_modes", type=click.Choice(PipelineConfig.PROCESS_MODES), multiple=True, help="Process mode of a run, can be used multiple times (defaults to 'threads')")
+@click.option("-io", "--io_engine", "io_engines", type=click.Choice(PipelineConfig.IO_ENGINES), multiple=True, help="I/O engine of a run, can be used multiple times (defaults to 'threads')")
+@click.option("-ac", "--async_concurrency", type=click.INT, default=1000, help="Maximum number of images in flight of the 'async' runs")
+@click.option("-hc", "--host_connections", type=click.INT, default=100, help="Maximum number of connections to the same host of the 'async' runs")
+@click.option("-ep", "--encoding_profile", type=click.Choice(list(PROFILES)), default=PROFILE_LEGACY, help="Encoding of the images with watermark")
+@click.option("-mb", "--max_inflight_mb", type=click.INT, default=256, help="Maximum megabytes of images held in memory at the same time")
+@click.option("-wl", "--watermark_latency", type=click.FLOAT, default=0.2, help="Mean seconds of a response of the stand-in watermark service")
+@click.option("-we", "--watermark_error_rate", type=click.FLOAT, default=0.0, help="Fraction of the requests answered with a 503 by the stand-in watermark service")
+@click.option("-wc", "--watermark_max_concurrency", type=click.INT, default=0, help="Maximum number of requests in flight accepted by the stand-in watermark service, 0 for no limit")
+@click.option("-wr", "--watermark_max_rps", type=click.FLOAT, default=0, help="Maximum number of requests per second accepted by the stand-in watermark service, 0 for no limit")
+@click.option("-sl", "--storage_latency", type=click.FLOAT, default=0.0, help="Seconds added to every request to the stand-in storage")
+@click.option("-rt", "--run_timeout", type=click.INT, default=1800, help="Maximum seconds of a run")
+@click.option("-o", "--output", type=click.Path(dir_okay=False, resolve_path=True), help="Path to a JSON file where the results of every run are written")
+def benchmark_pipeline(buildings, units, photos, blueprints, shared_photos, size, threads_list, engines, process_modes,
+                       io_engines, async_concurrency, host_connections, encoding_profile, max_inflight_mb, watermark_latency, watermark_error_rate, watermark_max_concurrency,
+                       watermark_max_rps, storage_latency, run_timeout, output):
+    """
+    Benchmark the whole pipeline end to end on a synthetic tree, against local stand-ins of the storage and the
+    watermark service, comparing the throughput and the memory of several configurations.
+    """
+    try:
+        width, height = map(int, size.lower().split('x'))
+    except ValueError:
+        raise click.UsageError(f"Invalid size: {size}, expected WIDTHxHEIGHT")
+
+    storage = FakeStorage(latency=storage_latency).start()
+    watermark_service = FakeWatermarkService(latency=watermark_latency, error_rate=watermark_error_rate,
+                                             max_concurrency=watermark_max_concurrency, max_rps=watermark_max_rps).start()
+    # Read by the storage client, the public urls and the image managers of the runs
+    os.environ['STORAGE_EMULATOR_HOST'] = storage.url
+    os.environ['FIREBASE_STORAGE_PUBLIC_URL'] = storage.url
+    os.environ['WATERMARK_RESOURCE_ENDPOINT'] = watermark_service.url
+
+    click.echo("Generating the synthetic tree...")
+    names = generate_tree(lambda name, data: storage.put(DOWNLOAD_BUCKET, name, data), buildings=buildings, units=units,
+                          photos=photos, blueprints=blueprints, shared_photos=shared_photos, size=(width, height))
+    storage.put(MARKS_BUCKET, 'watermark.png', watermark_png(), 'image/png')
+    source_mb = sum(len(obj.data) for obj in storage.buckets[DOWNLOAD_BUCKET].values()) / (1024 * 1024)
+    click.echo(f"{len(names)} images, {source_mb:.1f} MB\n")
+
+    runs: List[dict] = []
+    header = (f"{'threads':>8}{'engine':>8}{'mode':>11}{'io':>8}{'images':>8}{'img/s':>8}{'seconds':>9}{'RSS MB':>8}"
+              f"{'pool MB':>9}{'errors':>8}  slowest stage (total s, p95 ms)")
+    click.echo(header)
+    with tempfile.TemporaryDirectory() as log_dir:
+        for threads, engine, process_mode, io_engine in product(threads_list or [5], engines or ImageManager.ENGINES,
+                                                                process_modes or [PipelineConfig.PROCESS_THREADS],
+                                                                io_engines or [PipelineConfig.IO_THREADS]):
+            storage.clear(UPLOAD_BUCKET)
+            config = {'threads': threads, 'engine': engine, 'process_mode': process_mode, 'io_engine': io_engine,
+                      'async_concurrency': async_concurrency, 'host_connections': host_connections,
+                      'encoding_profile': encoding_profile, 'max_inflight_mb': max_inflight_mb,
+                      'watermark_url': storage.public_url(MARKS_BUCKET, 'watermark.png'),
+                      'log_dir': log_dir, 'run_timeout': run_timeout}
+            result = run_isolated(config)
+            runs.append({'config': {k: v for k, v in config.items() if k not in ('log_dir', 'run_timeout')},
+                         'result': result})
+
+            if result is None:
+                click.echo(f"{threads:>8}{engine:>8}{process_mode:>11}{io_engine:>8}  failed, see the logs of the run")
+                continue
+
+            stages = result['stages']
+            slowest = max(stages, key=lambda stage: stages[stage]['total_seconds']) if stages else '-'
+            n_errors = sum(stage['errors'] for stage in stages.values())
+            slowest_info = (f"{slowest} ({stages[slowest]['total_seconds']:.1f}, "
+                            f"{stages[slowest]['p95_seconds'] * 1000:.0f})") if stages else '-'
+            click.echo(f"{threads:>8}{engine:>8}{process_mode:>11}{io_engine:>8}{result['n_uploaded']:>8}"
+                       f"{result['images_per_second']:>8.1f}{result['duration_seconds']:>9.1f}"
+                       f"{result['peak_rss_mb']:>8.0f}{result['peak_children_rss_mb']:>9.0f}{n_errors:>8}  {slowest_info}")
+
+    click.echo(f"\nWatermark service: {watermark_service.stats()}")
+    if output:
+        with open(output, 'w') as f:
+            json.dump({'tree': {'images': len(names), 'megabytes': source_mb}, 'runs': runs}, f, indent=2)
+
+    watermark_service.stop()
+    storage.stop()
+
+
+if __name__ == "__main__":
+    benchmark_pipeline()
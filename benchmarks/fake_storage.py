@@ -0,0 +1,350 @@
+import base64
+import hashlib
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+
+import google_crc32c
+
+
+class StoredObject:
+    """
+    An object of the fake storage, with the fields returned by the JSON API.
+    """
+
+    __slots__ = ('name', 'data', 'content_type', 'metadata', 'generation', 'md5_hash', 'crc32c', 'cache_control')
+
+    def __init__(self, name: str, data: bytes, content_type: str, metadata: Optional[Dict[str, str]], generation: int,
+                 cache_control: Optional[str] = None) -> None:
+        self.name = name
+        self.data = data
+        self.content_type = content_type
+        self.metadata = metadata
+        self.cache_control = cache_control
+        self.generation = generation
+        self.md5_hash = base64.b64encode(hashlib.md5(data).digest()).decode()
+        self.crc32c = base64.b64encode(google_crc32c.Checksum(data).digest()).decode()
+
+    def headers(self) -> Dict[str, str]:
+        # The headers of the downloads of the object
+        return {'Cache-Control': self.cache_control} if self.cache_control else {}
+
+    def resource(self, bucket: str) -> dict:
+        resource = {
+            'kind': 'storage#object',
+            'id': f'{bucket}/{self.name}/{self.generation}',
+            'name': self.name,
+            'bucket': bucket,
+            'generation': str(self.generation),
+            'metageneration': '1',
+            'contentType': self.content_type,
+            'size': str(len(self.data)),
+            'md5Hash': self.md5_hash,
+            'crc32c': self.crc32c,
+        }
+        if self.metadata:
+            resource['metadata'] = self.metadata
+        if self.cache_control:
+            resource['cacheControl'] = self.cache_control
+
+        return resource
+
+
+class FakeStorage:
+    """
+    An in-memory stand-in of Cloud Storage, serving the subset of the JSON API used by `FirebaseUploaderManager`.
+    The clients reach it by setting `STORAGE_EMULATOR_HOST` to `self.url`.
+
+    Args:
+        latency (float, optional): The seconds added to every request, to simulate the round-trip to the storage.
+        page_size (int, optional): The maximum number of objects of a page of the listing.
+    """
+
+    def __init__(self, latency: float = 0.0, page_size: int = 1000) -> None:
+        self.latency = latency
+        self.page_size = page_size
+        self.buckets: Dict[str, Dict[str, StoredObject]] = {}
+        self.n_requests = 0
+
+        self._generation = 0
+        self._uploads: Dict[str, Tuple[str, dict, bytearray]] = {}
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def url(self) -> str:
+        """
+        The url of the server, ex: `http://127.0.0.1:8123`.
+        """
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def public_url(self, bucket: str, name: str) -> str:
+        """
+        Get the Firebase Storage public url of an object.
+
+        Args:
+            bucket (str): The name of the bucket.
+            name (str): The name of the object.
+        Returns:
+            str: The public url.
+        """
+        return f'{self.url}/v0/b/{bucket}/o/{quote(name, safe="")}?alt=media'
+
+    def put(self, bucket: str, name: str, data: bytes, content_type: str = 'image/jpeg',
+            metadata: Optional[Dict[str, str]] = None, cache_control: Optional[str] = None,
+            if_generation_match: Optional[int] = None) -> Optional[StoredObject]:
+        """
+        Store an object, replacing the previous one with the same name.
+
+        Args:
+            bucket (str): The name of the bucket.
+            name (str): The name of the object.
+            data (bytes): The content of the object.
+            content_type (str, optional): The content type of the object.
+            metadata (Dict[str, str], optional): The custom metadata of the object.
+            cache_control (str, optional): The Cache-Control of the object.
+            if_generation_match (int, optional): Only store the object if the generation of the previous one is this,
+                0 if there must be no previous one.
+        Returns:
+            StoredObject: The stored object, None if the precondition failed.
+        """
+        with self._lock:
+            if if_generation_match is not None:
+                previous = self.buckets.get(bucket, {}).get(name)
+                if (previous.generation if previous else 0) != if_generation_match:
+                    return None
+            self._generation += 1
+            obj = StoredObject(name, data, content_type, metadata, self._generation, cache_control)
+            self.buckets.setdefault(bucket, {})[name] = obj
+
+        return obj
+
+    def get(self, bucket: str, name: str) -> Optional[StoredObject]:
+        return self.buckets.get(bucket, {}).get(name)
+
+    def clear(self, bucket: str) -> None:
+        """
+        Delete every object of a bucket.
+
+        Args:
+            bucket (str): The name of the bucket.
+        Returns:
+            None
+        """
+        with self._lock:
+            self.buckets[bucket] = {}
+
+    def list(self, bucket: str, prefix: str = '', page_token: Optional[str] = None, delimiter: Optional[str] = None) -> dict:
+        with self._lock:
+            objects = dict(self.buckets.get(bucket, {}))
+        names = sorted(name for name in objects if name.startswith(prefix))
+        if delimiter:
+            # The names with the delimiter after the prefix are returned once as the folder holding them
+            entries = sorted({name[:name.find(delimiter, len(prefix)) + len(delimiter)]
+                              if delimiter in name[len(prefix):] else name for name in names})
+        else:
+            entries = names
+        if page_token:
+            entries = [entry for entry in entries if entry > page_token]
+
+        page = entries[:self.page_size]
+        response = {
+            'kind': 'storage#objects',
+            'items': [objects[entry].resource(bucket) for entry in page if entry in objects],
+        }
+        if delimiter:
+            response['prefixes'] = [entry for entry in page if entry not in objects]
+        if len(entries) > self.page_size:
+            response['nextPageToken'] = page[-1]
+
+        return response
+
+    def start(self, host: str = '127.0.0.1', port: int = 0) -> 'FakeStorage':
+        """
+        Start serving in a background thread.
+
+        Args:
+            host (str, optional): The host to bind.
+            port (int, optional): The port to bind, 0 picks a free port.
+        Returns:
+            FakeStorage: The same storage.
+        """
+        storage = self
+
+        class Handler(_StorageHandler):
+            pass
+
+        Handler.storage = storage
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        """
+        Stop serving.
+
+        Returns:
+            None
+        """
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+class _StorageHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    storage: FakeStorage = None
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def _body(self) -> bytes:
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _send(self, status: int, body: bytes = b'', content_type: str = 'application/json',
+              headers: Optional[Dict[str, str]] = None) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _json(self, status: int, payload: dict, headers: Optional[Dict[str, str]] = None) -> None:
+        self._send(status, json.dumps(payload).encode(), headers=headers)
+
+    def _not_found(self) -> None:
+        self._json(404, {'error': {'code': 404, 'message': 'Not Found'}})
+
+    def _route(self) -> Tuple[list, dict]:
+        self.storage.n_requests += 1
+        if self.storage.latency:
+            time.sleep(self.storage.latency)
+
+        parts = urlsplit(self.path)
+        segments = [unquote(segment) for segment in parts.path.strip('/').split('/')]
+        return segments, {key: values[-1] for key, values in parse_qs(parts.query).items()}
+
+    def do_GET(self) -> None:
+        segments, query = self._route()
+        storage = self.storage
+
+        # /v0/b/{bucket}/o/{name}?alt=media, the public urls of Firebase Storage
+        # /download/storage/v1/b/{bucket}/o/{name}?alt=media
+        if segments[:2] == ['v0', 'b'] and len(segments) == 5 or segments[:4] == ['download', 'storage', 'v1', 'b']:
+            bucket, name = segments[-3], segments[-1]
+            obj = storage.get(bucket, name)
+            if obj is None:
+                return self._not_found()
+            return self._send(200, obj.data, obj.content_type, obj.headers())
+
+        # /storage/v1/b/{bucket}/o
+        if segments[:3] == ['storage', 'v1', 'b'] and len(segments) == 5 and segments[4] == 'o':
+            return self._json(200, storage.list(segments[3], query.get('prefix', ''), query.get('pageToken'),
+                                                query.get('delimiter')))
+
+        # /storage/v1/b/{bucket}/o/{name}
+        if segments[:3] == ['storage', 'v1', 'b'] and len(segments) == 6:
+            obj = storage.get(segments[3], segments[5])
+            if obj is None:
+                return self._not_found()
+            if query.get('alt') == 'media':
+                return self._send(200, obj.data, obj.content_type, obj.headers())
+            return self._json(200, obj.resource(segments[3]))
+
+        self._not_found()
+
+    def do_POST(self) -> None:
+        segments, query = self._route()
+        storage = self.storage
+        body = self._body()
+
+        # /upload/storage/v1/b/{bucket}/o?uploadType=multipart|resumable
+        if segments[:4] == ['upload', 'storage', 'v1', 'b'] and len(segments) == 6:
+            bucket = segments[4]
+            if query.get('uploadType') == 'multipart':
+                resource, data, content_type = _parse_multipart(body, self.headers.get('Content-Type', ''))
+                generation = query.get('ifGenerationMatch')
+                obj = storage.put(bucket, resource.get('name') or query.get('name'), data,
+                                  resource.get('contentType', content_type), resource.get('metadata'),
+                                  resource.get('cacheControl'), int(generation) if generation is not None else None)
+                if obj is None:
+                    return self._json(412, {'error': {'code': 412, 'message': 'Precondition Failed'}})
+                return self._json(200, obj.resource(bucket))
+
+            resource = json.loads(body or b'{}')
+            resource.setdefault('name', query.get('name'))
+            upload_id = uuid.uuid4().hex
+            with storage._lock:
+                storage._uploads[upload_id] = (bucket, resource, bytearray())
+            location = f'{storage.url}/upload/storage/v1/b/{bucket}/o?uploadType=resumable&upload_id={upload_id}'
+            return self._send(200, headers={'Location': location})
+
+        # /storage/v1/b/{bucket}/o/{name}/rewriteTo/b/{bucket}/o/{name}
+        if segments[:3] == ['storage', 'v1', 'b'] and len(segments) == 11 and segments[6] == 'rewriteTo':
+            source = storage.get(segments[3], segments[5])
+            if source is None:
+                return self._not_found()
+
+            resource = json.loads(body or b'{}')
+            obj = storage.put(segments[8], segments[10], source.data, resource.get('contentType') or source.content_type,
+                              resource.get('metadata', source.metadata), resource.get('cacheControl', source.cache_control))
+            return self._json(200, {
+                'kind': 'storage#rewriteResponse',
+                'totalBytesRewritten': str(len(obj.data)),
+                'objectSize': str(len(obj.data)),
+                'done': True,
+                'resource': obj.resource(segments[8]),
+            })
+
+        self._not_found()
+
+    def do_PUT(self) -> None:
+        segments, query = self._route()
+        storage = self.storage
+        body = self._body()
+
+        upload = storage._uploads.get(query.get('upload_id', ''))
+        if upload is None:
+            return self._not_found()
+
+        bucket, resource, data = upload
+        data.extend(body)
+        # Content-Range: bytes 0-99/100, or bytes */100 to ask for the status
+        total = self.headers.get('Content-Range', '').rpartition('/')[2]
+        if total.isdigit() and len(data) >= int(total):
+            del storage._uploads[query['upload_id']]
+            obj = storage.put(bucket, resource['name'], bytes(data), resource.get('contentType', 'application/octet-stream'),
+                              resource.get('metadata'), resource.get('cacheControl'))
+            return self._json(200, obj.resource(bucket))
+
+        headers = {'Range': f'bytes=0-{len(data) - 1}'} if data else {}
+        self._send(308, headers=headers)
+
+
+def _parse_multipart(body: bytes, content_type: str) -> Tuple[dict, bytes, str]:
+    # multipart/related; boundary="===...==="
+    boundary = content_type.partition('boundary=')[2].strip('"').encode()
+    delimiter = b'--' + boundary
+    parts = body.split(delimiter)
+    # ['', metadata part, content part, '--\r\n']
+    metadata_part, content_part = parts[1], delimiter.join(parts[2:-1])
+    resource = json.loads(metadata_part.split(b'\r\n\r\n', 1)[1].rstrip(b'\r\n'))
+    headers, data = content_part.split(b'\r\n\r\n', 1)
+    # Without a content type in the resource, the storage takes the one of the content part
+    media_type = 'application/octet-stream'
+    for header in headers.decode('latin-1').split('\r\n'):
+        name, _, value = header.partition(':')
+        if name.strip().lower() == 'content-type':
+            media_type = value.strip()
+    # The content is followed by the CRLF before the closing delimiter
+    return resource, data[:-2] if data.endswith(b'\r\n') else data, media_type
@@ -0,0 +1,155 @@
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+import requests
+
+
+class FakeWatermarkService:
+    """
+    A stand-in of the watermark service, answering the same payload with the main image, with a latency, random 5xx
+    errors and caps of requests answered with a 429 and `Retry-After`.
+
+    Args:
+        latency (float, optional): The mean seconds of a response, each response takes between half and 1.5 times it.
+        error_rate (float, optional): The fraction of the requests answered with a 503 (0.0 - 1.0).
+        max_concurrency (int, optional): The maximum number of requests in flight, 0 for no limit.
+        max_rps (float, optional): The maximum number of requests per second, 0 for no limit.
+        retry_after (int, optional): The seconds sent in `Retry-After` with the 429 responses.
+    """
+
+    def __init__(self, latency: float = 0.2, error_rate: float = 0.0, max_concurrency: int = 0, max_rps: float = 0,
+                 retry_after: int = 1) -> None:
+        self.latency = latency
+        self.error_rate = error_rate
+        self.max_concurrency = max_concurrency
+        self.max_rps = max_rps
+        self.retry_after = retry_after
+
+        self.n_requests = 0
+        self.n_throttled = 0
+        self.n_errors = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+        self._tokens = float(max_rps)
+        self._refilled_at = time.monotonic()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def url(self) -> str:
+        """
+        The endpoint of the service, ex: `http://127.0.0.1:8123/watermark`.
+        """
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/watermark'
+
+    def _admit(self) -> bool:
+        # Takes a slot and a token of the rate limit, if both are available
+        with self._lock:
+            self.n_requests += 1
+            if self.max_concurrency and self.in_flight >= self.max_concurrency:
+                self.n_throttled += 1
+                return False
+
+            if self.max_rps:
+                now = time.monotonic()
+                self._tokens = min(self.max_rps, self._tokens + (now - self._refilled_at) * self.max_rps)
+                self._refilled_at = now
+                if self._tokens < 1:
+                    self.n_throttled += 1
+                    return False
+                self._tokens -= 1
+
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            return True
+
+    def _release(self) -> None:
+        with self._lock:
+            self.in_flight -= 1
+
+    def _session(self) -> requests.Session:
+        # A session per thread of the server, to download the main images with keep-alive connections
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def start(self, host: str = '127.0.0.1', port: int = 0) -> 'FakeWatermarkService':
+        """
+        Start serving in a background thread.
+
+        Args:
+            host (str, optional): The host to bind.
+            port (int, optional): The port to bind, 0 picks a free port.
+        Returns:
+            FakeWatermarkService: The same service.
+        """
+        class Handler(_WatermarkHandler):
+            pass
+
+        Handler.service = self
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        """
+        Stop serving.
+
+        Returns:
+            None
+        """
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def stats(self) -> dict:
+        return {'requests': self.n_requests, 'throttled': self.n_throttled, 'errors': self.n_errors,
+                'peak_in_flight': self.peak_in_flight}
+
+
+class _WatermarkHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    service: FakeWatermarkService = None
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def _send(self, status: int, body: bytes = b'', content_type: str = 'application/json', retry_after: Optional[int] = None) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if retry_after is not None:
+            self.send_header('Retry-After', str(retry_after))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self) -> None:
+        service = self.service
+        length = int(self.headers.get('Content-Length') or 0)
+        payload = json.loads(self.rfile.read(length) or b'{}')
+
+        if not service._admit():
+            return self._send(429, b'{"error": "Too Many Requests"}', retry_after=service.retry_after)
+
+        try:
+            time.sleep(service.latency * random.uniform(0.5, 1.5))
+            if random.random() < service.error_rate:
+                with service._lock:
+                    service.n_errors += 1
+                return self._send(503, b'{"error": "Service Unavailable"}')
+
+            r = service._session().get(payload.get('mainImageUrl', ''), timeout=30)
+            if r.status_code != 200:
+                return self._send(400, b'{"error": "Could not download the main image"}')
+            self._send(200, r.content, 'image/jpeg')
+        finally:
+            service._release()
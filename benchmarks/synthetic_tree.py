@@ -0,0 +1,85 @@
+import random
+from io import BytesIO
+from typing import Callable, List, Tuple
+
+from PIL import Image
+
+
+def synthetic_jpeg(size: Tuple[int, int], seed: int, quality: int = 90) -> bytes:
+    """
+    Create a JPEG with a gradient and noise, which compresses like a photo instead of a flat image.
+
+    Args:
+        size (Tuple[int, int]): The width and height of the image.
+        seed (int): The seed of the colors of the image.
+        quality (int, optional): The quality of the JPEG.
+    Returns:
+        bytes: The JPEG image.
+    """
+    rng = random.Random(seed)
+    gradient = Image.linear_gradient('L').resize(size)
+    noise = Image.effect_noise(size, 40)
+    image = Image.merge('RGB', (gradient, noise, Image.new('L', size, rng.randrange(256))))
+    image = image.rotate(rng.choice([0, 90, 180, 270]), expand=False)
+
+    output = BytesIO()
+    image.save(output, 'JPEG', quality=quality)
+    return output.getvalue()
+
+
+def unique(img: bytes, tag: str) -> bytes:
+    """
+    Make the content of an image unique, appending `tag` after the end of the JPEG, which the decoders ignore.
+
+    Args:
+        img (bytes): The JPEG image.
+        tag (str): A tag unique to the image.
+    Returns:
+        bytes: The image with a different checksum.
+    """
+    return img + tag.encode()
+
+
+def generate_tree(put: Callable[[str, bytes], None], buildings: int = 2, units: int = 5, photos: int = 6,
+                  blueprints: int = 2, shared_photos: int = 0, size: Tuple[int, int] = (1600, 1200),
+                  variants: int = 8) -> List[str]:
+    """
+    Generate a synthetic tree of the download bucket, with the structure of the real one:
+
+    edificio-{b}/local-{u}/fotos/{b}-local-{u}-{i}.jpg
+    edificio-{b}/local-{u}/planos/{b}-local-{u}-plano-{j}.jpg
+
+    The last `shared_photos` photos of every unit are the same in all the units of a building, like the photos
+    of the common areas, so they can be deduplicated.
+
+    Args:
+        put (Callable[[str, bytes], None]): Called with the name and the content of each image.
+        buildings (int, optional): The number of buildings.
+        units (int, optional): The number of units per building.
+        photos (int, optional): The number of photos per unit.
+        blueprints (int, optional): The number of blueprints per unit.
+        shared_photos (int, optional): The number of photos per unit shared by the units of a building.
+        size (Tuple[int, int], optional): The width and height of the images.
+        variants (int, optional): The number of different images encoded, reused for the whole tree.
+    Returns:
+        List[str]: The names of the images.
+    """
+    imgs = [synthetic_jpeg(size, seed) for seed in range(variants)]
+    names = []
+    for b in range(1, buildings + 1):
+        building = f'torre-{b}'
+        for u in range(1, units + 1):
+            folder = f'edificio-{building}/local-{u}'
+            for i in range(1, photos + 1):
+                name = f'{folder}/fotos/{building}-local-{u}-{i:02}.jpg'
+                if i > photos - shared_photos:
+                    put(name, unique(imgs[(b + i) % variants], f'{building}-shared-{i}'))
+                else:
+                    put(name, unique(imgs[(b + u + i) % variants], name))
+                names.append(name)
+            for j in range(1, blueprints + 1):
+                name = f'{folder}/planos/{building}-local-{u}-plano-{j}.jpg'
+                put(name, unique(imgs[(b + u + j) % variants], name))
+                names.append(name)
+
+    return names
@@ -0,0 +1,106 @@
+"""
+Cloud Function that onboards the images of the download bucket as they are created or updated, triggered by the
+object finalize events of the bucket.
+
+It's configured with environment variables:
+
+- UPLOAD_BUCKET: ID of the bucket where the images are uploaded (required).
+- DOWNLOAD_BUCKET: ID of the bucket of the original images, defaults to the bucket of the first event.
+- BROKERS_CONFIG: Path to the JSON file with the watermark of each broker, as the `-bc` option of
+  onboarding_brokers_imgs.py, or BROKER_NAME and WATERMARK_URL for a single broker.
+- ENGINE, ENCODING_PROFILE, DERIVATIVES (comma separated, ex: 'thumb:320,md:960'), TIMEOUT, N_TRIES, THREADS and
+  CACHE_CONTROL, as the options of onboarding_brokers_imgs.py.
+"""
+import os
+import threading
+
+import functions_framework
+
+# The onboarding of the instance, created on the first event. An instance can handle several events at the same
+# time, so it's created under a lock
+_onboarding = None
+_onboarding_lock = threading.Lock()
+
+
+def get_onboarding(bucket: str):
+    """
+    Get the onboarding of the instance, creating it on the first call with the clients and the watermarks loaded.
+
+    Args:
+        bucket (str): The bucket of the event, used as the download bucket unless DOWNLOAD_BUCKET is set.
+    Returns:
+        IncrementalOnboarding: The onboarding of the instance.
+    """
+    global _onboarding
+    if _onboarding is None:
+        with _onboarding_lock:
+            if _onboarding is None:
+                _onboarding = _create_onboarding(bucket)
+
+    return _onboarding
+
+
+def _create_onboarding(bucket: str):
+    from utilities.broker_index import IMAGES_CACHE_CONTROL
+    from utilities.brokers import Broker, load_brokers_config
+    from utilities.encoding import PROFILE_LEGACY, PROFILES, Derivative
+    from utilities.firebase_manager import FirebaseUploaderManager
+    from utilities.image_manager import ImageManager
+    from utilities.incremental import IncrementalOnboarding
+    from utilities.pipeline import PipelineConfig
+    from utilities.rate_control import ServiceControl
+
+    if os.environ.get('BROKERS_CONFIG'):
+        watermarks = load_brokers_config(os.environ['BROKERS_CONFIG'])
+    elif os.environ.get('BROKER_NAME'):
+        watermarks = {os.environ['BROKER_NAME']: os.environ.get('WATERMARK_URL') or None}
+    else:
+        raise ValueError('A broker is required, set BROKERS_CONFIG or BROKER_NAME')
+
+    threads = int(os.environ.get('THREADS', 2))
+    timeout = int(os.environ.get('TIMEOUT', ImageManager.TIMEOUT))
+    n_tries = int(os.environ.get('N_TRIES', ImageManager.N_TRIES))
+    engine = os.environ.get('ENGINE', ImageManager.ENGINE_LOCAL)
+    encoding = PROFILES[os.environ.get('ENCODING_PROFILE', PROFILE_LEGACY)]
+    encoding.check()
+    derivatives = [Derivative.parse(derivative) for derivative in os.environ.get('DERIVATIVES', '').split(',') if derivative]
+
+    config = PipelineConfig(threads=threads, schedule=PipelineConfig.SCHEDULE_LISTING,
+                            process_mode=PipelineConfig.PROCESS_THREADS)
+    img_mng = ImageManager(timeout=timeout, n_tries=n_tries, pool_size=config.fetch_workers)
+    # The credentials are the ones of the service account of the function
+    fb_mng = FirebaseUploaderManager(os.environ.get('DOWNLOAD_BUCKET', bucket), os.environ['UPLOAD_BUCKET'], None, img_mng,
+                                     pool_size=max(config.upload_workers, config.copy_workers),
+                                     cache_control=os.environ.get('CACHE_CONTROL', IMAGES_CACHE_CONTROL) or None)
+
+    service_control = ServiceControl(config.fetch_workers)
+    brokers = []
+    for name, watermark in watermarks.items():
+        broker_img_mng = ImageManager(timeout=timeout, n_tries=n_tries, watermark_url=watermark, engine=engine,
+                                      session=img_mng.session, service_control=service_control, encoding=encoding,
+                                      derivatives=derivatives)
+        if broker_img_mng.watermark_engine:
+            broker_img_mng.watermark_engine.load()
+        brokers.append(Broker(name, broker_img_mng))
+
+    return IncrementalOnboarding(fb_mng, brokers, config)
+
+
+@functions_framework.cloud_event
+def onboard_image(cloud_event) -> None:
+    """
+    Onboard the image of an object finalize event of the download bucket for every broker.
+
+    Args:
+        cloud_event (CloudEvent): The event, with the bucket and the name of the object in its data.
+    Returns:
+        None
+    """
+    data = cloud_event.data
+    onboarding = get_onboarding(data['bucket'])
+    if data['bucket'] != onboarding.fb_mng.download_bucket.name:
+        print(f"-- Event of another bucket, skipped: {data['bucket']}/{data['name']}")
+        return
+
+    n_uploaded = onboarding.onboard(data['name'])
+    print(f"-- {n_uploaded} images uploaded for the event of: {data['bucket']}/{data['name']}")
@@ -0,0 +1,52 @@
+import json
+import click
+from utilities.manifest import Manifest
+from utilities.metrics import METRICS, merge_reports
+from utilities.journal import merge_journals
+from utilities.sharding import shard_files
+
+
+@click.command()
+@click.option('-m', '--manifest', 'manifest_path', type=click.Path(dir_okay=False, resolve_path=True), default='manifest.db', help='Path to the manifest where the manifests of the shards are merged, the manifests of the shards are found next to it, ex: manifest.shard-1-of-4.db')
+@click.option('-jf', '--journal', 'journal_path', type=click.Path(dir_okay=False, resolve_path=True), default='failures.jsonl', help='Path to the journal where the journals of the shards are merged, to retry them with retry_download_imgs.py')
+@click.option('-mj', '--metrics_json', type=click.Path(dir_okay=False, resolve_path=True), default='metrics.json', help='Path to the JSON report where the reports of the shards are merged')
+@click.option('-mp', '--metrics_prom', type=click.Path(dir_okay=False, resolve_path=True), help='Path to a Prometheus textfile where the merged metrics are also written')
+@click.option('-sm', '--shard_manifest', 'shard_manifests', type=click.Path(exists=True, dir_okay=False, resolve_path=True), multiple=True, help='Path to the manifest of a shard, ex: copied from another machine. Can be used multiple times (defaults to the manifests of the shards found next to --manifest)')
+@click.option('-sj', '--shard_journal', 'shard_journals', type=click.Path(exists=True, dir_okay=False, resolve_path=True), multiple=True, help='Path to the journal of a shard. Can be used multiple times (defaults to the journals of the shards found next to --journal)')
+@click.option('-sr', '--shard_report', 'shard_reports', type=click.Path(exists=True, dir_okay=False, resolve_path=True), multiple=True, help='Path to the JSON report of a shard. Can be used multiple times (defaults to the reports of the shards found next to --metrics_json)')
+def merge_shards(manifest_path, journal_path, metrics_json, metrics_prom, shard_manifests, shard_journals, shard_reports):
+    """
+    Merge the manifests, the failure journals and the metrics of the shards of an onboarding executed with --shard.
+    """
+    shard_manifests = shard_manifests or shard_files(manifest_path)
+    shard_journals = shard_journals or shard_files(journal_path)
+    shard_reports = shard_reports or shard_files(metrics_json)
+    if not shard_manifests and not shard_journals and not shard_reports:
+        raise click.UsageError('No files of the shards were found, use -sm, -sj or -sr')
+
+    if shard_manifests:
+        manifest = Manifest(manifest_path)
+        for path in shard_manifests:
+            click.echo(f'{manifest.merge(path)} images merged from: {path}')
+        click.echo(f'{len(manifest)} images recorded in: {manifest_path}')
+        manifest.close()
+
+    if shard_journals:
+        n_failures = merge_journals(list(shard_journals), journal_path)
+        click.echo(f'{n_failures} failures of {len(shard_journals)} shards recorded in: {journal_path}')
+
+    if shard_reports:
+        reports = []
+        for path in shard_reports:
+            with open(path, 'r') as f:
+                reports.append(json.load(f))
+        report = merge_reports(reports)
+        click.echo(METRICS.summary(report))
+        METRICS.write_json(metrics_json, report)
+        if metrics_prom:
+            METRICS.write_prometheus(metrics_prom, report=report)
+        click.echo(f'Metrics of {len(reports)} shards written to: {metrics_json}')
+
+
+if __name__ == '__main__':
+    merge_shards()
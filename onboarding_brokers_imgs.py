@@ -1,55 +1,209 @@
+import os
 import click
 from utilities.image_manager import ImageManager
+from utilities.encoding import PROFILE_LEGACY, PROFILES, Derivative
 from utilities.firebase_manager import FirebaseUploaderManager
 from utilities.log_manager import LogManager
+from utilities.inventory import Inventory, check_prefixes
+from utilities.pipeline import PipelineConfig, inventory_tasks, unit_key
+from utilities.async_pipeline import async_available
+from utilities.metrics import METRICS
+from utilities.brokers import Broker, load_brokers_config
+from utilities.manifest import Manifest
+from utilities.cache import ProcessedImageCache
+from utilities.rate_control import ServiceControl
+from utilities.journal import FailureJournal
+from utilities.sharding import Shard
+from utilities.broker_index import IMAGES_CACHE_CONTROL, INDEX_NAME
+from utilities.planner import RunPlan, read_runs, record_run
+from utilities.buffers import configure_spool
 
 
 @click.command()
 @click.option("-d", "--download_bucket", type=click.STRING, required=True, help="ID of the Firebase Storage bucket where the images to download are located")
 @click.option("-u", "--upload_bucket", type=click.STRING, required=True, help="ID of the Firebase Storage bucket where the images will be uploaded")
 @click.option("-k", "--key", type=click.Path(exists=True, resolve_path=True), required=True, help="Path to the Firebase SDK credentials file")
-@click.option("-br", "--broker_name", type=click.STRING, required=True, help="Name of the broker, used to save the images in a folder with the broker name")
+@click.option("-br", "--broker_name", type=click.STRING, help="Name of the broker, used to save the images in a folder with the broker name")
 @click.option("-w", "--watermark", type=click.STRING, help="URL of the image that will be used as a watermark")
-@click.option("-f", "--file", type=click.Path(exists=True, resolve_path=True), help="Path to the log file where the logs will be saved (Tip: Use a .log extension, its the default format when the command is executed)")
+@click.option("-bc", "--brokers_config", type=click.Path(exists=True, dir_okay=False, resolve_path=True), help="Path to a JSON file mapping the name of each broker to the URL of its watermark, to onboard several brokers in a single run")
+@click.option("-f", "--file", type=click.Path(exists=True, resolve_path=True), help="Path to the log file where the errors and the folders uploaded are saved, one JSON object per line (defaults to logs.log)")
+@click.option("-pi", "--progress_interval", type=click.FLOAT, default=5.0, help="Seconds between two lines of progress in the console, with the images per second, the ETA and the errors, 0 to disable them")
 @click.option("-t", "--threads", type=click.INT, default=5, help="Number of threads to use for downloading and uploading images")
 @click.option("-to", "--timeout", type=click.INT, default=10, help="Timeout in seconds for the watermark service responses")
-@click.option("-nt", "--n_tries", type=click.INT, default=1, help="Number of attempts to download the image if an error occurs from the watermark service")
-def onboarding_brokers_imgs(file, broker_name, download_bucket, upload_bucket, key, watermark, threads, timeout, n_tries):
+@click.option("-cto", "--connect_timeout", type=click.FLOAT, help="Timeout in seconds for establishing the connections (defaults to --timeout)")
+@click.option("-nt", "--n_tries", type=click.INT, default=3, help="Number of retries, with an exponential backoff, when the watermark service is overloaded (429, 5xx or timeouts)")
+@click.option("-e", "--engine", type=click.Choice(ImageManager.ENGINES), default=ImageManager.ENGINE_LOCAL, help="Engine used to apply the watermark: 'local' composites it in-process, 'remote' uses the watermark service")
+@click.option("-p", "--prefix", "prefixes", type=click.STRING, multiple=True, help="Only onboard the images whose path starts with this prefix, ex: 'edificio-'. Can be used multiple times")
+@click.option("-sh", "--shard", type=click.STRING, help="Only onboard the units (edificio/local) of this shard, as i/N, ex: '2/4' is the second of four shards executed at the same time on several processes or machines. The manifest, the journal and the metrics are written to files of the shard, ex: 'manifest.shard-2-of-4.db', merged with merge_shards.py")
+@click.option("-fw", "--fetch_workers", type=click.INT, help="Number of threads downloading images (defaults to --threads)")
+@click.option("-pw", "--process_workers", type=click.INT, help="Number of threads or processes applying the watermark and compressing images (defaults to the number of available cores)")
+@click.option("-pm", "--process_mode", type=click.Choice(PipelineConfig.PROCESS_MODES), default=PipelineConfig.PROCESS_THREADS, help="Where the watermark is applied and the images are compressed: 'threads' uses -pw threads of the same process, 'processes' uses a pool of -pw processes to use every core")
+@click.option("-uw", "--upload_workers", type=click.INT, help="Number of threads uploading images (defaults to --threads)")
+@click.option("-io", "--io_engine", type=click.Choice(PipelineConfig.IO_ENGINES), default=PipelineConfig.IO_THREADS, help="How the images are downloaded, sent to the watermark service and uploaded: 'threads' uses the workers of each stage, 'async' uses an event loop with thousands of requests in flight (requires aiohttp)")
+@click.option("-ac", "--async_concurrency", type=click.INT, default=1000, help="Maximum number of images in flight with the 'async' I/O engine")
+@click.option("-hc", "--host_connections", type=click.INT, default=100, help="Maximum number of connections to the same host with the 'async' I/O engine, also the maximum number of requests in flight to the watermark service")
+@click.option("-qs", "--queue_size", type=click.INT, help="Maximum number of images waiting between two stages of the processing")
+@click.option("-mb", "--max_inflight_mb", type=click.INT, default=256, help="Maximum megabytes of images held in memory at the same time")
+@click.option("-sp", "--spool_mb", type=click.INT, default=16, help="Images larger than these megabytes are spooled to a temporary file instead of being held in memory, and uploaded streaming from it, 0 keeps every image in memory")
+@click.option("-sd", "--spool_dir", type=click.Path(file_okay=False, resolve_path=True), help="Directory of the temporary files of the spooled images (defaults to the temporary directory of the system)")
+@click.option("-s", "--schedule", type=click.Choice(PipelineConfig.SCHEDULES), default=PipelineConfig.SCHEDULE_LARGEST, help="Order the images are processed: 'largest' processes the largest images first, 'unit' finishes the photos and blueprints of each unit together, processing its largest images first, 'listing' keeps the order of the listing")
+@click.option("-sw", "--schedule_window", type=click.INT, default=2000, help="Number of images reordered at a time by the 'largest' and 'unit' schedules, 0 waits for the whole listing to sort all of them")
+@click.option("--server_copy/--no_server_copy", default=True, help="Without a watermark, copy the images between the buckets with server-side copies instead of downloading and uploading them")
+@click.option("--dedup/--no_dedup", default=True, help="Process only once the images with the same content under different paths, from the checksums of the listing, copying the first processed image server-side to the other paths")
+@click.option("-cw", "--copy_workers", type=click.INT, help="Number of server-side copies in flight when no watermark is applied (defaults to 4 times --threads)")
+@click.option("-m", "--manifest", "manifest_path", type=click.Path(dir_okay=False, resolve_path=True), default="manifest.db", help="Path to the manifest of the images already processed, which are skipped when the command is executed again")
+@click.option("--rebuild_manifest", is_flag=True, help="Rebuild the manifest from the images already uploaded for the brokers before processing")
+@click.option("--index/--no_index", default=True, help="Update the index of each broker, '{broker}/index.json', mapping each unit (edificio/local) to the urls of its photos and blueprints. Only the units with images uploaded by the run are listed again")
+@click.option("--rebuild_index", is_flag=True, help="Rebuild the index of each broker from every image already uploaded, ex: for the images uploaded before the index existed")
+@click.option("-cc", "--cache_control", type=click.STRING, default=IMAGES_CACHE_CONTROL, help=f"Cache-Control of the uploaded images (defaults to '{IMAGES_CACHE_CONTROL}'), '' to use the default of the storage")
+@click.option("-ep", "--encoding_profile", type=click.Choice(list(PROFILES)), default=PROFILE_LEGACY, help="Encoding of the images with watermark: 'legacy' keeps the full size JPEG at quality 20, 'web' and 'web-small' resize them to a progressive JPEG, 'webp' and 'avif' resize them to those formats")
+@click.option("-dv", "--derivative", "derivatives", type=click.STRING, multiple=True, help="Smaller version of the photos with watermark, as name:size, ex: 'thumb:320' uploads '...01-thumb.jpg' of at most 320px next to '...01.jpg'. Can be used multiple times")
+@click.option("-cd", "--cache_dir", type=click.Path(file_okay=False, resolve_path=True), default=".image_cache", help="Directory of the cache of processed images, reused when the same image is processed again with the same watermark")
+@click.option("-cs", "--cache_max_mb", type=click.INT, default=2048, help="Maximum megabytes of the cache of processed images, 0 disables the cache")
+@click.option("-jf", "--journal", "journal_path", type=click.Path(dir_okay=False, resolve_path=True), default="failures.jsonl", help="Path to the journal of the images that could not be processed, with the stage and the error of each one, used by retry_download_imgs.py")
+@click.option("-mj", "--metrics_json", type=click.Path(dir_okay=False, resolve_path=True), default="metrics.json", help="Path to the JSON report with the latency (p50/p95/p99), bytes, retries and errors of each stage of the run")
+@click.option("-rh", "--run_history", type=click.Path(dir_okay=False, resolve_path=True), default="run_history.jsonl", help="Path to the history of runs, where the throughput of each stage is appended at the end of the run, used by --plan to estimate the duration of the next runs")
+@click.option("--plan", is_flag=True, help="Only list the bucket and show the plan of the run, without processing any image: the photos and blueprints, their size per building and unit, the objects skipped, the downloads, watermark service calls, uploads and egress, and the duration estimated from the runs of --run_history for the given threads and mode")
+@click.option("-mp", "--metrics_prom", type=click.Path(dir_okay=False, resolve_path=True), help="Path to a Prometheus textfile where the metrics of the run are also written, ex: for the textfile collector of the node exporter")
+def onboarding_brokers_imgs(file, broker_name, download_bucket, upload_bucket, key, watermark, brokers_config, threads, timeout, n_tries, engine, prefixes,
+                            fetch_workers, process_workers, upload_workers, queue_size, max_inflight_mb,
+                            schedule, schedule_window, connect_timeout, server_copy, copy_workers,
+                            manifest_path, rebuild_manifest, cache_dir, cache_max_mb, encoding_profile, derivatives, process_mode,
+                            metrics_json, metrics_prom, journal_path, dedup, shard, io_engine, async_concurrency, host_connections,
+                            progress_interval, index, rebuild_index, cache_control, run_history, plan, spool_mb, spool_dir):
     """
-    Download images from a Firebase Storage bucket, apply a watermark to them, 
+    Download images from a Firebase Storage bucket, apply the watermark of each broker to them, 
     and upload them to another Firebase Storage bucket.
     """
 
-    log_mng = LogManager(filename=file)
-    img_mng = ImageManager(timeout=timeout, n_tries=n_tries,
-                           log_mng=log_mng, watermark_url=watermark)
-    fb_mng = FirebaseUploaderManager(
-        download_bucket, upload_bucket, key, img_mng)
+    config = PipelineConfig(threads=threads, fetch_workers=fetch_workers, process_workers=process_workers,
+                            upload_workers=upload_workers, queue_size=queue_size, max_inflight_mb=max_inflight_mb,
+                            schedule=schedule, schedule_window=schedule_window, server_copy=server_copy, copy_workers=copy_workers,
+                            process_mode=process_mode, dedup=dedup, io_engine=io_engine,
+                            async_concurrency=async_concurrency, host_connections=host_connections)
+    if io_engine == PipelineConfig.IO_ASYNC and not async_available():
+        raise click.UsageError("The async I/O engine requires aiohttp, install it with: pip install aiohttp")
+    configure_spool(spool_mb * 1024 * 1024, spool_dir)
 
-    click.echo("*******************************************************")
-    click.echo(f"Getting all images public urls from bucket: \
-               {download_bucket}")
+    watermarks = load_brokers_config(brokers_config) if brokers_config else {}
+    if broker_name:
+        watermarks[broker_name] = watermark
+    if not watermarks:
+        raise click.UsageError("A broker is required, use -br or -bc")
+    try:
+        prefixes = check_prefixes(prefixes)
+    except ValueError as e:
+        raise click.UsageError(str(e))
 
-    all_imgs_urls = fb_mng.get_all_imgs_public_urls()
+    if shard:
+        try:
+            shard = Shard.parse(shard)
+        except ValueError as e:
+            raise click.UsageError(str(e))
+        # The shards executed on the same machine do not overwrite the files of each other
+        manifest_path, journal_path, metrics_json = shard.path(manifest_path), shard.path(journal_path), shard.path(metrics_json)
+        if metrics_prom:
+            metrics_prom = shard.path(metrics_prom)
 
-    click.echo(f"Getting all blueprint images from bucket: \
-               {download_bucket}")
+    # A plan does not create the log, it leaves the log of the previous run and prints its errors
+    log_mng = None if plan else LogManager(filename=file, progress_interval=progress_interval)
+    # Downloads the images once for all the brokers
+    img_mng = ImageManager(timeout=timeout, n_tries=n_tries, log_mng=log_mng,
+                           pool_size=config.fetch_workers, connect_timeout=connect_timeout)
+    fb_mng = FirebaseUploaderManager(download_bucket, upload_bucket, key, img_mng,
+                                     pool_size=max(config.upload_workers, config.copy_workers), cache_control=cache_control or None)
 
-    all_blueprint_urls = fb_mng.get_all_blueprint_imgs_public_urls()
+    encoding = PROFILES[encoding_profile]
+    try:
+        encoding.check()
+        derivatives = [Derivative.parse(derivative) for derivative in derivatives]
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    # A plan does not create the cache, it does not process any image
+    cache = ProcessedImageCache(cache_dir, cache_max_mb * 1024 * 1024) if cache_max_mb > 0 and not plan else None
 
-    click.echo("*******************************************************")
-    click.echo(f"Downloading images from public urls obtained and uploading them to the new bucket: {upload_bucket} \
-                ({len(all_imgs_urls)} aproximated images and {len(all_blueprint_urls)*2} blueprint aproximated images)\n\n")
+    # Every broker sends its requests to the same watermark service
+    service_control = ServiceControl(config.service_concurrency)
 
-    fb_mng.upload_all_imgs(all_imgs_urls, broker_name, max_workers=threads)
+    brokers = []
+    for name, broker_watermark in watermarks.items():
+        broker_img_mng = ImageManager(timeout=timeout, n_tries=n_tries, log_mng=log_mng, watermark_url=broker_watermark,
+                                      engine=engine, connect_timeout=connect_timeout, session=img_mng.session,
+                                      cache=cache, service_control=service_control, encoding=encoding,
+                                      derivatives=derivatives)
+        if broker_img_mng.watermark_engine and not plan:
+            click.echo(f"Loading watermark of broker {name}: {broker_watermark}")
+            broker_img_mng.watermark_engine.load()
+        brokers.append(Broker(name, broker_img_mng))
+
+    if plan:
+        # A plan only reads the manifest, and leaves the journal of the previous run for a retry
+        manifest = Manifest(manifest_path, read_only=True) if os.path.exists(manifest_path) else None
+        journal = None
+    else:
+        manifest = Manifest(manifest_path)
+        journal = FailureJournal(journal_path)
+    if rebuild_manifest and not plan:
+        for broker in brokers:
+            click.echo(f"Rebuilding manifest from bucket: {upload_bucket}/{broker.name}")
+            n_recorded = fb_mng.rebuild_manifest(manifest, broker.name)
+            click.echo(f"{n_recorded} images recorded in the manifest")
 
     click.echo("*******************************************************")
-    click.echo("All images uploaded successfully!")
+    click.echo(f"Listing images from bucket: {download_bucket} and uploading them to the new bucket: {upload_bucket} \
+               for the brokers: {', '.join(watermarks)}\n\n")
+
+    # The bucket is listed only once, and the photos and blueprints are uploaded by the same workers
+    # while the listing is still paging
+    inventory = Inventory()
+    if shard:
+        click.echo(f"Listing only the units of the shard {shard}")
+        prefixes = fb_mng.iter_shard_units(shard, prefixes)
+    groups = inventory.consume(fb_mng.iter_inventory(prefixes, inventory.skipped))
 
-    fb_mng.upload_all_blueprints_imgs(all_blueprint_urls, broker_name)
+    if plan:
+        # Only the inventory is listed, the images already in the manifest are not counted as work
+        run_plan = RunPlan(brokers, config, manifest)
+        run_plan.skipped = inventory.skipped
+        run_plan.add_all(inventory_tasks(groups))
+        click.echo(run_plan.summary(read_runs(run_history, config.io_engine)))
+        if manifest is not None:
+            manifest.close()
+        return
+
+    # The units with images uploaded, whose entries of the indexes are updated
+    units = set()
+    n_uploaded = fb_mng.run_pipeline(inventory_tasks(groups), brokers, config=config, manifest=manifest, journal=journal,
+                                     on_uploaded=lambda task, url: units.add(unit_key(task.path)))
+    if rebuild_index or index and units:
+        for broker in brokers:
+            try:
+                n_units = fb_mng.update_broker_index(broker.name, None if rebuild_index else units)
+            except Exception as e:
+                click.echo(f"Error updating the index of {broker.name}, update it with --rebuild_index: {e}")
+                continue
+            click.echo(f"Index of {broker.name} updated: {n_units} units in {upload_bucket}/{broker.name}/{INDEX_NAME}")
+    # Writes the pending messages and the last line of progress
+    log_mng.close()
 
     click.echo("*******************************************************")
-    click.echo("All blueprint images uploaded successfully!")
+    click.echo(f"All images uploaded successfully! {sum(map(len, inventory.photos.values()))} photos and "
+               f"{sum(map(len, inventory.blueprints.values()))} blueprint images")
+    click.echo(f"{manifest.n_skipped} images already processed were skipped")
+    click.echo(f"{journal.n_failures} images failed, recorded in: {journal_path}")
+    if cache is not None:
+        click.echo(cache.stats())
+    if engine == ImageManager.ENGINE_REMOTE:
+        click.echo(service_control.stats())
+
+    click.echo(METRICS.summary())
+    METRICS.write_json(metrics_json)
+    if metrics_prom:
+        METRICS.write_prometheus(metrics_prom)
+    record_run(run_history, METRICS.report(), config, brokers, n_uploaded, str(shard) if shard else None)
+
+    journal.close()
+    manifest.close()
 
 
 if __name__ == "__main__":
@@ -1,57 +1,228 @@
-from urllib.parse import unquote
 import re
+import json
 import click
-import concurrent.futures
+from typing import Dict, Iterator, List, Set, Tuple
 from utilities.image_manager import ImageManager
+from utilities.encoding import PROFILE_LEGACY, PROFILES, Derivative
 from utilities.firebase_manager import FirebaseUploaderManager
 from utilities.log_manager import LogManager
+from utilities.inventory import BLUEPRINTS, PHOTOS
+from utilities.pipeline import ImageTask, PipelineConfig, unit_key
+from utilities.async_pipeline import async_available
+from utilities.metrics import METRICS
+from utilities.brokers import Broker, load_brokers_config
+from utilities.manifest import Manifest
+from utilities.rate_control import ServiceControl
+from utilities.journal import FailureJournal, read_failures
+from utilities.broker_index import IMAGES_CACHE_CONTROL, INDEX_NAME
+from utilities.buffers import configure_spool
 import utilities.tools
 
 
+def read_journal_tasks(journal_path: str, brokers: Set[str], skipped: List[Dict]) -> Iterator[ImageTask]:
+    """
+    Read the images that failed from a failure journal, yielding the task to process each of them again.
+    An image that failed for several brokers is downloaded once for all of them.
+
+    Args:
+        journal_path (str): The path to the failure journal.
+        brokers (Set[str]): The names of the brokers that can be retried.
+        skipped (List[Dict]): Where the failures of the other brokers are added.
+    Yields:
+        ImageTask: The task of each image found in the journal.
+    """
+    tasks: Dict[Tuple[str, str], ImageTask] = {}
+    for failure in read_failures(journal_path):
+        if failure.get('broker') not in brokers:
+            skipped.append(failure)
+            continue
+
+        key = (failure.get('source') or failure['url'], failure['path'])
+        attempt = failure.get('attempt', 1) + 1
+        if key in tasks:
+            tasks[key].targets.add(failure['broker'])
+            tasks[key].attempt = max(tasks[key].attempt, attempt)
+            continue
+
+        tasks[key] = ImageTask(failure['url'], failure['path'], kind=failure.get('kind') or PHOTOS, name=failure.get('source'),
+                               generation=failure.get('generation'), md5_hash=failure.get('md5_hash'), attempt=attempt,
+                               targets={failure['broker']})
+
+    yield from tasks.values()
+
+
+def read_log_tasks(log_file: str) -> Iterator[ImageTask]:
+    """
+    Read the public urls of the images that failed from a log file, yielding the task to process each of them again.
+    Used for the logs written before the failure journal existed.
+
+    Args:
+        log_file (str): The path to the log file.
+    Yields:
+        ImageTask: The task of each image found in the log file.
+    """
+    seen = set()
+    with open(log_file, "r") as f:
+        for line in f:
+            if line.startswith('{'):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get('event') != 'message':
+                    continue
+                line = entry.get('message', '')
+
+            match = re.search(r'https:\S*\?alt=media', line)
+            if not match or match.group(0) in seen:
+                continue
+
+            public_url = match.group(0)
+            seen.add(public_url)
+            path = utilities.tools.get_blob_name_from_url(public_url)
+            yield ImageTask(public_url, path, kind=BLUEPRINTS if '/planos/' in path else PHOTOS)
+
+
 @click.command()
 @click.option('-d', '--download_bucket', type=click.STRING, required=True, help='ID of the Firebase Storage bucket where the images to download are located')
 @click.option('-u', '--upload_bucket', type=click.STRING, required=True, help='ID of the Firebase Storage bucket where the images will be uploaded')
 @click.option('-k', '--key', type=click.Path(exists=True, resolve_path=True), required=True, help='Path to the Firebase SDK credentials file')
-@click.option('-br', '--broker', type=click.STRING, required=True, help='Name of the broker, used to save the images in a folder with the broker name')
-@click.option('-w', '--watermark', type=click.STRING, required=True, help='URL of the image that will be used as a watermark')
-@click.option('-l', '--log_file', type=click.Path(exists=True, resolve_path=True), required=True, help='Path to the log file to read and retry the download of the images')
+@click.option('-br', '--broker', type=click.STRING, help='Name of the broker, used to save the images in a folder with the broker name')
+@click.option('-w', '--watermark', type=click.STRING, help='URL of the image that will be used as a watermark')
+@click.option('-bc', '--brokers_config', type=click.Path(exists=True, dir_okay=False, resolve_path=True), help='Path to a JSON file mapping the name of each broker to the URL of its watermark, to retry the images of several brokers in a single run')
+@click.option('-j', '--journal', 'journal_path', type=click.Path(exists=True, dir_okay=False, resolve_path=True), help='Path to the failure journal written by onboarding_brokers_imgs.py (-jf) or by a previous retry (-o)')
+@click.option('-l', '--log_file', type=click.Path(exists=True, resolve_path=True), help='Path to a log file to read and retry the download of the images, for the runs without a failure journal')
+@click.option('-o', '--output_journal', type=click.Path(dir_okay=False, resolve_path=True), default='retry_failures.jsonl', help='Path to the journal of the images that failed again')
+@click.option('-f', '--file', type=click.Path(dir_okay=False, resolve_path=True), default='retry_logs.log', help='Path to the log file where the errors and the images uploaded are saved, one JSON object per line')
+@click.option('-pi', '--progress_interval', type=click.FLOAT, default=5.0, help='Seconds between two lines of progress in the console, with the images per second, the ETA and the errors, 0 to disable them')
 @click.option('-to', '--timeout', type=click.INT, default=10, help='Timeout in seconds for the watermark service responses')
-@click.option('-nt', '--n_tries', type=click.INT, default=1, help='Number of attempts to download the image if an error occurs from the watermark service')
+@click.option('-cto', '--connect_timeout', type=click.FLOAT, help='Timeout in seconds for establishing the connections (defaults to --timeout)')
+@click.option('-nt', '--n_tries', type=click.INT, default=3, help='Number of retries, with an exponential backoff, when the watermark service is overloaded (429, 5xx or timeouts)')
 @click.option('-t', '--threads', type=click.INT, default=5, help='Number of threads to use for downloading the images')
-def retry_download_imgs(download_bucket, upload_bucket, key, broker, watermark, log_file, timeout, n_tries, threads):
+@click.option('-e', '--engine', type=click.Choice(ImageManager.ENGINES), default=ImageManager.ENGINE_LOCAL, help="Engine used to apply the watermark: 'local' composites it in-process, 'remote' uses the watermark service")
+@click.option('-fw', '--fetch_workers', type=click.INT, help='Number of threads downloading images (defaults to --threads)')
+@click.option('-pw', '--process_workers', type=click.INT, help='Number of threads or processes applying the watermark and compressing images (defaults to the number of available cores)')
+@click.option('-pm', '--process_mode', type=click.Choice(PipelineConfig.PROCESS_MODES), default=PipelineConfig.PROCESS_THREADS, help="Where the watermark is applied and the images are compressed: 'threads' uses -pw threads of the same process, 'processes' uses a pool of -pw processes to use every core")
+@click.option('-uw', '--upload_workers', type=click.INT, help='Number of threads uploading images (defaults to --threads)')
+@click.option('-io', '--io_engine', type=click.Choice(PipelineConfig.IO_ENGINES), default=PipelineConfig.IO_THREADS, help="How the images are downloaded, sent to the watermark service and uploaded: 'threads' uses the workers of each stage, 'async' uses an event loop with thousands of requests in flight (requires aiohttp)")
+@click.option('-ac', '--async_concurrency', type=click.INT, default=1000, help="Maximum number of images in flight with the 'async' I/O engine")
+@click.option('-hc', '--host_connections', type=click.INT, default=100, help="Maximum number of connections to the same host with the 'async' I/O engine, also the maximum number of requests in flight to the watermark service")
+@click.option('-qs', '--queue_size', type=click.INT, help='Maximum number of images waiting between two stages of the processing')
+@click.option('-mb', '--max_inflight_mb', type=click.INT, default=256, help='Maximum megabytes of images held in memory at the same time')
+@click.option('-sp', '--spool_mb', type=click.INT, default=16, help='Images larger than these megabytes are spooled to a temporary file instead of being held in memory, and uploaded streaming from it, 0 keeps every image in memory')
+@click.option('-sd', '--spool_dir', type=click.Path(file_okay=False, resolve_path=True), help='Directory of the temporary files of the spooled images (defaults to the temporary directory of the system)')
+@click.option('-s', '--schedule', type=click.Choice(PipelineConfig.SCHEDULES), default=PipelineConfig.SCHEDULE_LARGEST, help="Order the images are processed: 'largest' processes the largest images first, 'unit' finishes the photos and blueprints of each unit together, processing its largest images first, 'listing' keeps the order of the listing")
+@click.option('-sw', '--schedule_window', type=click.INT, default=2000, help="Number of images reordered at a time by the 'largest' and 'unit' schedules, 0 waits for the whole listing to sort all of them")
+@click.option('--server_copy/--no_server_copy', default=True, help='Without a watermark, copy the images between the buckets with server-side copies instead of downloading and uploading them')
+@click.option('-cw', '--copy_workers', type=click.INT, help='Number of server-side copies in flight when no watermark is applied (defaults to 4 times --threads)')
+@click.option('-m', '--manifest', 'manifest_path', type=click.Path(dir_okay=False, resolve_path=True), default='manifest.db', help='Path to the manifest of the images already processed, the images uploaded again are recorded in it and the images already processed are skipped')
+@click.option('-ep', '--encoding_profile', type=click.Choice(list(PROFILES)), default=PROFILE_LEGACY, help="Encoding of the images with watermark: 'legacy' keeps the full size JPEG at quality 20, 'web' and 'web-small' resize them to a progressive JPEG, 'webp' and 'avif' resize them to those formats")
+@click.option('-dv', '--derivative', 'derivatives', type=click.STRING, multiple=True, help="Smaller version of the photos with watermark, as name:size, ex: 'thumb:320' uploads '...01-thumb.jpg' of at most 320px next to '...01.jpg'. Can be used multiple times")
+@click.option('-mj', '--metrics_json', type=click.Path(dir_okay=False, resolve_path=True), default='metrics.json', help="Path to the JSON report with the latency (p50/p95/p99), bytes, retries and errors of each stage of the run")
+@click.option('--index/--no_index', default=True, help="Update the entries of the units with images uploaded again in the index of each broker, '{broker}/index.json'")
+@click.option('-cc', '--cache_control', type=click.STRING, default=IMAGES_CACHE_CONTROL, help=f"Cache-Control of the uploaded images (defaults to '{IMAGES_CACHE_CONTROL}'), '' to use the default of the storage")
+@click.option('-mp', '--metrics_prom', type=click.Path(dir_okay=False, resolve_path=True), help="Path to a Prometheus textfile where the metrics of the run are also written, ex: for the textfile collector of the node exporter")
+def retry_download_imgs(download_bucket, upload_bucket, key, broker, watermark, brokers_config, journal_path, log_file, output_journal,
+                        timeout, n_tries, threads, engine, fetch_workers, process_workers, upload_workers, queue_size, max_inflight_mb,
+                        schedule, schedule_window, server_copy, copy_workers, manifest_path, connect_timeout, encoding_profile,
+                        derivatives, process_mode, metrics_json, metrics_prom, io_engine, async_concurrency, host_connections,
+                        file, progress_interval, index, cache_control, spool_mb, spool_dir):
+    """
+    Process again the images that failed, reading them from the failure journal of a previous run.
+    """
 
-    log_mng = LogManager(filename="retry_logs.log")
-    img_mng = ImageManager(timeout=timeout, n_tries=n_tries,
-                           log_mng=log_mng, watermark_url=watermark)
-    fb_mng = FirebaseUploaderManager(
-        download_bucket, upload_bucket, key, img_mng)
+    if not journal_path and not log_file:
+        raise click.UsageError('The images to retry are required, use -j or -l')
 
-    with open(log_file, "r") as f:
-        lines = f.readlines()
-        public_urls = list(map(lambda line: re.search(
-            r'https:.*\.jpg\?alt\=media', line).group(0), lines))
-        paths = list(map(lambda url: broker + "/" + unquote(url).replace(
-            "https://firebasestorage.googleapis.com/v0/b/duvify-brokers-fotos-unidades/o/", "").replace("?alt=media", ""), public_urls))
+    watermarks = load_brokers_config(brokers_config) if brokers_config else {}
+    if broker:
+        watermarks[broker] = watermark
+    if not watermarks:
+        raise click.UsageError('A broker is required, use -br or -bc')
 
-    click.echo('*******************************************************')
-    click.echo(
-        f'Downloading images from public urls ({len(public_urls)} images)\n\n')
+    config = PipelineConfig(threads=threads, fetch_workers=fetch_workers, process_workers=process_workers,
+                            upload_workers=upload_workers, queue_size=queue_size, max_inflight_mb=max_inflight_mb,
+                            schedule=schedule, schedule_window=schedule_window, server_copy=server_copy,
+                            copy_workers=copy_workers, process_mode=process_mode, io_engine=io_engine,
+                            async_concurrency=async_concurrency, host_connections=host_connections)
+    configure_spool(spool_mb * 1024 * 1024, spool_dir)
+    if io_engine == PipelineConfig.IO_ASYNC and not async_available():
+        raise click.UsageError('The async I/O engine requires aiohttp, install it with: pip install aiohttp')
+
+    encoding = PROFILES[encoding_profile]
+    try:
+        encoding.check()
+        derivatives = [Derivative.parse(derivative) for derivative in derivatives]
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+    log_mng = LogManager(filename=file, progress_interval=progress_interval)
+    # Downloads the images once for all the brokers
+    img_mng = ImageManager(timeout=timeout, n_tries=n_tries, log_mng=log_mng,
+                           pool_size=config.fetch_workers, connect_timeout=connect_timeout)
+    fb_mng = FirebaseUploaderManager(download_bucket, upload_bucket, key, img_mng,
+                                     pool_size=max(config.upload_workers, config.copy_workers), cache_control=cache_control or None)
 
-    imgs = img_mng.download_images(public_urls)
+    service_control = ServiceControl(config.service_concurrency)
+    brokers = []
+    for name, broker_watermark in watermarks.items():
+        broker_img_mng = ImageManager(timeout=timeout, n_tries=n_tries, log_mng=log_mng, watermark_url=broker_watermark,
+                                      engine=engine, connect_timeout=connect_timeout, session=img_mng.session,
+                                      service_control=service_control, encoding=encoding, derivatives=derivatives)
+        if broker_img_mng.watermark_engine:
+            click.echo(f'Loading watermark of broker {name}: {broker_watermark}')
+            broker_img_mng.watermark_engine.load()
+        brokers.append(Broker(name, broker_img_mng))
+
+    skipped = []
+    if journal_path:
+        tasks = read_journal_tasks(journal_path, set(watermarks), skipped)
+    else:
+        tasks = read_log_tasks(log_file)
 
     click.echo('*******************************************************')
     click.echo(
-        f'Uploading images to the new bucket: {upload_bucket}\n\n')
+        f'Processing again the images that failed and uploading them to the new bucket: {upload_bucket}\n\n')
+
+    # The units with images uploaded again, whose entries of the indexes are updated
+    units = set()
+
+    def on_uploaded(task: ImageTask, url: str) -> None:
+        units.add(unit_key(task.path))
+        if url:
+            log_mng.event('image_uploaded', url=utilities.tools.replace_domain_url(url), path=task.path)
+
+    manifest = Manifest(manifest_path)
+    journal = FailureJournal(output_journal)
+    # The images are downloaded, processed and uploaded in parallel, and only a bounded number of them is held in memory
+    n_uploaded = fb_mng.run_pipeline(tasks, brokers, config=config, manifest=manifest, journal=journal,
+                                     on_uploaded=on_uploaded)
+    if index and units:
+        for broker in brokers:
+            try:
+                n_units = fb_mng.update_broker_index(broker.name, units)
+            except Exception as e:
+                click.echo(f'Error updating the index of {broker.name}, update it with --rebuild_index of onboarding_brokers_imgs.py: {e}')
+                continue
+            click.echo(f'Index of {broker.name} updated: {n_units} units in {upload_bucket}/{broker.name}/{INDEX_NAME}')
+    # Writes the pending messages and the last line of progress
+    log_mng.close()
+
+    click.echo(f'{n_uploaded} images processed')
+    if skipped:
+        click.echo(f'{len(skipped)} images of brokers not given with -br or -bc were skipped')
+    click.echo(f'{manifest.n_skipped} images already processed were skipped')
+    click.echo(f'{journal.n_failures} images failed again, recorded in: {output_journal}')
+    if engine == ImageManager.ENGINE_REMOTE:
+        click.echo(service_control.stats())
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
-        futures = []
-        for img, path in zip(imgs, paths):
-            futures.append(executor.submit(fb_mng._upload_img, path, img))
+    click.echo(METRICS.summary())
+    METRICS.write_json(metrics_json)
+    if metrics_prom:
+        METRICS.write_prometheus(metrics_prom)
 
-        for future in concurrent.futures.as_completed(futures):
-            url: str = future.result()
-            click.echo(
-                f'-- Image uploaded: {utilities.tools.replace_domain_url(url)}')
+    journal.close()
+    manifest.close()
 
     click.echo('*******************************************************')
     click.echo('Task completed!')
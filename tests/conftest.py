@@ -0,0 +1,53 @@
+import pytest
+
+from benchmarks.fake_storage import FakeStorage
+from utilities.firebase_manager import FirebaseUploaderManager
+from utilities.image_manager import ImageManager
+
+
+@pytest.fixture(scope='session')
+def fake_storage():
+    storage = FakeStorage().start()
+    yield storage
+    storage.stop()
+
+
+@pytest.fixture
+def storage(fake_storage, monkeypatch):
+    """The local stand-in of Cloud Storage, with empty buckets."""
+    monkeypatch.setenv('STORAGE_EMULATOR_HOST', fake_storage.url)
+    monkeypatch.setenv('FIREBASE_STORAGE_PUBLIC_URL', fake_storage.url)
+    for bucket in list(fake_storage.buckets):
+        fake_storage.clear(bucket)
+    return fake_storage
+
+
+@pytest.fixture
+def uploader(storage):
+    """An uploader from the bucket `dl` to the bucket `up` of the fake storage."""
+    return FirebaseUploaderManager('dl', 'up', None, ImageManager(n_tries=1))
+
+
+@pytest.fixture
+def tree(storage):
+    """A small tree of photos and blueprints in the bucket `dl`, and a watermark in the bucket `marks`."""
+    from benchmarks.benchmark_pipeline import watermark_png
+    from benchmarks.synthetic_tree import generate_tree
+
+    storage.put('marks', 'w.png', watermark_png(), 'image/png')
+    return generate_tree(lambda name, data: storage.put('dl', name, data), buildings=1, units=2, photos=3,
+                         blueprints=1, shared_photos=1, size=(64, 48))
+
+
+@pytest.fixture
+def make_broker(storage, uploader):
+    """Create a broker with the watermark of the bucket `marks`, applied by the local engine."""
+    from utilities.brokers import Broker
+
+    def make_broker(name='B', **kwargs):
+        img_mng = ImageManager(n_tries=1, watermark_url=storage.public_url('marks', 'w.png'),
+                               engine=ImageManager.ENGINE_LOCAL, session=uploader.img_mng.session, **kwargs)
+        img_mng.watermark_engine.load()
+        return Broker(name, img_mng)
+
+    return make_broker
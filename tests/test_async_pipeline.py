@@ -0,0 +1,70 @@
+import threading
+
+from google.auth.credentials import AnonymousCredentials
+
+from utilities.async_pipeline import AsyncPipeline
+from utilities.inventory import Inventory
+from utilities.journal import FailureJournal, read_failures
+from utilities.manifest import Manifest
+from utilities.pipeline import PipelineConfig, inventory_tasks
+
+
+def run(uploader, brokers, io_engine, **kwargs):
+    tasks = inventory_tasks(Inventory().consume(uploader.iter_inventory()))
+    config = PipelineConfig(threads=2, process_mode=PipelineConfig.PROCESS_THREADS, io_engine=io_engine)
+    return uploader.run_pipeline(tasks, brokers, config=config, **kwargs)
+
+
+def uploaded(storage):
+    return {name: (obj.content_type, obj.metadata) for name, obj in storage.buckets['up'].items()}
+
+
+def test_async_uploads_the_same_images_as_threads(storage, uploader, tree, make_broker):
+    brokers = [make_broker()]
+    n_threads = run(uploader, brokers, PipelineConfig.IO_THREADS)
+    expected = uploaded(storage)
+    storage.clear('up')
+
+    assert run(uploader, brokers, PipelineConfig.IO_ASYNC) == n_threads
+    assert uploaded(storage) == expected
+
+
+def test_async_journals_unexpected_errors_from_a_thread(storage, uploader, tree, make_broker, monkeypatch, tmp_path):
+    def fail(self, task):
+        raise ValueError('broken')
+
+    threads = set()
+    record = FailureJournal.record
+
+    def recorded(self, *args, **kwargs):
+        threads.add(threading.current_thread())
+        return record(self, *args, **kwargs)
+
+    monkeypatch.setattr(AsyncPipeline, '_process', fail)
+    monkeypatch.setattr(FailureJournal, 'record', recorded)
+    journal = FailureJournal(str(tmp_path / 'failures.jsonl'))
+    manifest = Manifest(':memory:')
+
+    assert run(uploader, [make_broker()], PipelineConfig.IO_ASYNC, manifest=manifest, journal=journal) == 0
+    journal.close()
+
+    failures = list(read_failures(journal.path))
+    assert len(failures) == len(tree)
+    assert {failure['error'] for failure in failures} == {'ValueError'}
+    # The event loop runs in the calling thread
+    assert threading.main_thread() not in threads
+    assert len(manifest) == 0
+
+
+def test_async_uploads_use_the_credentials_of_the_uploader(storage, uploader, tree, make_broker):
+    applied = []
+
+    class Credentials(AnonymousCredentials):
+        def apply(self, headers, token=None):
+            applied.append(headers)
+
+    uploader.credentials = Credentials()
+
+    assert run(uploader, [make_broker()], PipelineConfig.IO_ASYNC) == len(tree)
+    # The duplicate photo is copied from its original on the server
+    assert len(applied) == len(tree) - 1
@@ -0,0 +1,53 @@
+from utilities.broker_index import BrokerIndex
+from utilities.encoding import Derivative
+from utilities.inventory import Inventory
+from utilities.manifest import META_DERIVATIVE
+from utilities.pipeline import PipelineConfig, inventory_tasks
+
+UNIT = 'edificio-a/local-1'
+
+
+def url(name):
+    return f'https://storage/{name}'
+
+
+def test_update_tells_derivatives_by_their_metadata():
+    index = BrokerIndex('B')
+
+    index.update([
+        (f'B/{UNIT}/fotos/a-10.jpg', {}),
+        (f'B/{UNIT}/fotos/a-2.jpg', None),
+        (f'B/{UNIT}/fotos/a-2-thumb.jpg', {META_DERIVATIVE: 'thumb'}),
+        (f'B/{UNIT}/fotos/a-10-thumb.jpg', {META_DERIVATIVE: 'thumb'}),
+        # A photo whose name looks like a derivative
+        (f'B/{UNIT}/fotos/a-3-md.jpg', {}),
+        (f'B/{UNIT}/planos/plano.jpg', {}),
+    ], url)
+
+    assert index.units[UNIT] == {
+        'fotos': [url(f'B/{UNIT}/fotos/a-2.jpg'), url(f'B/{UNIT}/fotos/a-3-md.jpg'), url(f'B/{UNIT}/fotos/a-10.jpg')],
+        'planos': [url(f'B/{UNIT}/planos/plano.jpg')],
+        'derivatives': {'thumb': [url(f'B/{UNIT}/fotos/a-2-thumb.jpg'), url(f'B/{UNIT}/fotos/a-10-thumb.jpg')]},
+    }
+
+
+def test_update_keeps_the_other_units_and_removes_the_empty_ones():
+    index = BrokerIndex('B', {'edificio-b/local-1': {'fotos': ['x'], 'planos': []}, UNIT: {'fotos': ['y'], 'planos': []}})
+
+    assert index.update([], url, {UNIT}) == 0
+    assert list(index.units) == ['edificio-b/local-1']
+
+
+def test_index_does_not_depend_on_the_derivatives_of_the_run(storage, uploader, tree, make_broker):
+    broker = make_broker(derivatives=[Derivative.parse('thumb:32')])
+    config = PipelineConfig(threads=2, process_mode=PipelineConfig.PROCESS_THREADS)
+    uploader.run_pipeline(inventory_tasks(Inventory().consume(uploader.iter_inventory())), [broker], config=config)
+
+    uploader.update_broker_index('B')
+
+    index = BrokerIndex.loads(storage.get('up', 'B/index.json').data)
+    n_photos = sum(len(unit['fotos']) for unit in index.units.values())
+    n_thumbs = sum(len(unit['derivatives']['thumb']) for unit in index.units.values())
+    # The duplicate photo and its derivative are copied from the original, with their metadata
+    assert n_photos == n_thumbs == sum('/fotos/' in name for name in tree)
+    assert all(not url.endswith('-thumb.jpg?alt=media') for unit in index.units.values() for url in unit['fotos'])
@@ -0,0 +1,55 @@
+import os
+
+from utilities.cache import ProcessedImageCache
+
+
+def test_evicts_the_least_recently_used_images(tmp_path):
+    cache = ProcessedImageCache(str(tmp_path), max_bytes=25)
+    cache.put('a', b'a' * 10)
+    cache.put('b', b'b' * 10)
+    assert cache.get('a') == b'a' * 10
+
+    cache.put('c', b'c' * 10)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == b'a' * 10
+    assert cache.get('c') == b'c' * 10
+    assert cache.evictions == 1
+    assert not os.path.exists(cache._path('b'))
+
+
+def test_images_larger_than_the_cache_are_not_saved(tmp_path):
+    cache = ProcessedImageCache(str(tmp_path), max_bytes=10)
+    cache.put('a', b'a' * 5)
+
+    cache.put('b', b'b' * 11)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == b'a' * 5
+    assert cache.evictions == 0
+
+
+def test_replacing_an_image_counts_its_size_once(tmp_path):
+    cache = ProcessedImageCache(str(tmp_path), max_bytes=20)
+    cache.put('a', b'a' * 10)
+    cache.put('a', b'A' * 10)
+    cache.put('b', b'b' * 10)
+
+    assert cache.evictions == 0
+    assert cache.get('a') == b'A' * 10
+
+
+def test_loads_the_images_of_a_previous_run_in_order_of_use(tmp_path):
+    cache = ProcessedImageCache(str(tmp_path), max_bytes=30)
+    for key in ('a', 'b', 'c'):
+        cache.put(key, key.encode() * 10)
+    os.utime(cache._path('a'), (1, 1))
+    os.utime(cache._path('b'), (3, 3))
+    os.utime(cache._path('c'), (2, 2))
+
+    cache = ProcessedImageCache(str(tmp_path), max_bytes=20)
+
+    assert cache.evictions == 1
+    assert cache.get('a') is None
+    assert cache.get('b') == b'b' * 10
+    assert cache.get('c') == b'c' * 10
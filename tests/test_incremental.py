@@ -0,0 +1,79 @@
+import pytest
+
+from benchmarks.benchmark_pipeline import watermark_png
+from benchmarks.synthetic_tree import synthetic_jpeg
+from utilities.brokers import Broker
+from utilities.image_manager import ImageManager
+from utilities.incremental import IncrementalOnboarding, is_retryable
+from utilities.manifest import META_SOURCE
+
+NAME = 'edificio-torre/local-1/fotos/torre-local-1-01.jpg'
+OUTPUT = f'B/{NAME}'
+
+
+@pytest.fixture
+def onboarding(storage, uploader):
+    storage.put('marks', 'w.png', watermark_png(), 'image/png')
+    for index in (1, 2):
+        storage.put('dl', f'edificio-torre/local-1/fotos/torre-local-1-0{index}.jpg', synthetic_jpeg((64, 48), index))
+
+    img_mng = ImageManager(n_tries=1, watermark_url=storage.public_url('marks', 'w.png'), engine=ImageManager.ENGINE_LOCAL,
+                           session=uploader.img_mng.session)
+    img_mng.watermark_engine.load()
+    return IncrementalOnboarding(uploader, [Broker('B', img_mng)])
+
+
+def test_onboard_skips_images_already_uploaded(storage, onboarding):
+    assert onboarding.onboard(NAME) == 2
+    assert storage.get('up', OUTPUT).metadata[META_SOURCE] == NAME
+    assert 'B/index.json' in storage.buckets['up']
+
+    assert onboarding.onboard(NAME) == 0
+
+
+def test_onboard_uploads_an_overwritten_source_again(storage, onboarding):
+    onboarding.onboard(NAME)
+    generation = storage.get('up', OUTPUT).generation
+
+    storage.put('dl', NAME, synthetic_jpeg((64, 48), 99))
+
+    assert onboarding.onboard(NAME) == 1
+    assert storage.get('up', OUTPUT).generation > generation
+
+
+def test_onboard_uploads_images_without_source_metadata_again(storage, onboarding):
+    onboarding.onboard(NAME)
+    # An image uploaded before the source was saved in the metadata
+    storage.put('up', OUTPUT, storage.get('up', OUTPUT).data)
+
+    assert onboarding.onboard(NAME) == 1
+    assert storage.get('up', OUTPUT).metadata[META_SOURCE] == NAME
+
+
+def test_onboard_does_not_retry_an_image_that_cannot_be_processed(storage, onboarding, capsys):
+    storage.put('dl', NAME, b'not an image')
+
+    # The event is not delivered again, the failure is only logged
+    onboarding.onboard(NAME)
+
+    assert f'Could not process {NAME} for B, not retried: process' in capsys.readouterr().out
+
+
+def test_onboard_retries_a_network_failure(storage, onboarding):
+    broker = onboarding.brokers[0]
+    broker.img_mng = ImageManager(n_tries=0, watermark_url=broker.img_mng.watermark_url,
+                                  watermark_endpoint='http://127.0.0.1:9/watermark')
+
+    with pytest.raises(RuntimeError):
+        onboarding.onboard(NAME)
+
+
+@pytest.mark.parametrize('stage, error, retryable', [
+    ('watermark_service', 'ConnectionError', True),
+    ('download', 'HTTP 503', True),
+    ('upload', 'HTTP 429', True),
+    ('download', 'HTTP 404', False),
+    ('process', 'UnidentifiedImageError', False),
+])
+def test_is_retryable(stage, error, retryable):
+    assert is_retryable({'stage': stage, 'error': error}) == retryable
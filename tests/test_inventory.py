@@ -0,0 +1,101 @@
+import re
+
+import pytest
+
+from utilities.inventory import BLUEPRINTS, PHOTOS, check_prefixes, classify
+from utilities.pipeline import inventory_tasks
+
+NAMES = [
+    '.DS_Store',
+    'edificio-a/local-1/fotos/.DS_Store',
+    'edificio-a/local-1/fotos/a-local-1-01.jpg',
+    'edificio-a/local-1/fotos/a-local-1-02.jpg',
+    'edificio-a/local-1/fotos/a-local-1-10.jpg',
+    # A photo without index, its own group
+    'edificio-a/local-1/fotos/portada.jpg',
+    # A subfolder listed between the photos of its parent folder
+    'edificio-a/local-1/fotos/b/b-01.jpg',
+    'edificio-a/local-1/fotos/c-01.jpg',
+    'edificio-a/local-1/planos/plano-1.jpg',
+    'edificio-a/local-1/planos/plano-2.png',
+    # In both kinds of groups, as in the baseline
+    'edificio-a/local-2/fotos/planos/x-01.jpg',
+    'edificio-a/local-2/fotos/y-01.jpg',
+    'edificio-b/casa-fotos/c-01.jpg',
+    'edificio-b/otros/readme.txt',
+]
+
+
+def baseline_groups(names):
+    # The grouping of the listing of the baseline, with a listing for the photos and another one for the blueprints
+    photos, blueprints = {}, {}
+    for name in names:
+        if '.DS_Store' in name:
+            continue
+        if 'fotos/' in name:
+            photos.setdefault(re.sub(r'\d{2}\.jpg$', '', name), []).append(name)
+        if 'planos/' in name:
+            blueprints.setdefault('/'.join(name.split('/')[:-1]), []).append(name)
+
+    paths = {}
+    for key, group in photos.items():
+        for index, name in enumerate(group):
+            paths[(PHOTOS, f'{key}{index + 1:02}.jpg')] = name
+    for path, group in blueprints.items():
+        for name in group:
+            paths[(BLUEPRINTS, f"{path}/{name.split('/')[-1]}")] = name
+    return paths
+
+
+def test_inventory_numbers_photos_as_the_baseline(storage, uploader):
+    for name in NAMES:
+        storage.put('dl', name, b'image')
+    skipped = []
+
+    tasks = list(inventory_tasks(uploader.iter_inventory(skipped=skipped)))
+
+    assert {(task.kind, task.path): task.name for task in tasks} == baseline_groups(sorted(NAMES))
+    assert len(tasks) == len(baseline_groups(NAMES))
+    assert sorted(skipped) == ['.DS_Store', 'edificio-a/local-1/fotos/.DS_Store', 'edificio-b/otros/readme.txt']
+
+
+def test_groups_are_yielded_once_their_folder_is_listed(storage, uploader):
+    for name in NAMES:
+        storage.put('dl', name, b'image')
+
+    groups = [(kind, key, [image.name for image in images]) for kind, key, images in uploader.iter_inventory()]
+
+    keys = [(kind, key) for kind, key, _ in groups]
+    assert len(keys) == len(set(keys))
+    assert (PHOTOS, 'edificio-a/local-1/fotos/a-local-1-', [
+        'edificio-a/local-1/fotos/a-local-1-01.jpg',
+        'edificio-a/local-1/fotos/a-local-1-02.jpg',
+        'edificio-a/local-1/fotos/a-local-1-10.jpg',
+    ]) in groups
+    assert (BLUEPRINTS, 'edificio-a/local-1/planos', [
+        'edificio-a/local-1/planos/plano-1.jpg',
+        'edificio-a/local-1/planos/plano-2.png',
+    ]) in groups
+
+
+def test_classify():
+    assert classify('a/fotos/b-01.jpg') == [(PHOTOS, 'a/fotos/b-')]
+    assert classify('a/planos/p.jpg') == [(BLUEPRINTS, 'a/planos')]
+    assert classify('a/fotos/planos/p-01.jpg') == [(PHOTOS, 'a/fotos/planos/p-'), (BLUEPRINTS, 'a/fotos/planos')]
+    assert classify('a/fotos/.DS_Store') == []
+    assert classify('a/otros/x.jpg') == []
+
+
+@pytest.mark.parametrize('prefixes', [
+    ['edificio-a/local-1/fotos/a-local'],
+    ['edificio-a/', 'edificio-a/local-1/'],
+    ['edificio-a/local-1/', 'edificio-a/'],
+])
+def test_check_prefixes_rejects_prefixes_splitting_or_repeating_groups(prefixes):
+    with pytest.raises(ValueError):
+        check_prefixes(prefixes)
+
+
+def test_check_prefixes_accepts_disjoint_prefixes():
+    prefixes = ['edificio-a/', 'edificio-b/local-1/fotos/', 'edificio-c']
+    assert check_prefixes(iter(prefixes)) == prefixes
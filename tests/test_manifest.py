@@ -0,0 +1,69 @@
+import pytest
+
+from utilities import DEFAULT_IMAGE_CONTENT
+from utilities.manifest import META_GENERATION, META_MD5, META_SOURCE, META_VARIANT, Manifest
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    manifest = Manifest(str(tmp_path / 'manifest.db'))
+    yield manifest
+    manifest.close()
+
+
+@pytest.mark.parametrize('source, generation, md5_hash, variant, done', [
+    ('a/fotos/a-01.jpg', 1, 'md5', 'w', True),
+    ('a/fotos/a-02.jpg', 1, 'md5', 'w', False),
+    ('a/fotos/a-01.jpg', 2, 'md5', 'w', False),
+    ('a/fotos/a-01.jpg', 1, 'other', 'w', False),
+    ('a/fotos/a-01.jpg', 1, 'md5', 'other', False),
+    # Unknown versions of the source are not compared
+    ('a/fotos/a-01.jpg', None, None, 'w', True),
+])
+def test_is_done(manifest, source, generation, md5_hash, variant, done):
+    manifest.record('B/a/fotos/a-01.jpg', 'a/fotos/a-01.jpg', 1, 'md5', 'w', 'out')
+
+    assert manifest.is_done('B/a/fotos/a-01.jpg', source, generation, md5_hash, variant) is done
+    assert manifest.n_skipped == int(done)
+
+
+def test_is_done_without_record(manifest):
+    assert not manifest.is_done('B/a/fotos/a-01.jpg', 'a/fotos/a-01.jpg', 1, 'md5', 'w')
+
+
+def test_record_without_source_is_done(manifest):
+    manifest.record_blob_metadata('B/a/fotos/a-01.jpg', None, 'out')
+
+    assert manifest.is_done('B/a/fotos/a-01.jpg', 'a/fotos/a-01.jpg', 1, 'md5', 'w')
+
+
+def test_merge_keeps_the_most_recent_record(tmp_path, manifest, monkeypatch):
+    clock = iter(range(100))
+    monkeypatch.setattr('utilities.manifest.time.time', lambda: next(clock))
+    shard = Manifest(str(tmp_path / 'shard.db'))
+    manifest.record('B/old.jpg', 'old.jpg', 1, 'md5', 'w', 'out')
+    manifest.record('B/new.jpg', 'new.jpg', 1, 'md5', 'w', 'out')
+    shard.record('B/old.jpg', 'old.jpg', 2, 'md5', 'w', 'out')
+    shard.record('B/shard.jpg', 'shard.jpg', 1, 'md5', 'w', 'out')
+    manifest.record('B/new.jpg', 'new.jpg', 3, 'md5', 'w', 'out')
+    shard.close()
+
+    assert manifest.merge(str(tmp_path / 'shard.db')) == 2
+    assert len(manifest) == 3
+    assert manifest.is_done('B/old.jpg', 'old.jpg', 2, 'md5', 'w')
+    assert manifest.is_done('B/new.jpg', 'new.jpg', 3, 'md5', 'w')
+    assert manifest.is_done('B/shard.jpg', 'shard.jpg', 1, 'md5', 'w')
+
+
+@pytest.mark.parametrize('strict, n_recorded', [(False, 2), (True, 1)])
+def test_rebuild_manifest(storage, uploader, manifest, strict, n_recorded):
+    metadata = {META_SOURCE: 'a/fotos/a-01.jpg', META_GENERATION: '1', META_MD5: 'md5', META_VARIANT: 'w'}
+    storage.put('up', 'B/a/fotos/a-01.jpg', b'image', metadata=metadata)
+    storage.put('up', 'B/a/fotos/a-02.jpg', b'image')
+    storage.put('up', 'B/a/fotos/a-03.jpg', DEFAULT_IMAGE_CONTENT, metadata=metadata)
+    storage.put('up', 'C/a/fotos/a-01.jpg', b'image', metadata=metadata)
+
+    assert uploader.rebuild_manifest(manifest, 'B', strict=strict) == n_recorded
+    assert manifest.is_done('B/a/fotos/a-01.jpg', 'a/fotos/a-01.jpg', 1, 'md5', 'w')
+    assert manifest.is_done('B/a/fotos/a-02.jpg', 'a/fotos/a-02.jpg', 1, 'md5', 'w') is not strict
+    assert not manifest.is_done('B/a/fotos/a-03.jpg', 'a/fotos/a-01.jpg', 1, 'md5', 'w')
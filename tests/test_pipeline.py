@@ -0,0 +1,53 @@
+from utilities.firebase_manager import FirebaseUploaderManager
+from utilities.inventory import Inventory
+from utilities.journal import note_error
+from utilities.pipeline import PipelineConfig, inventory_tasks
+
+# The last photo of every unit of the tree is shared by the units of the building
+SHARED = '-03.jpg'
+
+
+def run(uploader, brokers):
+    tasks = inventory_tasks(Inventory().consume(uploader.iter_inventory()))
+    config = PipelineConfig(threads=2, process_mode=PipelineConfig.PROCESS_THREADS)
+    return uploader.run_pipeline(tasks, brokers, config=config)
+
+
+def shared(storage):
+    return {name: obj.data for name, obj in storage.buckets['up'].items() if name.endswith(SHARED)}
+
+
+def test_duplicates_are_copied_from_the_original(storage, uploader, tree, make_broker, monkeypatch):
+    uploads, copies = [], []
+    upload, copy = FirebaseUploaderManager._upload_img, FirebaseUploaderManager._copy_uploaded_img
+    monkeypatch.setattr(FirebaseUploaderManager, '_upload_img',
+                        lambda self, name, *args, **kwargs: uploads.append(name) or upload(self, name, *args, **kwargs))
+    monkeypatch.setattr(FirebaseUploaderManager, '_copy_uploaded_img',
+                        lambda self, source, name, *args: copies.append(name) or copy(self, source, name, *args))
+
+    assert run(uploader, [make_broker()]) == len(tree)
+
+    assert len(uploads) == len(tree) - 1
+    assert len(copies) == 1 and copies[0].endswith(SHARED)
+    data = shared(storage)
+    assert len(data) == 2 and len(set(data.values())) == 1
+
+
+def test_duplicate_is_processed_when_the_original_fails(storage, uploader, tree, make_broker, monkeypatch):
+    upload = FirebaseUploaderManager._upload_img
+    failed = []
+
+    def upload_img(self, name, *args, **kwargs):
+        if name.endswith(SHARED) and not failed:
+            failed.append(name)
+            note_error('HTTP 503', 'Service Unavailable')
+            return None
+        return upload(self, name, *args, **kwargs)
+
+    monkeypatch.setattr(FirebaseUploaderManager, '_upload_img', upload_img)
+    monkeypatch.setattr(FirebaseUploaderManager, '_copy_uploaded_img', lambda *args: None)
+
+    assert run(uploader, [make_broker()]) == len(tree)
+
+    data = shared(storage)
+    assert len(data) == 1 and failed[0] not in data
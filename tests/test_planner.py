@@ -0,0 +1,48 @@
+import hashlib
+import json
+
+from click.testing import CliRunner
+
+import onboarding_brokers_imgs
+from utilities.planner import read_runs
+
+
+def test_read_runs_skips_invalid_lines(tmp_path):
+    path = tmp_path / 'run_history.jsonl'
+    runs = [{'config': {'io_engine': 'threads'}, 'n': 1}, {'config': {'io_engine': 'async'}, 'n': 2}]
+    path.write_text('\n'.join([json.dumps(runs[0]), '[1, 2]', '"text"', '{"n": 3}', '{"config": null}', '{"conf',
+                               json.dumps(runs[1])]) + '\n')
+
+    assert read_runs(str(path)) == runs
+    assert read_runs(str(path), 'async') == [runs[1]]
+    assert read_runs(str(tmp_path / 'missing.jsonl')) == []
+
+
+def snapshot(path):
+    return {file.name: hashlib.md5(file.read_bytes()).hexdigest() for file in path.iterdir() if file.is_file()}
+
+
+def test_plan_has_no_side_effects(storage, tree, tmp_path, monkeypatch):
+    uploader = onboarding_brokers_imgs.FirebaseUploaderManager
+    # The fake storage does not need the key
+    monkeypatch.setattr(onboarding_brokers_imgs, 'FirebaseUploaderManager',
+                        lambda download, upload, key, *args, **kwargs: uploader(download, upload, None, *args, **kwargs))
+    monkeypatch.chdir(tmp_path)
+    key = tmp_path / 'key.json'
+    key.write_text('{}')
+    args = ['-d', 'dl', '-u', 'up', '-k', str(key), '-br', 'B', '-w', storage.public_url('marks', 'w.png'), '-pi', '0']
+    result = CliRunner().invoke(onboarding_brokers_imgs.onboarding_brokers_imgs, args)
+    assert result.exit_code == 0, result.output
+    uploaded = dict(storage.buckets['up'])
+    (tmp_path / 'logs.log').unlink()
+    files = snapshot(tmp_path)
+
+    result = CliRunner().invoke(onboarding_brokers_imgs.onboarding_brokers_imgs,
+                                args + ['--plan', '--rebuild_manifest', '-cd', str(tmp_path / 'cache')])
+
+    assert result.exit_code == 0, result.output
+    # The read-only manifest may leave the empty files of its journal
+    assert {name: md5 for name, md5 in snapshot(tmp_path).items() if not name.startswith('manifest.db-')} == files
+    assert not (tmp_path / 'logs.log').exists()
+    assert not (tmp_path / 'cache').exists()
+    assert storage.buckets['up'] == uploaded
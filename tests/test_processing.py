@@ -0,0 +1,17 @@
+from utilities import processing
+from utilities.inventory import PHOTOS
+
+
+def test_pool_restarts_when_a_process_dies():
+    pool = processing.ImageProcessPool({}, workers=1)
+    try:
+        assert pool.render(PHOTOS, 'url', None, [], []) == ([], [], {}, [])
+        executor = pool._executor
+        for process in list(executor._processes.values()):
+            process.kill()
+            process.join()
+
+        assert pool.render(PHOTOS, 'url', None, [], []) == ([], [], {}, [])
+        assert pool._executor is not executor
+    finally:
+        pool.close()
@@ -0,0 +1,183 @@
+import pytest
+
+from utilities import rate_control
+from utilities.rate_control import AdaptiveLimiter, CircuitBreaker
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_control.time, 'monotonic', clock)
+    return clock
+
+
+def run_round(limiter, clock, latency, overloaded=False):
+    """Send `limit` requests at once and release them `latency` seconds later."""
+    n = int(limiter.limit)
+    for _ in range(n):
+        assert limiter.try_acquire() is None
+    clock.now += latency
+    for _ in range(n):
+        limiter.release(latency, overloaded)
+    return limiter.limit
+
+
+def test_limit_grows_by_one_per_round_with_steady_latency(clock):
+    limiter = AdaptiveLimiter(4, 64)
+
+    limits = [run_round(limiter, clock, 0.05) for _ in range(10)]
+
+    assert limits == sorted(limits)
+    assert 13 <= limits[-1] <= 15
+    assert limiter.latency == pytest.approx(0.05)
+
+
+def test_limit_stops_at_max_limit(clock):
+    limiter = AdaptiveLimiter(4, 8)
+
+    for _ in range(20):
+        run_round(limiter, clock, 0.05)
+
+    assert limiter.limit == 8
+
+
+def test_slow_response_halves_limit_once_per_round(clock):
+    limiter = AdaptiveLimiter(16, 64)
+    run_round(limiter, clock, 0.05)
+    limit = limiter.limit
+
+    # Every request of the round is slow, but they were all sent with the old limit
+    run_round(limiter, clock, 1.0)
+
+    assert limit / 2 <= limiter.limit < limit / 2 + 2
+
+
+def test_varied_latency_is_not_overload(clock):
+    limiter = AdaptiveLimiter(4, 64)
+
+    for latency in [0.05, 0.1, 0.03, 0.12, 0.06, 0.09, 0.04, 0.11] * 2:
+        previous = limiter.limit
+        assert run_round(limiter, clock, latency) > previous
+
+    assert 0.03 < limiter.latency < 0.12
+
+
+def test_average_latency_follows_a_slower_service(clock):
+    limiter = AdaptiveLimiter(4, 64)
+    for _ in range(5):
+        run_round(limiter, clock, 0.05)
+
+    # A gradual slowdown moves the average instead of looking like overload forever
+    decreases = 0
+    for latency in [0.1, 0.2, 0.3, 0.4, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5]:
+        previous = limiter.limit
+        decreases += run_round(limiter, clock, latency) < previous
+
+    assert decreases <= 2
+    assert limiter.latency > 0.3
+    previous = limiter.limit
+    assert run_round(limiter, clock, 0.5) > previous
+
+
+def test_limit_stays_under_ceiling_until_probe_interval(clock):
+    limiter = AdaptiveLimiter(10, 64, probe_interval=10.0)
+    run_round(limiter, clock, 0.05)
+
+    # The service throttles a single request of the round, ex: with a 429
+    assert limiter.try_acquire() is None
+    clock.now += 0.05
+    limiter.release(0.05, overloaded=True)
+    ceiling = limiter.ceiling
+    assert limiter.limit == pytest.approx(ceiling / 2)
+
+    for _ in range(50):
+        run_round(limiter, clock, 0.05)
+    assert limiter.limit <= ceiling - 1
+
+    clock.now += 10.0
+    for _ in range(5):
+        run_round(limiter, clock, 0.05)
+    assert limiter.limit > ceiling
+
+
+def test_limit_never_under_min_limit(clock):
+    limiter = AdaptiveLimiter(4, 64, min_limit=2)
+
+    for _ in range(10):
+        run_round(limiter, clock, 0.05, overloaded=True)
+        clock.now += 1.0
+
+    assert limiter.limit == 2
+
+
+def test_pause_blocks_new_requests(clock):
+    limiter = AdaptiveLimiter(4, 64)
+
+    limiter.pause(1.5)
+
+    assert limiter.try_acquire() == pytest.approx(1.5)
+    clock.now += 1.5
+    assert limiter.try_acquire() is None
+
+
+def test_try_acquire_waits_at_the_limit(clock):
+    limiter = AdaptiveLimiter(2, 64)
+
+    assert limiter.try_acquire() is None
+    assert limiter.try_acquire() is None
+    assert limiter.try_acquire() == 0.0
+    limiter.release(0.05)
+    assert limiter.try_acquire() is None
+
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30.0)
+
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.n_opened == 1
+    assert not breaker.allow()
+    assert breaker.remaining() == pytest.approx(30.0)
+
+
+def test_breaker_allows_a_single_trial_after_timeout(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30.0)
+    breaker.record_failure()
+
+    clock.now += 30.0
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+
+def test_breaker_reopens_if_trial_fails(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30.0)
+    breaker.record_failure()
+    clock.now += 30.0
+    assert breaker.allow()
+
+    breaker.record_failure()
+
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.n_opened == 2
+    assert breaker.remaining() == pytest.approx(30.0)
@@ -0,0 +1,58 @@
+import pytest
+
+from utilities.inventory import unit_prefix
+from utilities.pipeline import unit_key
+from utilities.sharding import Shard
+
+NAMES = [
+    'edificio-a/local-1/fotos/a-local-1-01.jpg',
+    'edificio-a/local-1/fotos/a-local-1-02.jpg',
+    'edificio-a/local-1/planos/plano.jpg',
+    'edificio-a/local-2/planos/plano.jpg',
+    'edificio-b/local-1/fotos/b-local-1-01.jpg',
+    # Matched as a substring by `classify`, as in the listing of the whole bucket
+    'edificio-c/casa-fotos/c-01.jpg',
+    'edificio-d/local-1/otros/d.jpg',
+]
+
+
+@pytest.mark.parametrize('name, prefix', [
+    ('edificio-a/local-1/fotos/a-local-1-01.jpg', 'edificio-a/local-1/'),
+    ('edificio-a/local-1/planos/', 'edificio-a/local-1/'),
+    ('edificio-c/casa-fotos/c-01.jpg', 'edificio-c/'),
+    ('edificio-a/local-1/fotos/planos/x.jpg', 'edificio-a/local-1/'),
+    ('fotos/x-01.jpg', ''),
+    ('edificio-d/local-1/otros/d.jpg', None),
+])
+def test_unit_prefix(name, prefix):
+    assert unit_prefix(name) == prefix
+
+
+def test_unit_key():
+    assert unit_key('edificio-a/local-1/fotos/a-local-1-01.jpg') == 'edificio-a/local-1'
+    assert unit_key('edificio-c/casa-fotos/c-01.jpg') == 'edificio-c'
+    assert unit_key('edificio-d/local-1/otros/d.jpg') == 'edificio-d/local-1/otros'
+
+
+def listed(uploader, prefixes=None):
+    return sorted(image.name for _, _, images in uploader.iter_inventory(prefixes) for image in images)
+
+
+def recorded(units, found):
+    for unit in found:
+        units.append(unit)
+        yield unit
+
+
+def test_shards_list_the_same_images_as_the_whole_bucket(storage, uploader):
+    for name in NAMES:
+        storage.put('dl', name, b'image')
+
+    units = []
+    images = []
+    for index in range(1, 4):
+        # Lazily, as the command does, since an empty list of prefixes lists the whole bucket
+        images.extend(listed(uploader, recorded(units, uploader.iter_shard_units(Shard(index, 3)))))
+
+    assert sorted(units) == ['edificio-a/local-1/', 'edificio-a/local-2/', 'edificio-b/local-1/', 'edificio-c/']
+    assert sorted(images) == listed(uploader)
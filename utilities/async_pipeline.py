@@ -0,0 +1,507 @@
+import asyncio
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import google.auth.transport.requests
+
+from . import DEFAULT_IMAGE_CONTENT
+from .brokers import Broker
+from .buffers import CHUNK_SIZE, heap_estimate, is_spooled, read_response_async
+from . import metrics
+from .metrics import METRICS
+from .pipeline import _DONE, ByteBudget, ImageTask, Pipeline
+from .rate_control import ServiceControl
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# The class and the message of an error, as noted in the failure journal
+Error = Tuple[str, str]
+
+
+def async_available() -> bool:
+    """
+    Check if the `async` I/O engine can be used, that is if `aiohttp` is installed.
+
+    Returns:
+        bool: If `aiohttp` is installed.
+    """
+    return aiohttp is not None
+
+
+def _wake(waiter: asyncio.Future) -> None:
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class AsyncByteBudget(ByteBudget):
+    """
+    A `ByteBudget` that can also be acquired from an event loop without blocking it. The bytes are still
+    released from any thread, ex: the threads processing the images.
+
+    Args:
+        max_bytes (int): The maximum number of bytes in flight.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        super().__init__(max_bytes)
+        self._waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+
+    async def acquire_async(self, n_bytes: int) -> None:
+        """
+        Reserve `n_bytes`, waiting until they fit in the budget without blocking the event loop.
+
+        Args:
+            n_bytes (int): The number of bytes to reserve.
+        Returns:
+            None
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._cond:
+                if not self.in_flight or self.in_flight + n_bytes <= self.max_bytes:
+                    self.in_flight += n_bytes
+                    self.peak = max(self.peak, self.in_flight)
+                    return
+                waiter = loop.create_future()
+                self._waiters.append((loop, waiter))
+            await waiter
+
+    def adjust(self, old_bytes: int, new_bytes: int) -> None:
+        super().adjust(old_bytes, new_bytes)
+        if new_bytes < old_bytes:
+            with self._cond:
+                waiters, self._waiters = self._waiters, []
+            for loop, waiter in waiters:
+                loop.call_soon_threadsafe(_wake, waiter)
+
+
+class AsyncImageClient:
+    """
+    The async counterpart of the downloads and watermark requests of `ImageManager`. The errors are returned along
+    with `DEFAULT_IMAGE_CONTENT` instead of noted with `note_error`.
+
+    Args:
+        session (aiohttp.ClientSession): The session of the event loop, with its limits of connections.
+    """
+
+    def __init__(self, session: 'aiohttp.ClientSession') -> None:
+        self.session = session
+        # Wakes the requests waiting for the limit of each watermark service once a request is released
+        self._released: Dict[ServiceControl, asyncio.Condition] = {}
+
+    @staticmethod
+    def _timeout(img_mng) -> 'aiohttp.ClientTimeout':
+        connect_timeout, read_timeout = img_mng.timeouts
+        return aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+
+    async def download(self, img_mng, img_url: str) -> Tuple[bytes, Optional[Error]]:
+        """
+        Download an image from a public url, as `ImageManager._download_image`.
+
+        Args:
+            img_mng (ImageManager): The image manager whose timeouts and log are used.
+            img_url (str): The public url of the image.
+        Returns:
+            Tuple[bytes, Optional[Error]]: The image content, and the error if it's `DEFAULT_IMAGE_CONTENT`.
+        """
+        start = time.perf_counter()
+        try:
+            async with self.session.get(img_url, timeout=self._timeout(img_mng)) as r:
+                content = await read_response_async(r) if r.status == 200 else await r.read()
+        except Exception as e:
+            METRICS.record(metrics.DOWNLOAD, time.perf_counter() - start, error=True)
+            img_mng._log_error(f'{e}. Could not download the image. URL: {img_url}')
+            return DEFAULT_IMAGE_CONTENT, (type(e).__name__, str(e))
+
+        if r.status == 200:
+            METRICS.record(metrics.DOWNLOAD, time.perf_counter() - start, bytes_in=len(content))
+            return content, None
+
+        METRICS.record(metrics.DOWNLOAD, time.perf_counter() - start, error=True)
+        img_mng._log_error(f'Error downloading the image. Status code: {r.status}. URL: {img_url}')
+        return DEFAULT_IMAGE_CONTENT, (f'HTTP {r.status}', r.reason or '')
+
+    async def _acquire(self, control: ServiceControl) -> None:
+        released = self._released.setdefault(control, asyncio.Condition())
+        while True:
+            wait = control.limiter.try_acquire()
+            if wait is None:
+                return
+            if wait:
+                await asyncio.sleep(wait)
+                continue
+            async with released:
+                try:
+                    # Bounded, in case the limit is also released by a thread
+                    await asyncio.wait_for(released.wait(), 1.0)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _release(self, control: ServiceControl, latency: Optional[float] = None, overloaded: bool = False) -> None:
+        control.limiter.release(latency, overloaded)
+        released = self._released.get(control)
+        if released is not None:
+            async with released:
+                released.notify_all()
+
+    async def apply_watermark(self, img_mng, img_url: str) -> Tuple[bytes, Optional[Error]]:
+        """
+        The async counterpart of `ImageManager._apply_watermark`.
+
+        Args:
+            img_mng (ImageManager): The image manager with the watermark and the rate control of the service.
+            img_url (str): The public url of the image.
+        Returns:
+            Tuple[bytes, Optional[Error]]: The image content with the watermark, and the error if it's `DEFAULT_IMAGE_CONTENT`.
+        """
+        payload = img_mng.watermark_payload(img_url)
+        control = img_mng.service_control
+
+        for attempt in range(img_mng.N_TRIES + 1):
+            last_attempt = attempt == img_mng.N_TRIES
+            if attempt:
+                METRICS.retry(metrics.WATERMARK)
+
+            if not control.breaker.allow():
+                if last_attempt:
+                    img_mng._log_error(f"Error applying watermark to the image, the watermark service is unavailable. URL: {img_url}")
+                    return DEFAULT_IMAGE_CONTENT, ('CircuitOpen', 'The watermark service is unavailable')
+                # Waits for the circuit breaker instead of sending the request
+                await asyncio.sleep(max(control.breaker.remaining(), control.delay(attempt)))
+                continue
+
+            await self._acquire(control)
+            start = time.monotonic()
+            try:
+                async with self.session.post(img_mng.WATERMARK_RESOURCE_ENDPOINT, json=payload, headers=img_mng.WATERMARK_HEADERS,
+                                             timeout=self._timeout(img_mng)) as r:
+                    content = await read_response_async(r) if r.status == 200 else await r.read()
+            except Exception as e:
+                latency = time.monotonic() - start
+                METRICS.record(metrics.WATERMARK, latency, error=True)
+                await self._release(control, latency, isinstance(e, (asyncio.TimeoutError, aiohttp.ClientConnectionError)))
+                control.breaker.record_failure()
+                if last_attempt:
+                    img_mng._log_error(f"{e}. Could not apply watermark to the image. URL: {img_url}")
+                    return DEFAULT_IMAGE_CONTENT, (type(e).__name__, str(e))
+                await asyncio.sleep(control.delay(attempt))
+                continue
+
+            overloaded = r.status == 429 or r.status >= 500
+            latency = time.monotonic() - start
+            await self._release(control, latency, overloaded)
+            METRICS.record(metrics.WATERMARK, latency, bytes_in=len(content) if r.status == 200 else 0,
+                           error=r.status != 200)
+
+            if r.status == 200:
+                control.breaker.record_success()
+                return content, None
+
+            if overloaded:
+                control.breaker.record_failure()
+            else:
+                # The service is answering, the request itself is wrong
+                control.breaker.record_success()
+            if not overloaded or last_attempt:
+                img_mng._log_error(f"Error applying watermark to the image, reason: {r.reason}. Status code: {r.status}. "
+                                   f"URL: {img_url}")
+                return DEFAULT_IMAGE_CONTENT, (f'HTTP {r.status}', r.reason or '')
+
+            await asyncio.sleep(control.delay(attempt, r.headers.get('Retry-After')))
+
+        return DEFAULT_IMAGE_CONTENT, ('Unknown', '')
+
+
+async def _stream_body(head: bytes, img, tail: bytes):
+    yield head
+    for offset in range(0, len(img), CHUNK_SIZE):
+        yield img[offset:offset + CHUNK_SIZE]
+    yield tail
+
+
+class AsyncUploader:
+    """
+    The async counterpart of `FirebaseUploaderManager._upload_img`, uploading the images to the upload bucket with
+    multipart uploads of the JSON API of the storage.
+
+    Args:
+        uploader (FirebaseUploaderManager): The manager whose upload bucket and Cache-Control are used.
+        session (aiohttp.ClientSession): The session of the event loop, with its limits of connections.
+        credentials (google.auth.credentials.Credentials): The credentials that authorize the uploads.
+        api_endpoint (str): The host of the storage, ex: `FirebaseUploaderManager.api_endpoint`.
+    """
+
+    def __init__(self, uploader, session: 'aiohttp.ClientSession', credentials, api_endpoint: str) -> None:
+        self.uploader = uploader
+        self.session = session
+        self.api_endpoint = api_endpoint.rstrip('/')
+        self._credentials = credentials
+        self._refresh_lock = asyncio.Lock()
+
+    async def _auth_headers(self) -> Dict[str, str]:
+        headers: Dict[str, str] = {}
+        if not self._credentials.valid:
+            async with self._refresh_lock:
+                if not self._credentials.valid:
+                    # The token is refreshed with a blocking request, once for every upload waiting for it
+                    await asyncio.to_thread(self._credentials.refresh, google.auth.transport.requests.Request())
+        self._credentials.apply(headers)
+        return headers
+
+    async def upload(self, blob_name: str, img: bytes, metadata: Optional[Dict[str, str]] = None,
+                     content_type: str = 'image/jpeg') -> Tuple[str, Optional[Error]]:
+        """
+        Upload an image to the upload bucket.
+
+        Args:
+            blob_name (str): The name of the blob.
+            img (bytes): The image to upload, or an image spooled to a temporary file.
+            metadata (Dict[str, str], optional): The custom metadata of the blob.
+            content_type (str, optional): The content type of the image.
+        Returns:
+            Tuple[str, Optional[Error]]: The public url of the blob, or an empty string and the error.
+        """
+        bucket = self.uploader.upload_bucket
+        resource = {'name': blob_name, 'contentType': content_type}
+        if metadata:
+            resource['metadata'] = metadata
+        if self.uploader.cache_control:
+            resource['cacheControl'] = self.uploader.cache_control
+        boundary = uuid.uuid4().hex
+        head = b''.join([
+            f'--{boundary}\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n'.encode(),
+            json.dumps(resource).encode('utf-8'),
+            f'\r\n--{boundary}\r\nContent-Type: {content_type}\r\n\r\n'.encode(),
+        ])
+        tail = f'\r\n--{boundary}--\r\n'.encode()
+        spooled = is_spooled(img)
+        body = _stream_body(head, img, tail) if spooled else b''.join([head, img, tail])
+        url = f'{self.api_endpoint}/upload/storage/v1/b/{bucket.name}/o?uploadType=multipart'
+
+        start = time.perf_counter()
+        try:
+            headers = await self._auth_headers()
+            headers['Content-Type'] = f'multipart/related; boundary="{boundary}"'
+            if spooled:
+                # The length is known, so the streamed body is not sent with chunked encoding
+                headers['Content-Length'] = str(len(head) + len(img) + len(tail))
+            async with self.session.post(url, data=body, headers=headers) as r:
+                response = await r.read()
+            if r.status != 200:
+                raise RuntimeError(f'{r.status} POST {url}: {response[:200].decode("utf-8", "replace")}')
+        except Exception as e:
+            METRICS.record(metrics.UPLOAD, time.perf_counter() - start, error=True)
+            self.uploader.img_mng._log_error(f'Error uploading image: {e}')
+            return '', (type(e).__name__, str(e))
+        METRICS.record(metrics.UPLOAD, time.perf_counter() - start, bytes_out=len(img))
+
+        return bucket.blob(blob_name).public_url, None
+
+
+class _LoopQueue:
+    # Receives the duplicates released by `Pipeline` from any thread, and schedules their copy in the event loop
+    def __init__(self, loop: asyncio.AbstractEventLoop, spawn) -> None:
+        self._loop = loop
+        self._spawn = spawn
+
+    def put(self, task: ImageTask) -> None:
+        self._loop.call_soon_threadsafe(self._spawn, task)
+
+
+class AsyncPipeline(Pipeline):
+    """
+    The pipeline of `Pipeline` with its network requests sent from an event loop, with at most
+    `config.async_concurrency` images in flight. The images are processed in a pool of threads or processes, and
+    the blocking clients, ex: the server-side copies or the manifest, are used from a pool of `config.copy_workers` threads.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.budget = AsyncByteBudget(self.config.max_inflight_bytes)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._images: Optional[AsyncImageClient] = None
+        self._async_uploader: Optional[AsyncUploader] = None
+        self._process_executor: Optional[ThreadPoolExecutor] = None
+        self._io_executor: Optional[ThreadPoolExecutor] = None
+        self._running: Set[asyncio.Task] = set()
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._copy_slots: Optional[asyncio.Semaphore] = None
+        self._producer_error: Optional[BaseException] = None
+
+    async def _in_thread(self, executor: ThreadPoolExecutor, func, *args):
+        return await self._loop.run_in_executor(executor, func, *args)
+
+    async def _fetch_async(self, task: ImageTask) -> None:
+        # The cache is on disk, so it's read from a thread
+        task.brokers = await self._in_thread(self._io_executor, self._uncached_brokers, task)
+
+        remote = [broker for broker in task.brokers if broker.img_mng.remote]
+        sharing = [broker for broker in task.brokers if self._needs_source(broker)]
+
+        reserved = heap_estimate(task.size or self.config.default_image_size) * (len(remote) + bool(sharing))
+        await self.budget.acquire_async(reserved)
+        try:
+            fetches = [self._images.apply_watermark(broker.img_mng, task.url) for broker in remote]
+            if sharing:
+                fetches.append(self._images.download(self.img_mng, task.url))
+            results = await asyncio.gather(*fetches)
+
+            if sharing:
+                task.data, error = results.pop()
+                if error is not None:
+                    for broker in sharing:
+                        task.failures[broker.name] = (metrics.DOWNLOAD, *error)
+            for broker, (data, error) in zip(remote, results):
+                if error is not None:
+                    task.failures[broker.name] = (metrics.WATERMARK, *error)
+                task.outputs.append((broker, data))
+        except BaseException:
+            self.budget.release(reserved)
+            task.data = None
+            task.outputs = []
+            task.ready = []
+            task.derivatives = []
+            raise
+        self.budget.adjust(reserved, task.n_bytes())
+
+    async def _upload_output(self, task: ImageTask, broker: Broker, data: bytes) -> None:
+        path = self._path(task, broker)
+        content_type = self._content_type(broker, data)
+        metadata = self._metadata(task, broker)
+
+        # The derivatives are uploaded next to the image, and the image is only recorded as done with all of them
+        uploads = [self._async_uploader.upload(path, data, metadata, content_type)]
+        uploads.extend(self._async_uploader.upload(derivative.rename(path), derivative_data,
+                                                   self._derivative_metadata(metadata, derivative), content_type)
+                       for derivative_broker, derivative, derivative_data in task.derivatives if derivative_broker is broker)
+        results = await asyncio.gather(*uploads)
+
+        url = results[0][0]
+        errors = [error for _, error in results if error is not None]
+        # The output is hashed and recorded in the manifest and the journal from a thread, not to block the event loop
+        await self._in_thread(self._io_executor, self._output_uploaded, task, broker, data, url, errors[0] if errors else None)
+
+    async def _upload_async(self, task: ImageTask) -> None:
+        uploads = []
+        for broker, data in task.outputs:
+            if data is None:
+                uploads.append(self._in_thread(self._io_executor, self._copy_output, task, broker))
+            else:
+                uploads.append(self._upload_output(task, broker, data))
+        await asyncio.gather(*uploads)
+
+        self._finish(task)
+
+    async def _onboard(self, task: ImageTask, stage: str = metrics.DOWNLOAD) -> None:
+        try:
+            await self._fetch_async(task)
+            stage = metrics.PROCESS
+            await self._in_thread(self._process_executor, self._process, task)
+            stage = metrics.UPLOAD
+            await self._upload_async(task)
+        except Exception as e:
+            # The failure is recorded in the journal from a thread, as the other writes
+            await self._in_thread(self._io_executor, self._unexpected_error, task, stage, e)
+
+    async def _onboard_image(self, task: ImageTask) -> None:
+        try:
+            await self._onboard(task)
+        finally:
+            self._slots.release()
+
+    async def _copy_duplicate_async(self, task: ImageTask) -> None:
+        async with self._copy_slots:
+            try:
+                pending = await self._in_thread(self._io_executor, self._copy_duplicate_outputs, task)
+            except Exception as e:
+                await self._in_thread(self._io_executor, self._unexpected_error, task, metrics.DEDUP, e)
+                return
+
+            if pending:
+                # The original image failed for these brokers, so the duplicate is processed by itself
+                task.brokers = pending
+                await self._onboard(task, metrics.DEDUP)
+            else:
+                self._group_progress(task)
+
+    def _spawn(self, coro) -> None:
+        running = asyncio.ensure_future(coro)
+        self._running.add(running)
+        running.add_done_callback(self._running.discard)
+
+    def _produce(self, tasks: Iterable[ImageTask], inbox: asyncio.Queue) -> None:
+        # The listing and the manifest are blocking, so the tasks are produced from a thread
+        try:
+            for task in self._pending(self._scheduled(tasks)):
+                asyncio.run_coroutine_threadsafe(inbox.put(task), self._loop).result()
+        except BaseException as e:
+            self._producer_error = e
+        finally:
+            asyncio.run_coroutine_threadsafe(inbox.put(_DONE), self._loop).result()
+
+    async def _run(self, tasks: Iterable[ImageTask]) -> None:
+        config = self.config
+        self._loop = asyncio.get_running_loop()
+        self._slots = asyncio.Semaphore(config.async_concurrency)
+        self._copy_slots = asyncio.Semaphore(config.copy_workers)
+        if config.dedup:
+            self._duplicates_q = _LoopQueue(self._loop, lambda task: self._spawn(self._copy_duplicate_async(task)))
+
+        connector = aiohttp.TCPConnector(limit=config.async_concurrency, limit_per_host=config.host_connections)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            self._images = AsyncImageClient(session)
+            self._async_uploader = AsyncUploader(self.uploader, session, self.uploader.credentials,
+                                                 self.uploader.api_endpoint)
+
+            inbox = asyncio.Queue(maxsize=config.queue_size)
+            producer = threading.Thread(target=self._produce, args=(tasks, inbox), daemon=True)
+            producer.start()
+            while True:
+                task = await inbox.get()
+                if task is _DONE:
+                    break
+                METRICS.queue_depth(metrics.DOWNLOAD, inbox.qsize())
+                await self._slots.acquire()
+                self._spawn(self._onboard_image(task))
+
+            # The duplicates are released while the images are uploaded, so they are waited for until none is left
+            while self._running:
+                await asyncio.wait(set(self._running))
+            await self._loop.run_in_executor(None, producer.join)
+            if self._producer_error is not None:
+                raise self._producer_error
+
+    def run(self, tasks: Iterable[ImageTask]) -> int:
+        """
+        Run every task through the pipeline from an event loop, see `Pipeline.run`.
+
+        Args:
+            tasks (Iterable[ImageTask]): The tasks to process.
+        Returns:
+            int: The number of images uploaded, counting the image of each broker.
+        """
+        if self.server_copy:
+            # A server-side copy only waits for the storage, the threads of the copies are enough
+            return super().run(tasks)
+        if not async_available():
+            raise RuntimeError('The async I/O engine requires aiohttp, install it with: pip install aiohttp')
+
+        self._start_process_pool()
+        self._process_executor = ThreadPoolExecutor(self.config.process_workers)
+        self._io_executor = ThreadPoolExecutor(self.config.copy_workers)
+        try:
+            asyncio.run(self._run(tasks))
+        finally:
+            self._process_executor.shutdown()
+            self._io_executor.shutdown()
+            self._close_process_pool()
+            METRICS.gauge('peak_inflight_bytes', max(self.budget.peak, METRICS.gauges.get('peak_inflight_bytes', 0)))
+
+        return self.n_uploaded
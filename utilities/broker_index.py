@@ -0,0 +1,128 @@
+import json
+import re
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, Optional, Set, Tuple
+
+from .inventory import BLUEPRINTS, PHOTOS
+from .manifest import META_DERIVATIVE
+from .pipeline import unit_key
+
+# The name of the index inside the folder of the broker
+INDEX_NAME = 'index.json'
+# The index changes on every run, so it's only cached for a short time
+INDEX_CACHE_CONTROL = 'public, max-age=60'
+# The images are only replaced when they are processed again, ex: with another watermark
+IMAGES_CACHE_CONTROL = 'public, max-age=86400'
+
+
+def _natural_key(name: str) -> list:
+    # The photos are sorted by their index, ex: '-2.jpg' before '-10.jpg'
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', name)]
+
+
+class BrokerIndex:
+    """
+    The index of the images uploaded for a broker, uploaded as `{broker}/index.json`:
+
+    {
+        "broker": "nombre-empresa-broker",
+        "updated_at": "2024-08-01T12:00:00+00:00",
+        "units": {
+            "edificio-parque-andino/local-3": {
+                "fotos": ["https://firebasestorage.googleapis.com/v0/b/.../parque-andino-local-3-01.jpg?alt=media", ...],
+                "planos": ["https://firebasestorage.googleapis.com/v0/b/.../parque-andino-local-3-plano-1.jpg?alt=media"],
+                "derivatives": {"thumb": ["https://firebasestorage.googleapis.com/v0/b/.../parque-andino-local-3-01-thumb.jpg?alt=media", ...]}
+            }
+        }
+    }
+
+    The photos, and their derivatives, are in the order of their index.
+
+    Args:
+        broker_name (str): The name of the broker.
+        units (Dict[str, dict], optional): The images of each unit, as in the `units` of the index.
+        updated_at (str, optional): When the index was updated.
+    """
+
+    def __init__(self, broker_name: str, units: Optional[Dict[str, dict]] = None, updated_at: Optional[str] = None) -> None:
+        self.broker_name = broker_name
+        self.units = units or {}
+        self.updated_at = updated_at
+
+    def __len__(self) -> int:
+        return len(self.units)
+
+    @classmethod
+    def loads(cls, data: bytes) -> 'BrokerIndex':
+        """
+        Load an index uploaded by a previous run.
+
+        Args:
+            data (bytes): The content of the index.
+        Returns:
+            BrokerIndex: The index.
+        """
+        index = json.loads(data)
+        return cls(index['broker'], index.get('units'), index.get('updated_at'))
+
+    def dumps(self) -> bytes:
+        """
+        Get the content of the index to upload, without spaces so it's as small as possible.
+
+        Returns:
+            bytes: The content of the index.
+        """
+        index = {'broker': self.broker_name, 'updated_at': self.updated_at, 'units': dict(sorted(self.units.items()))}
+        return json.dumps(index, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+    def update(self, blobs: Iterable[Tuple[str, Optional[Dict[str, str]]]], public_url: Callable[[str], str],
+               units: Optional[Set[str]] = None) -> int:
+        """
+        Replace the images of the units with the blobs uploaded for the broker, telling the derivatives apart by their metadata.
+
+        Args:
+            blobs (Iterable[Tuple[str, Dict[str, str]]]): The name and the metadata of the blobs in the folder of the
+                broker, ex: listed from the upload bucket.
+            public_url (Callable[[str], str]): Get the public url of a blob from its name.
+            units (Set[str], optional): The units to replace, ex: 'edificio-parque-andino/local-3'. If it's None, every unit
+                of the index is replaced.
+        Returns:
+            int: The number of units indexed.
+        """
+        prefix = f'{self.broker_name}/'
+        found: Dict[str, Dict[str, list]] = {}
+        for name, metadata in blobs:
+            path = name[len(prefix):] if name.startswith(prefix) else name
+            match = re.search(r'/(fotos|planos)/', path)
+            if not match:
+                continue
+
+            unit = unit_key(path)
+            if units is not None and unit not in units:
+                continue
+            entry = found.setdefault(unit, {PHOTOS: [], BLUEPRINTS: []})
+            if match.group(1) == BLUEPRINTS:
+                entry[BLUEPRINTS].append(name)
+                continue
+
+            derivative = (metadata or {}).get(META_DERIVATIVE)
+            if derivative is None:
+                entry[PHOTOS].append(name)
+            else:
+                entry.setdefault('derivatives', {}).setdefault(derivative, []).append(name)
+
+        # The units without images anymore are removed
+        for unit in (set(self.units) if units is None else units) - set(found):
+            self.units.pop(unit, None)
+        for unit, entry in found.items():
+            self.units[unit] = {
+                PHOTOS: [public_url(name) for name in sorted(entry[PHOTOS], key=_natural_key)],
+                BLUEPRINTS: [public_url(name) for name in sorted(entry[BLUEPRINTS], key=_natural_key)],
+            }
+            if 'derivatives' in entry:
+                self.units[unit]['derivatives'] = {
+                    derivative: [public_url(name) for name in sorted(names, key=_natural_key)]
+                    for derivative, names in sorted(entry['derivatives'].items())}
+
+        self.updated_at = datetime.now(timezone.utc).isoformat(timespec='seconds')
+        return len(found)
@@ -0,0 +1,46 @@
+import json
+from typing import Dict, Optional
+
+from . import image_manager
+
+
+class Broker:
+    """
+    A broker whose images are onboarded, with the image manager that applies its watermark. The images of the
+    broker are saved in a folder with its name.
+
+    Args:
+        name (str): The name of the broker.
+        img_mng (image_manager.ImageManager): The image manager with the watermark of the broker.
+    """
+
+    def __init__(self, name: str, img_mng: image_manager.ImageManager) -> None:
+        self.name = name
+        self.img_mng = img_mng
+
+    def __repr__(self) -> str:
+        return f'Broker({self.name!r})'
+
+
+def load_brokers_config(path: str) -> Dict[str, Optional[str]]:
+    """
+    Load the brokers to onboard from a JSON file, mapping the name of each broker to the url of its watermark.
+    A broker without watermark has a null url.
+    Ex:
+    {
+        "nombre-empresa-broker": "https://url.marca-agua-broker.cl/marca.png",
+        "otro-broker": null
+    }
+
+    Args:
+        path (str): The path to the JSON file.
+    Returns:
+        Dict[str, Optional[str]]: The url of the watermark of each broker.
+    """
+    with open(path, 'r') as f:
+        config = json.load(f)
+
+    if not isinstance(config, dict) or not config:
+        raise ValueError(f'The brokers config must be a non empty JSON object of broker name to watermark url: {path}')
+
+    return config
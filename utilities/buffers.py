@@ -0,0 +1,237 @@
+import io
+import mmap
+import tempfile
+from typing import Iterable, List, Optional, Union
+
+# The images larger than this are spooled to a temporary file instead of being held in the heap
+DEFAULT_SPOOL_THRESHOLD = 16 * 1024 * 1024
+# The size of the chunks read from the responses, and of the chunks of the resumable uploads of the spooled images
+CHUNK_SIZE = 1024 * 1024
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+# An image in memory, or spooled to a temporary file and mapped in memory
+Buffer = Union[bytes, mmap.mmap]
+
+_spool_threshold = DEFAULT_SPOOL_THRESHOLD
+_spool_dir: Optional[str] = None
+
+
+def configure_spool(threshold: int = DEFAULT_SPOOL_THRESHOLD, directory: Optional[str] = None) -> None:
+    """
+    Configure the spooling of the large images of the process.
+
+    Args:
+        threshold (int, optional): The images larger than this number of bytes are spooled, 0 disables the spooling.
+        directory (str, optional): The directory of the temporary files, defaults to the temporary directory of the system.
+    Returns:
+        None
+    """
+    global _spool_threshold, _spool_dir
+    _spool_threshold = threshold
+    _spool_dir = directory
+
+
+def is_spooled(data) -> bool:
+    """
+    Check if an image is spooled to a temporary file.
+    """
+    return isinstance(data, mmap.mmap)
+
+
+def heap_size(data: Optional[Buffer]) -> int:
+    """
+    Get the bytes of an image held in the heap, 0 if it's spooled.
+    """
+    return 0 if data is None or is_spooled(data) else len(data)
+
+
+def heap_estimate(size: int) -> int:
+    """
+    Get the bytes of the heap an image of `size` bytes will use once downloaded, at most the spooling threshold.
+    """
+    return min(size, _spool_threshold) if _spool_threshold else size
+
+
+class Spool:
+    """
+    A buffer that collects the chunks of an image in memory until they exceed the spooling threshold, then in a
+    temporary file mapped in memory.
+
+    Args:
+        size_hint (int, optional): The expected size of the image, ex: the Content-Length of the response, so an image
+            known to be large is written to the file from the first chunk.
+    """
+
+    def __init__(self, size_hint: int = 0) -> None:
+        self._chunks: List[bytes] = []
+        self._size = 0
+        self._file = None
+        if _spool_threshold and size_hint > _spool_threshold:
+            self._file = tempfile.TemporaryFile(dir=_spool_dir)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def write(self, chunk) -> int:
+        """
+        Add a chunk of the image.
+
+        Args:
+            chunk (bytes): The chunk, any bytes-like object.
+        Returns:
+            int: The number of bytes written.
+        """
+        self._size += len(chunk)
+        if self._file is None and _spool_threshold and self._size > _spool_threshold:
+            self._file = tempfile.TemporaryFile(dir=_spool_dir)
+            for previous in self._chunks:
+                self._file.write(previous)
+            self._chunks = []
+
+        if self._file is not None:
+            self._file.write(chunk)
+        else:
+            self._chunks.append(bytes(chunk))
+        return len(chunk)
+
+    def value(self) -> Buffer:
+        """
+        Get the image, as bytes if it's in memory or mapped from the temporary file if it was spooled.
+
+        Returns:
+            Buffer: The image.
+        """
+        if self._file is None:
+            chunks, self._chunks = self._chunks, []
+            return chunks[0] if len(chunks) == 1 else b''.join(chunks)
+
+        file, self._file = self._file, None
+        try:
+            file.flush()
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if self._size else b''
+        finally:
+            file.close()
+
+
+def spool_chunks(chunks: Iterable, size_hint: int = 0) -> Buffer:
+    """
+    Collect the chunks of an image, spooling it if it's larger than the threshold.
+
+    Args:
+        chunks (Iterable): The chunks, ex: `response.iter_content(CHUNK_SIZE)`.
+        size_hint (int, optional): The expected size of the image.
+    Returns:
+        Buffer: The image.
+    """
+    spool = Spool(size_hint)
+    for chunk in chunks:
+        spool.write(chunk)
+    return spool.value()
+
+
+def spool(data: Buffer) -> Buffer:
+    """
+    Move an image larger than the threshold out of the heap.
+
+    Args:
+        data (Buffer): The image.
+    Returns:
+        Buffer: The same image if it's small or already spooled, otherwise the spooled image.
+    """
+    if not _spool_threshold or is_spooled(data) or len(data) <= _spool_threshold:
+        return data
+
+    return spool_chunks([data], len(data))
+
+
+def read_response(response) -> Buffer:
+    """
+    Read the body of a response sent with `stream=True`, spooling it if it's larger than the threshold.
+
+    Args:
+        response (requests.Response): The response.
+    Returns:
+        Buffer: The body.
+    """
+    length = int(response.headers.get('Content-Length') or 0)
+    if not _spool_threshold or 0 < length <= _spool_threshold:
+        return response.content
+
+    return spool_chunks(response.iter_content(CHUNK_SIZE), length)
+
+
+async def read_response_async(response) -> Buffer:
+    """
+    The async counterpart of `read_response`, for the responses of aiohttp.
+
+    Args:
+        response (aiohttp.ClientResponse): The response.
+    Returns:
+        Buffer: The body.
+    """
+    length = response.content_length or 0
+    if not _spool_threshold or 0 < length <= _spool_threshold:
+        return await response.read()
+
+    spool = Spool(length)
+    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+        spool.write(chunk)
+    return spool.value()
+
+
+class BufferReader(io.RawIOBase):
+    """
+    A readable and seekable file over a buffer, without copying it, ex: to decode a spooled image with Pillow.
+
+    Args:
+        data (Buffer): The buffer to read.
+    """
+
+    def __init__(self, data) -> None:
+        super().__init__()
+        self._view = memoryview(data).cast('B')
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        chunk = self._view[self._position:self._position + len(b)]
+        n = len(chunk)
+        b[:n] = chunk
+        self._position += n
+        return n
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._position = max(0, offset)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def close(self) -> None:
+        if not self.closed:
+            self._view.release()
+        super().close()
+
+
+def open_buffer(data: Buffer) -> io.IOBase:
+    """
+    Get a file to read an image without copying it.
+
+    Args:
+        data (Buffer): The image.
+    Returns:
+        io.IOBase: The file.
+    """
+    if isinstance(data, bytes):
+        return io.BytesIO(data)
+
+    return io.BufferedReader(BufferReader(data), CHUNK_SIZE)
@@ -0,0 +1,159 @@
+import os
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+
+class ProcessedImageCache:
+    """
+    An on-disk cache of processed images, addressed by the content of the source image and the processing applied to it.
+    The least recently used images are evicted once it exceeds `max_bytes`.
+
+    Attributes:
+        hits (int): The number of images found in the cache.
+        misses (int): The number of images not found in the cache.
+        evictions (int): The number of images evicted from the cache.
+    Args:
+        directory (str): The directory where the images are saved.
+        max_bytes (int): The maximum size of the cache in bytes.
+    """
+
+    def __init__(self, directory: str, max_bytes: int) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # key -> size, from the least to the most recently used
+        self._entries: OrderedDict = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    @staticmethod
+    def key(*parts: str) -> str:
+        """
+        Get the key of a processed image from the parts that identify it, ex: the source hash, the watermark and
+        the compression parameters.
+
+        Args:
+            *parts (str): The parts that identify the processed image.
+        Returns:
+            str: The key of the image.
+        """
+        return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def _load(self) -> None:
+        """
+        Index the images already in the cache directory, using their modification time as the last use.
+        """
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.startswith('.'):
+                    continue
+                stat = os.stat(os.path.join(root, name))
+                entries.append((stat.st_mtime, name, stat.st_size))
+
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self._size += size
+
+        self._evict()
+
+    def _evict(self) -> None:
+        """
+        Remove the least recently used images until the cache fits in `self.max_bytes`. Must be called holding the lock.
+        """
+        while self._entries and self._size > self.max_bytes:
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        Get a processed image from the cache.
+
+        Args:
+            key (str): The key of the image.
+        Returns:
+            Optional[bytes]: The image content, None if it's not in the cache.
+        """
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+
+        try:
+            with open(self._path(key), 'rb') as f:
+                img = f.read()
+            # Saves the last use, so the order survives between runs
+            os.utime(self._path(key))
+        except OSError:
+            with self._lock:
+                size = self._entries.pop(key, None)
+                if size is not None:
+                    self._size -= size
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return img
+
+    def put(self, key: str, img: bytes) -> None:
+        """
+        Save a processed image in the cache, evicting the least recently used images if the cache is full.
+
+        Args:
+            key (str): The key of the image.
+            img (bytes): The image content.
+        Returns:
+            None
+        """
+        if len(img) > self.max_bytes:
+            return
+
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(img)
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+
+        with self._lock:
+            self._size += len(img) - self._entries.pop(key, 0)
+            self._entries[key] = len(img)
+            self._evict()
+
+    def stats(self) -> str:
+        """
+        Get a summary of the use of the cache.
+
+        Returns:
+            str: The hits, misses and size of the cache.
+        """
+        total = self.hits + self.misses
+        ratio = self.hits / total * 100 if total else 0.0
+        return f'Cache: {self.hits} hits, {self.misses} misses ({ratio:.1f}% hit ratio), {self.evictions} evictions, ' +\
+            f'{self._size / (1024 * 1024):.1f}/{self.max_bytes / (1024 * 1024):.0f} MB used'
@@ -0,0 +1,246 @@
+import os
+from PIL import Image, features
+from typing import Dict, Optional, Tuple
+
+from . import tools
+from .watermark_engine import WatermarkEngine
+
+FORMATS = {
+    # format -> (extension, content type)
+    'JPEG': ('.jpg', 'image/jpeg'),
+    'WEBP': ('.webp', 'image/webp'),
+    'AVIF': ('.avif', 'image/avif'),
+}
+
+
+def format_available(format: str) -> bool:
+    """
+    Check if Pillow can encode images in `format`. AVIF requires the optional `pillow-avif-plugin` package
+    on the Pillow versions without native support.
+
+    Args:
+        format (str): The format, ex: JPEG, WEBP or AVIF.
+    Returns:
+        bool: If the format can be encoded.
+    """
+    if format == 'AVIF':
+        try:
+            import pillow_avif  # noqa: F401
+        except ImportError:
+            pass
+    elif format == 'WEBP':
+        return features.check('webp')
+
+    Image.init()
+    return format in Image.SAVE
+
+
+class EncodingProfile:
+    """
+    How the processed images are decoded and encoded.
+
+    Args:
+        name (str): The name of the profile.
+        max_size (Tuple[int, int], optional): The maximum width and height of the images, None keeps the original size.
+        quality (int, optional): The quality of the encoded images (0-100).
+        format (str, optional): The format of the encoded images: JPEG, WEBP or AVIF.
+        progressive (bool, optional): If the JPEG images are encoded as progressive.
+        optimize (bool, optional): If the JPEG images are encoded with optimized Huffman tables.
+        method (int, optional): The speed/size tradeoff of the WebP encoder (0 fast - 6 small).
+    """
+
+    def __init__(self, name: str, max_size: Optional[Tuple[int, int]] = None, quality: int = 20, format: str = 'JPEG',
+                 progressive: bool = False, optimize: bool = False, method: int = 4) -> None:
+        if format not in FORMATS:
+            raise ValueError(f'Unknown image format: {format}')
+
+        self.name = name
+        self.max_size = max_size
+        self.quality = quality
+        self.format = format
+        self.progressive = progressive
+        self.optimize = optimize
+        self.method = method
+
+    def __repr__(self) -> str:
+        return f'EncodingProfile({self.name!r})'
+
+    @property
+    def extension(self) -> str:
+        """
+        The extension of the encoded images, ex: `.jpg`.
+        """
+        return FORMATS[self.format][0]
+
+    @property
+    def content_type(self) -> str:
+        """
+        The content type of the encoded images, ex: `image/jpeg`.
+        """
+        return FORMATS[self.format][1]
+
+    @property
+    def key(self) -> str:
+        """
+        The identity of the encoding, so the images encoded with different settings are not considered the same.
+        """
+        max_size = 'x'.join(map(str, self.max_size)) if self.max_size else 'full'
+        return f'{self.format.lower()}-q{self.quality}-{max_size}' +\
+            ('-progressive' if self.progressive else '') + ('-optimize' if self.optimize else '')
+
+    def _options(self) -> Dict[str, object]:
+        if self.format == 'JPEG':
+            return {'progressive': self.progressive, 'optimize': self.optimize}
+        if self.format == 'WEBP':
+            return {'method': self.method}
+
+        return {}
+
+    def check(self) -> None:
+        """
+        Check that the format of the profile can be encoded, failing before any image is processed.
+
+        Returns:
+            None
+        """
+        if not format_available(self.format):
+            raise ValueError(f'The {self.format} format is not supported by the installed Pillow' +
+                             (', install pillow-avif-plugin' if self.format == 'AVIF' else ''))
+
+    def decode(self, img: bytes) -> Image.Image:
+        """
+        Decode an image, shrinking it to `self.max_size`.
+
+        Args:
+            img (bytes): The image content.
+        Returns:
+            Image.Image: The decoded image in RGB mode.
+        """
+        return tools.decode_img(img, self.max_size)
+
+    def encode(self, image: Image.Image) -> bytes:
+        """
+        Encode an image with the settings of the profile.
+
+        Args:
+            image (Image.Image): The decoded image.
+        Returns:
+            bytes: The encoded image.
+        """
+        return tools.encode_img(image, self.quality, self.format, **self._options())
+
+    def compress(self, img: bytes, watermark: Optional[WatermarkEngine] = None) -> bytes:
+        """
+        Decode and encode an image with the settings of the profile, optionally applying a watermark to it.
+
+        Args:
+            img (bytes): The image content.
+            watermark (WatermarkEngine, optional): The watermark engine used to apply the watermark.
+        Returns:
+            bytes: The encoded image.
+        """
+        image = self.decode(img)
+        if watermark:
+            image = watermark.apply(image)
+
+        return self.encode(image)
+
+    def rename(self, path: str) -> str:
+        """
+        Replace the extension of `path` with the extension of the profile. The JPEG profiles keep the original name.
+
+        Args:
+            path (str): The path of the image.
+        Returns:
+            str: The path with the extension of the profile.
+        """
+        if self.format == 'JPEG':
+            return path
+
+        return os.path.splitext(path)[0] + self.extension
+
+
+class Derivative:
+    """
+    A smaller version of the processed images, uploaded next to them with a suffix in the name,
+    ex: `fotos/local-3-01-thumb.jpg` next to `fotos/local-3-01.jpg`.
+
+    Args:
+        name (str): The name of the derivative, used as the suffix, ex: `thumb`.
+        max_size (int): The maximum width and height of the derivative in pixels.
+    """
+
+    def __init__(self, name: str, max_size: int) -> None:
+        if not name or '/' in name:
+            raise ValueError(f'Invalid derivative name: {name}')
+        if max_size <= 0:
+            raise ValueError(f'Invalid derivative size: {max_size}')
+
+        self.name = name
+        self.max_size = max_size
+
+    def __repr__(self) -> str:
+        return f'Derivative({self.name!r}, {self.max_size})'
+
+    @classmethod
+    def parse(cls, value: str) -> 'Derivative':
+        """
+        Parse a derivative given as `name:size`, ex: `thumb:320`.
+
+        Args:
+            value (str): The derivative.
+        Returns:
+            Derivative: The parsed derivative.
+        """
+        name, sep, size = value.partition(':')
+        if not sep or not size.strip().isdigit():
+            raise ValueError(f'Invalid derivative: {value}, the format is name:size, ex: thumb:320')
+
+        return cls(name.strip(), int(size))
+
+    @property
+    def key(self) -> str:
+        """
+        The identity of the derivative, ex: `thumb=320`.
+        """
+        return f'{self.name}={self.max_size}'
+
+    def rename(self, path: str) -> str:
+        """
+        Add the suffix of the derivative to `path`, before the extension.
+
+        Args:
+            path (str): The path of the processed image.
+        Returns:
+            str: The path of the derivative.
+        """
+        root, extension = os.path.splitext(path)
+        return f'{root}-{self.name}{extension}'
+
+    def resize(self, image: Image.Image) -> Image.Image:
+        """
+        Get the image shrunk to fit in `self.max_size`, without enlarging it.
+
+        Args:
+            image (Image.Image): The processed image, with the watermark already applied.
+        Returns:
+            Image.Image: The resized image, a new image even if it is not resized.
+        """
+        scale = self.max_size / max(image.size)
+        if scale >= 1:
+            return image.copy()
+
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        return image.resize(size, Image.LANCZOS, reducing_gap=3.0)
+
+
+# The profile used before the profiles existed, full size baseline JPEG at quality 20
+PROFILE_LEGACY = 'legacy'
+
+PROFILES: Dict[str, EncodingProfile] = {
+    PROFILE_LEGACY: EncodingProfile(PROFILE_LEGACY),
+    'web': EncodingProfile('web', max_size=(1920, 1920), quality=60, progressive=True, optimize=True),
+    'web-small': EncodingProfile('web-small', max_size=(1280, 1280), quality=50, progressive=True, optimize=True),
+    'webp': EncodingProfile('webp', max_size=(1920, 1920), quality=60, format='WEBP'),
+    'avif': EncodingProfile('avif', max_size=(1920, 1920), quality=50, format='AVIF'),
+}
@@ -1,13 +1,23 @@
 from google.cloud import storage
 import os
-import re
-import concurrent.futures
-from typing import Dict, List
-from . import image_manager
+import time
+import requests
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+from . import async_pipeline, broker_index, image_manager, inventory, pipeline
+import google.auth
 from google.oauth2 import service_account
-from google.cloud.storage.blob import Blob
+from google.auth.credentials import AnonymousCredentials
+from google.auth.transport.requests import AuthorizedSession
+from google.api_core.exceptions import NotFound, PreconditionFailed
 import urllib
-from . import tools
+from . import tools, DEFAULT_IMAGE_CONTENT
+from .brokers import Broker
+from .buffers import UPLOAD_CHUNK_SIZE, is_spooled, open_buffer
+from .manifest import META_SOURCE, Manifest, md5_base64
+from . import metrics
+from .metrics import METRICS
+from .journal import FailureJournal, note_error
+from .sharding import Shard
 
 
 class FirebaseUploaderManager:
@@ -19,39 +29,224 @@ class FirebaseUploaderManager:
     Args:
         download_bucket_id (str): The id of the bucket to download images.
         upload_bucket_id (str): The id of the bucket to upload images.
-        cred_fb_sdk (str): The path to the Firebase SDK credentials.
+        cred_fb_sdk (str): The path to the Firebase SDK credentials. If it's None, the default credentials of the
+            environment are used, ex: the service account of a Cloud Function, or no credentials if the environment
+            variable `STORAGE_EMULATOR_HOST` points to a local stand-in of the storage.
         img_mng (image_manager.ImageManager): An instance of ImageManager to process the images.
+        pool_size (int, optional): The number of keep-alive connections to the storage shared by all the threads, typically the number of threads.
+        cache_control (str, optional): The Cache-Control of the uploaded images, so the browsers and the CDN cache them.
+            If it's None, the default of the storage is used.
     """
 
-    def __init__(self, download_bucket_id: str, upload_bucket_id: str,  cred_fb_path: str, img_mng: image_manager.ImageManager) -> None:
-        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = cred_fb_path
-        credentials = service_account.Credentials.from_service_account_file(
-            cred_fb_path)
-        self.client = storage.Client(credentials=credentials)
+    def __init__(self, download_bucket_id: str, upload_bucket_id: str,  cred_fb_path: Optional[str], img_mng: image_manager.ImageManager,
+                 pool_size: int = 10, cache_control: Optional[str] = broker_index.IMAGES_CACHE_CONTROL) -> None:
+        # The transport is shared by all the threads, so the uploads reuse the connections
+        if cred_fb_path is None and os.environ.get('STORAGE_EMULATOR_HOST'):
+            self.credentials = AnonymousCredentials()
+            http = tools.mount_pool(requests.Session(), pool_size)
+            self.client = storage.Client(project='local', credentials=self.credentials, _http=http)
+        else:
+            if cred_fb_path is None:
+                self.credentials, _ = google.auth.default(scopes=storage.Client.SCOPE)
+            else:
+                os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = cred_fb_path
+                self.credentials = service_account.Credentials.from_service_account_file(
+                    cred_fb_path, scopes=storage.Client.SCOPE)
+            http = tools.mount_pool(AuthorizedSession(self.credentials), pool_size)
+            self.client = storage.Client(credentials=self.credentials, _http=http)
+        # The host of the storage, or of its local stand-in when `STORAGE_EMULATOR_HOST` is set
+        self.api_endpoint = self.client.api_endpoint
         self.download_bucket = self.client.bucket(download_bucket_id)
         self.upload_bucket = self.client.bucket(upload_bucket_id)
         self.img_mng = img_mng
+        self.cache_control = cache_control
+        self._inventory = None
 
-    def _upload_img(self, blob_name: str, img: bytes) -> str:
+    def _upload_img(self, blob_name: str, img: bytes, metadata: Optional[Dict[str, str]] = None, content_type: str = 'image/jpeg') -> str:
         """
         Upload an image to Firebase Storage in `self.upload_bucket` bucket.
 
         Args:
             blob_name (str): The name of the blob.
-            img (bytes): The image to upload.
+            img (bytes): The image to upload, or an image spooled to a temporary file.
+            metadata (Dict[str, str], optional): The custom metadata of the blob.
+            content_type (str, optional): The content type of the image.
         Returns:
             str: The public url of the blob.
         """
         blob = self.upload_bucket.blob(blob_name)
+        if metadata:
+            blob.metadata = metadata
+        if self.cache_control:
+            blob.cache_control = self.cache_control
+        start = time.perf_counter()
         try:
-            blob.upload_from_string(img, content_type='image/jpeg')
+            if is_spooled(img):
+                blob.chunk_size = UPLOAD_CHUNK_SIZE
+                with open_buffer(img) as file:
+                    blob.upload_from_file(file, size=len(img), content_type=content_type)
+            else:
+                blob.upload_from_string(img, content_type=content_type)
         except Exception as e:
-            print(f'Error uploading image: {e}')
+            METRICS.record(metrics.UPLOAD, time.perf_counter() - start, error=True)
+            note_error(type(e).__name__, str(e))
+            self.img_mng._log_error(f'Error uploading image: {e}')
             return ''
+        METRICS.record(metrics.UPLOAD, time.perf_counter() - start, bytes_out=len(img))
 
         # blob.make_public()
         return blob.public_url
 
+    def _copy_img(self, source_name: str, blob_name: str, metadata: Optional[Dict[str, str]] = None,
+                  source_bucket: Optional[storage.Bucket] = None, content_type: Optional[str] = None) -> str:
+        """
+        Copy an image from the bucket `self.download_bucket` to the bucket `self.upload_bucket` with a server-side
+        rewrite, so the image never travels through this machine.
+
+        Args:
+            source_name (str): The name of the blob to copy.
+            blob_name (str): The name of the new blob.
+            metadata (Dict[str, str], optional): The custom metadata of the new blob.
+            source_bucket (storage.Bucket, optional): The bucket of the blob to copy, defaults to `self.download_bucket`.
+            content_type (str, optional): The content type of the new blob, defaults to the content type of the source blob.
+        Returns:
+            str: The public url of the new blob.
+        """
+        source = (source_bucket or self.download_bucket).blob(source_name)
+        blob = self.upload_bucket.blob(blob_name)
+        if metadata:
+            blob.metadata = metadata
+        if content_type:
+            blob.content_type = content_type
+        if self.cache_control:
+            blob.cache_control = self.cache_control
+        start = time.perf_counter()
+        try:
+            # Large objects or copies between locations may need several rewrite calls
+            token, n_bytes, _ = blob.rewrite(source)
+            while token is not None:
+                token, n_bytes, _ = blob.rewrite(source, token=token)
+        except Exception as e:
+            METRICS.record(metrics.COPY, time.perf_counter() - start, error=True)
+            note_error(type(e).__name__, str(e))
+            self.img_mng._log_error(f'Error copying image: {e}')
+            return ''
+        METRICS.record(metrics.COPY, time.perf_counter() - start, bytes_out=n_bytes or 0)
+
+        return blob.public_url
+
+    def _copy_uploaded_img(self, source_name: str, blob_name: str, metadata: Optional[Dict[str, str]] = None,
+                           content_type: Optional[str] = None) -> str:
+        """
+        Copy an image already uploaded to the bucket `self.upload_bucket` to another blob of the same bucket with
+        a server-side rewrite, ex: for an image whose source is identical to another one already processed.
+
+        Args:
+            source_name (str): The name of the uploaded blob to copy.
+            blob_name (str): The name of the new blob.
+            metadata (Dict[str, str], optional): The custom metadata of the new blob.
+            content_type (str, optional): The content type of the new blob.
+        Returns:
+            str: The public url of the new blob.
+        """
+        return self._copy_img(source_name, blob_name, metadata, self.upload_bucket, content_type)
+
+    def iter_inventory(self, prefixes: Optional[Iterable[str]] = None, skipped: Optional[List[str]] = None) -> Iterator[Tuple[str, str, List[inventory.SourceImage]]]:
+        """
+        List the bucket `self.download_bucket` once, yielding the photos and blueprints groups as soon as they are complete.
+
+        Args:
+            prefixes (Iterable[str], optional): Only list the blobs starting with these prefixes, ex: ['edificio-'].
+            skipped (List[str], optional): A list where the names of the blobs that are not images are appended.
+        Yields:
+            Tuple[str, str, List[SourceImage]]: The kind of the group (`inventory.PHOTOS` or `inventory.BLUEPRINTS`),
+            its key and its images.
+        """
+        for prefix in prefixes or [None]:
+            blobs = self.download_bucket.list_blobs(
+                prefix=prefix, fields=inventory.LIST_FIELDS)
+            yield from inventory.iter_groups(
+                self._timed_pages(blobs), lambda name: tools.get_public_url(self.download_bucket.name, name), skipped)
+
+    def iter_shard_units(self, shard: Shard, prefixes: Optional[List[str]] = None) -> Iterator[str]:
+        """
+        Find the units of the bucket `self.download_bucket` that belong to a shard, listing only its folders.
+
+        Args:
+            shard (Shard): The shard.
+            prefixes (List[str], optional): Only search the units starting with these prefixes, ex: ['edificio-'].
+        Yields:
+            str: The prefix of each unit of the shard, ex: 'edificio-parque-andino/local-3/', to list with `iter_inventory`.
+        """
+        pending = list(reversed(prefixes or ['']))
+        while pending:
+            prefix = pending.pop()
+            folders = self._list_folders(prefix)
+            # A folder in a group, ex: 'fotos/', makes `prefix` its unit, since `prefix` itself was not in any group
+            if any(inventory.unit_prefix(folder) is not None for folder in folders):
+                if shard.owns(prefix):
+                    yield prefix
+                continue
+            # Depth first and in lexicographic order, as the listing of the images
+            pending.extend(reversed(folders))
+
+    def _list_folders(self, prefix: str) -> List[str]:
+        """
+        List the folders directly under `prefix`, without listing the blobs.
+        """
+        blobs = self.download_bucket.list_blobs(prefix=prefix or None, delimiter='/', fields='prefixes,nextPageToken')
+        folders = []
+        pages = iter(blobs.pages)
+        while True:
+            start = time.perf_counter()
+            page = next(pages, None)
+            if page is None:
+                return sorted(folders)
+            folders.extend(page.prefixes)
+            METRICS.record(metrics.LIST, time.perf_counter() - start)
+
+    @staticmethod
+    def _timed_pages(blobs) -> Iterator:
+        """
+        Iterate the blobs of a listing, recording the latency of each page requested to the storage.
+        """
+        pages = iter(blobs.pages)
+        while True:
+            start = time.perf_counter()
+            page = next(pages, None)
+            if page is None:
+                return
+            items = list(page)
+            METRICS.record(metrics.LIST, time.perf_counter() - start)
+            yield from items
+
+    def get_inventory(self, prefixes: Optional[List[str]] = None) -> inventory.Inventory:
+        """
+        Get the inventory of photos and blueprints of the bucket `self.download_bucket`, listing it only once.
+
+        Args:
+            prefixes (List[str], optional): Only list the blobs starting with these prefixes, ex: ['edificio-'].
+        Returns:
+            Inventory: The photos and blueprints grouped by folder.
+        """
+        inv = inventory.Inventory()
+        for kind, key, images in self.iter_inventory(prefixes, inv.skipped):
+            inv.add(kind, key, images)
+
+        return inv
+
+    def _get_cached_inventory(self) -> inventory.Inventory:
+        """
+        Get the inventory of the whole bucket `self.download_bucket`, listing it on the first call only.
+
+        Returns:
+            Inventory: The photos and blueprints grouped by folder.
+        """
+        if self._inventory is None:
+            self._inventory = self.get_inventory()
+
+        return self._inventory
+
     def get_all_imgs_public_urls(self) -> Dict[str, List[str]]:
         """
         Get all public urls for images in the bucket: `self.download_bucket`, grouped by folder.
@@ -72,26 +267,7 @@ class FirebaseUploaderManager:
         Returns:
             Dict[str, List[str]]: A dictionary with the public urls of the blobs.
         """
-
-        blobs = self.download_bucket.list_blobs()
-        folders = {}
-        for blob in blobs:
-            if '.DS_Store' in blob.name or 'fotos/' not in blob.name:
-                # Ignore all type of files that are not images
-                continue
-
-            # Remove the indexing
-            filename = re.sub(r'\d{2}\.jpg$', '', blob.name)
-
-            if filename not in folders:
-                folders[filename] = []
-
-            public_url = f"https://firebasestorage.googleapis.com/v0/b/" +\
-                f"{self.download_bucket.name}/o/{urllib.parse.quote(blob.name, safe='')}?alt=media"
-
-            # folders[filename].append(blob.public_url)
-            folders[filename].append(public_url)
-        return folders
+        return inventory.Inventory.urls(self._get_cached_inventory().photos)
 
     def get_all_blueprint_imgs_public_urls(self) -> Dict[str, List[str]]:
         """
@@ -113,98 +289,161 @@ class FirebaseUploaderManager:
         Returns:
             Dict[str, List[str]]: A dictionary where the key is the folder path to folder planos and the value is a list of public urls.
         """
+        return inventory.Inventory.urls(self._get_cached_inventory().blueprints)
+
+    def rebuild_manifest(self, manifest: Manifest, broker_name: str, prefix: str = '', strict: bool = False) -> int:
+        """
+        Rebuild the records of `manifest` from the metadata of the images uploaded for the broker `broker_name`,
+        except the default image.
 
-        blobs = self.download_bucket.list_blobs()
-        paths = {}
+        Args:
+            manifest (Manifest): The manifest to rebuild.
+            broker_name (str): The name of the broker.
+            prefix (str, optional): Only record the images whose path inside the folder of the broker starts with this prefix.
+            strict (bool, optional): Only record the images with source information.
+        Returns:
+            int: The number of images recorded.
+        """
+        default_md5 = md5_base64(DEFAULT_IMAGE_CONTENT)
+        n_recorded = 0
+        blobs = self.upload_bucket.list_blobs(
+            prefix=f'{broker_name}/{prefix}', fields='items(name,md5Hash,metadata),nextPageToken')
         for blob in blobs:
-            if '.DS_Store' in blob.name or 'planos/' not in blob.name:
-                # Ignore all type of files that are not images
+            if blob.md5_hash == default_md5 or blob.name == f'{broker_name}/{broker_index.INDEX_NAME}':
+                continue
+            if strict and not (blob.metadata or {}).get(META_SOURCE):
                 continue
 
-            path_to_blueprint: str = blob.name
-            path_to_blueprint = "/".join(path_to_blueprint.split('/')[:-1])
-            if path_to_blueprint not in paths:
-                paths[path_to_blueprint] = []
-
-            public_url = f"https://firebasestorage.googleapis.com/v0/b/" +\
-                f"{self.download_bucket.name}/o/{urllib.parse.quote(blob.name, safe='')}?alt=media"
-
-            paths[path_to_blueprint].append(public_url)
+            manifest.record_blob_metadata(blob.name, blob.metadata, blob.md5_hash)
+            n_recorded += 1
 
-        return paths
+        return n_recorded
 
-    def _background_imgs_process(self, blob_name: str, public_imgs_url: List[str]) -> str:
+    def update_broker_index(self, broker_name: str, units: Optional[Iterable[str]] = None, n_tries: int = 5) -> int:
         """
-        Process a list of images by downloading them from bucket `self.download_bucket`, and
-        applying a watermark for then uploading them to `self.upload_bucket`.
-        This method is used as handler for the concurrent processing of images.
+        Update the index `{broker}/index.json` of the images uploaded for the broker `broker_name`, listing again only
+        the folders of `units`. If somebody else replaced the index since it was read, it's read and updated again.
 
         Args:
-            blob_name (str): The blob name for upload in to the bucket.
-            imgs (List[str]): The list of images to apply watermark and upload.
+            broker_name (str): The name of the broker.
+            units (Iterable[str], optional): The units whose images changed, ex: 'edificio-parque-andino/local-3'.
+                If it's None, or there is no index yet, the whole folder of the broker is listed.
+            n_tries (int, optional): The number of times the index is updated when it's replaced by somebody else.
         Returns:
-            str: The folder where the images were uploaded.
+            int: The number of units in the index.
+        Raises:
+            PreconditionFailed: If the index was replaced by somebody else in each of the `n_tries`.
         """
-        watermark_imgs = self.img_mng.download_images(public_imgs_url)
+        units = None if units is None else set(units)
+        if units is not None and not units:
+            return 0
+
+        for attempt in range(1, n_tries + 1):
+            try:
+                return self._replace_broker_index(broker_name, units)
+            except PreconditionFailed:
+                if attempt == n_tries:
+                    raise
+
+    def _replace_broker_index(self, broker_name: str, units: Optional[Set[str]]) -> int:
+        index_blob = self.upload_bucket.blob(f'{broker_name}/{broker_index.INDEX_NAME}')
+        index, generation = None, 0
+        try:
+            index_blob.reload()
+            generation = index_blob.generation
+            if units is not None:
+                index = broker_index.BrokerIndex.loads(index_blob.download_as_bytes(if_generation_match=generation))
+        except NotFound:
+            pass
+        except ValueError as e:
+            self.img_mng._log_error(f'Error reading the index of {broker_name}, rebuilding it: {e}')
+        if index is None:
+            # Without the index of a previous run, every unit of the broker is indexed
+            index, units = broker_index.BrokerIndex(broker_name), None
+
+        def public_url(name: str) -> str:
+            return self.upload_bucket.blob(name).public_url
+
+        prefixes = [f'{broker_name}/'] if units is None else [f'{broker_name}/{unit}/' for unit in sorted(units)]
+        blobs = ((blob.name, blob.metadata) for prefix in prefixes
+                 for blob in self._timed_pages(self.upload_bucket.list_blobs(prefix=prefix,
+                                                                             fields='items(name,metadata),nextPageToken')))
+        index.update(blobs, public_url, units)
+
+        index_blob.cache_control = broker_index.INDEX_CACHE_CONTROL
+        # 0 only creates the index if it does not exist yet
+        index_blob.upload_from_string(index.dumps(), content_type='application/json', if_generation_match=generation)
+        return len(index)
+
+    def run_pipeline(self, tasks: Iterable[pipeline.ImageTask], brokers: List[Broker],
+                     config: Optional[pipeline.PipelineConfig] = None, manifest: Optional[Manifest] = None,
+                     journal: Optional[FailureJournal] = None,
+                     on_uploaded: Optional[Callable[[pipeline.ImageTask, str], None]] = None) -> int:
+        """
+        Download, process and upload the images of `tasks` for every broker, see `Pipeline` and `AsyncPipeline`.
 
-        for index, img in enumerate(watermark_imgs):
-            index = index + 1
-            path = f'{blob_name}{index:02}.jpg'
-            self._upload_img(path, img)
+        Args:
+            tasks (Iterable[ImageTask]): The images to process.
+            brokers (List[Broker]): The brokers whose images are processed.
+            config (PipelineConfig, optional): The configuration of the pipeline.
+            manifest (Manifest, optional): The manifest used to skip the images already processed.
+            journal (FailureJournal, optional): The journal where the images that could not be processed are recorded.
+            on_uploaded (Callable[[ImageTask, str], None], optional): Called with each task and its public url once uploaded.
+        Returns:
+            int: The number of images uploaded.
+        """
+        if config is not None and config.io_engine == pipeline.PipelineConfig.IO_ASYNC:
+            return async_pipeline.AsyncPipeline(self.img_mng, self, brokers, config, on_uploaded, manifest, journal).run(tasks)
 
-        return re.sub(r'fotos\/.*', '', blob_name)
+        return pipeline.Pipeline(self.img_mng, self, brokers, config, on_uploaded, manifest, journal).run(tasks)
 
-    def upload_all_imgs(self, publics_urls_data: Dict[str, List[str]], broker_name: str, max_workers: int = 5) -> None:
+    def upload_all_imgs(self, publics_urls_data: Union[Dict[str, List], Iterable[Tuple[str, List]]], broker_name: str, max_workers: int = 5,
+                        config: Optional[pipeline.PipelineConfig] = None, manifest: Optional[Manifest] = None) -> None:
         """
         Upload all images obtained from `publics_urls_data` to the bucket `self.upload_bucket` for the
         broker `broker_name`. This task is done concurrently.
 
         Args:
-            publics_urls_data (Dict[str, List[str]]): A dictionary with the public urls of the blobs.
+            publics_urls_data (Union[Dict[str, List], Iterable[Tuple[str, List]]]): A dictionary with the public urls (or `SourceImage`) of the blobs,
+                or an iterable of (folder, images) so the folders are processed while they are being listed.
+            broker_name (str): The name of the broker.
+            max_workers (int, optional): The number of threads used if `config` is not given.
+            config (PipelineConfig, optional): The configuration of the pipeline.
+            manifest (Manifest, optional): The manifest used to skip the images already processed.
         Returns:
             None
         """
+        if isinstance(publics_urls_data, dict):
+            publics_urls_data = publics_urls_data.items()
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-            futures = []
-            for blob_name, public_imgs_url in publics_urls_data.items():
-                blob_name = f'{broker_name}/{blob_name}'
-                futures.append(executor.submit(
-                    self._background_imgs_process, blob_name, public_imgs_url))
-
-            for future in concurrent.futures.as_completed(futures):
-                folder = future.result()
-                print(f'---- Images uploaded to folder: {folder}')
+        groups = ((key, inventory.as_source_images(imgs))
+                  for key, imgs in publics_urls_data)
+        self.run_pipeline(pipeline.photo_tasks(groups), [Broker(broker_name, self.img_mng)],
+                          config or pipeline.PipelineConfig(threads=max_workers), manifest)
 
-    def upload_blueprints_imgs(self, publics_urls: List[str], broker_name: str, path: str) -> None:
+    def upload_all_blueprints_imgs(self, public_blueprint_urls: Union[Dict[str, List], Iterable[Tuple[str, List]]], broker_name: str, max_workers: int = 5,
+                                   config: Optional[pipeline.PipelineConfig] = None, manifest: Optional[Manifest] = None) -> None:
         """
-        Upload all blueprint images obtained from `publics_urls` to the bucket `self.upload_bucket` for the
+        Upload all blueprint images obtained from `public_blueprint_urls` to the bucket `self.upload_bucket` for the
         broker `broker_name`. This task is done concurrently.
 
         Args:
-            publics_urls (List[str]): A list with the public urls of the blobs.
+            public_blueprint_urls (Union[Dict[str, List], Iterable[Tuple[str, List]]]): A dictionary where the key is the path to folder planos
+                and the value is a list of public urls (or `SourceImage`).
             broker_name (str): The name of the broker.
-            path (str): The path where the blueprint images will be uploaded.
+            max_workers (int, optional): The number of threads used if `config` is not given.
+            config (PipelineConfig, optional): The configuration of the pipeline.
+            manifest (Manifest, optional): The manifest used to skip the images already processed.
         Returns:
             None
         """
-        watermark_imgs = self.img_mng.download_images(publics_urls)
-
-        for img_url, img in zip(publics_urls, watermark_imgs):
-            filepath = f"{broker_name}/{path}/{tools.get_file_name_from_url(img_url)}"
-            self._upload_img(filepath, img)
-
-    def upload_all_blueprints_imgs(self, public_blueprint_urls: Dict[str, List[str]], broker_name: str) -> None:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-            futures = []
-            for path, publics_urls in public_blueprint_urls.items():
-                futures.append(executor.submit(
-                    self.upload_blueprints_imgs, publics_urls, broker_name, path))
+        if isinstance(public_blueprint_urls, dict):
+            public_blueprint_urls = public_blueprint_urls.items()
 
-            for future in concurrent.futures.as_completed(futures):
-                future.result()
-                print(
-                    f"---- Blueprint images uploaded to folder: {broker_name}/{path}")
+        groups = ((path, inventory.as_source_images(imgs))
+                  for path, imgs in public_blueprint_urls)
+        self.run_pipeline(pipeline.blueprint_tasks(groups), [Broker(broker_name, self.img_mng)],
+                          config or pipeline.PipelineConfig(threads=max_workers), manifest)
 
 
 if __name__ == "__main__":
@@ -225,7 +464,7 @@ if __name__ == "__main__":
         if path_to_blueprint not in paths:
             paths[path_to_blueprint] = []
 
-        public_url = f"https://firebasestorage.googleapis.com/v0/b/" +\
+        public_url = "https://firebasestorage.googleapis.com/v0/b/" +\
             f"{fb_mng.download_bucket.name}/o/{urllib.parse.quote(blob.name, safe='')}?alt=media"
 
         paths[path_to_blueprint].append(public_url)
@@ -1,8 +1,19 @@
+import os
+import time
 import requests
 
-from typing import List
+from PIL import Image
+from typing import List, Optional, Tuple
 from . import tools, DEFAULT_IMAGE_CONTENT
 from . import log_manager
+from .watermark_engine import WatermarkEngine
+from .cache import ProcessedImageCache
+from .rate_control import ServiceControl
+from . import metrics
+from .metrics import METRICS
+from .journal import note_error
+from .buffers import read_response
+from .encoding import PROFILE_LEGACY, PROFILES, Derivative, EncodingProfile
 
 
 class ImageManager:
@@ -10,67 +21,208 @@ class ImageManager:
     An image manager to download image(s) and apply watermarks if its neccesary.
 
     Attributes:
-        WATERMARK_RESOURCE_ENDPOINT (str): The endpoint for the watermark resource.
+        WATERMARK_RESOURCE_ENDPOINT (str): The endpoint for the watermark resource, it can be replaced with the
+            environment variable `WATERMARK_RESOURCE_ENDPOINT`, ex: to use a local stand-in of the service.
+        WATERMARK_HEADERS (Dict[str, str]): The headers of the requests to the watermark service.
         TIMEOUT (int): The timeout for the requests.
+        ENGINES (List[str]): The available engines to apply the watermark.
     Args:
         timeout (int, optional): The timeout for waiting in the responses for the watermark service.
         n_tries (int, optional): The number of tries to request the resource from the watermark service if an error ocurres.
         logger (Logger, optional): The logger to save log errors while downloading images.
         watermark_url (str, optional): The url of the watermark image.
+        engine (str, optional): The engine used to apply the watermark, `local` composites the watermark in-process
+            and `remote` uses the watermark service.
+        pool_size (int, optional): The number of keep-alive connections per host shared by all the threads, typically the number of threads.
+        connect_timeout (float, optional): The timeout for establishing a connection, defaults to `timeout`.
+        session (requests.Session, optional): A session to share with other image managers, ex: one per broker.
+        cache (ProcessedImageCache, optional): The cache of processed images, consulted before downloading and processing an image.
+        service_control (ServiceControl, optional): The rate control of the watermark service, shared by the image managers
+            using it. By default a new one is created, limited to `pool_size` requests in flight.
+        encoding (EncodingProfile, optional): How the processed images are decoded and encoded, defaults to the `legacy` profile.
+        derivatives (List[Derivative], optional): The smaller versions generated for the processed photos.
+        watermark_endpoint (str, optional): The endpoint of the watermark service, defaults to `WATERMARK_RESOURCE_ENDPOINT`.
     """
 
     WATERMARK_RESOURCE_ENDPOINT = 'https://quickchart.io/watermark'
+    WATERMARK_HEADERS = {"Content-Type": "application/json", "User-Agent": "insomnia/9.3.3"}
     TIMEOUT = 10
     N_TRIES = 1
+    ENGINE_LOCAL = 'local'
+    ENGINE_REMOTE = 'remote'
+    ENGINES = [ENGINE_LOCAL, ENGINE_REMOTE]
 
-    def __init__(self, timeout: int = TIMEOUT, n_tries: int = N_TRIES, log_mng: log_manager.LogManager = None, watermark_url: str = None) -> None:
+    def __init__(self, timeout: int = TIMEOUT, n_tries: int = N_TRIES, log_mng: log_manager.LogManager = None, watermark_url: str = None,
+                 engine: str = ENGINE_REMOTE, pool_size: int = 10, connect_timeout: Optional[float] = None,
+                 session: Optional[requests.Session] = None, cache: Optional[ProcessedImageCache] = None,
+                 service_control: Optional[ServiceControl] = None, encoding: Optional[EncodingProfile] = None,
+                 derivatives: Optional[List[Derivative]] = None, watermark_endpoint: Optional[str] = None) -> None:
         self.TIMEOUT = timeout
         self.N_TRIES = n_tries
         self.log_mng = log_mng
         self.watermark_url = watermark_url
+        self.WATERMARK_RESOURCE_ENDPOINT = watermark_endpoint or os.environ.get('WATERMARK_RESOURCE_ENDPOINT') or\
+            self.WATERMARK_RESOURCE_ENDPOINT
+        self.engine = engine
+        self.watermark_engine = None
+        self.cache = cache
+        self.encoding = encoding or PROFILES[PROFILE_LEGACY]
+        # From the largest to the smallest, so each derivative is resized from the previous one
+        self.derivatives = sorted(derivatives or [], key=lambda derivative: derivative.max_size, reverse=True)
+        # (connect, read) timeouts for the requests
+        self.timeouts = (connect_timeout or timeout, timeout)
+        # The session is shared by all the threads, reusing the connections to the storage and the watermark service
+        self.session = session or tools.mount_pool(requests.Session(), pool_size)
+        self.service_control = service_control or ServiceControl(pool_size)
+
+        if watermark_url and engine == self.ENGINE_LOCAL:
+            # Same settings as the payload sent to the watermark service
+            self.watermark_engine = WatermarkEngine(watermark_url, opacity=1.0, mark_ratio=1.0, position='bottomMiddle',
+                                                    timeout=self.timeouts, session=self.session)
+
+    @property
+    def remote(self) -> bool:
+        """
+        If the watermark is applied by the watermark service.
+        """
+        return bool(self.watermark_url) and not self.watermark_engine
+
+    @property
+    def variant(self) -> str:
+        """
+        The identity of the processing applied to the images, so the images processed with a different watermark
+        are not considered the same.
+        """
+        if not self.watermark_url:
+            return ''
+
+        variant = f'{self.engine}|{self.watermark_url}'
+        # The images processed before the encoding profiles keep their variant
+        if self.encoding.name != PROFILE_LEGACY:
+            variant += f'|{self.encoding.key}'
+        if self.derivatives:
+            variant += '|' + ','.join(derivative.key for derivative in self.derivatives)
+
+        return variant
+
+    @property
+    def content_type(self) -> str:
+        """
+        The content type of the images returned by `download_image`.
+        """
+        return self.encoding.content_type if self.watermark_url else 'image/jpeg'
+
+    def output_path(self, path: str) -> str:
+        """
+        Get the path where a processed image is uploaded, with the extension of the encoding if the image is processed.
+
+        Args:
+            path (str): The path of the image.
+        Returns:
+            str: The path of the processed image.
+        """
+        return self.encoding.rename(path) if self.watermark_url else path
+
+    def _cache_key(self, source_id: str, derivative: Optional[Derivative] = None) -> str:
+        """
+        Get the key of the processed image in the cache, from the identity of the source image, the watermark
+        and the compression applied to it.
+
+        Args:
+            source_id (str): The identity of the source image, ex: its md5 hash.
+            derivative (Derivative, optional): The derivative of the processed image.
+        Returns:
+            str: The key of the image in the cache.
+        """
+        digest = self.watermark_engine.digest if self.watermark_engine else ''
+        parts = [source_id, self.variant, digest or '', self.encoding.key]
+        if derivative:
+            parts.append(derivative.key)
+
+        return self.cache.key(*parts)
+
+    def get_cached(self, source_id: Optional[str], derivative: Optional[Derivative] = None) -> Optional[bytes]:
+        """
+        Get the processed image from the cache. Only the images with a watermark are cached.
+
+        Args:
+            source_id (str, optional): The identity of the source image, ex: its md5 hash.
+            derivative (Derivative, optional): The derivative of the processed image to get.
+        Returns:
+            Optional[bytes]: The processed image content, None if it's not in the cache.
+        """
+        if self.cache is None or not source_id or not self.watermark_url:
+            return None
+
+        return self.cache.get(self._cache_key(source_id, derivative))
+
+    def set_cached(self, source_id: Optional[str], img: bytes, derivative: Optional[Derivative] = None) -> None:
+        """
+        Save the processed image in the cache. The default image is never cached.
+
+        Args:
+            source_id (str, optional): The identity of the source image, ex: its md5 hash.
+            img (bytes): The processed image content.
+            derivative (Derivative, optional): The derivative of the processed image to save.
+        Returns:
+            None
+        """
+        if self.cache is None or not source_id or not self.watermark_url or img is DEFAULT_IMAGE_CONTENT:
+            return
+
+        self.cache.put(self._cache_key(source_id, derivative), img)
 
     def _download_image(self, img_url: str) -> bytes:
         """
-        Downloads an image from a public url.
+        Downloads an image from a public url, spooling it if it's large, see `buffers.read_response`.
 
         Args:
             img_url (str): The public url of the image.
         Returns:
             bytes: The image content.
         """
+        start = time.perf_counter()
         try:
-            r = requests.get(img_url, timeout=self.TIMEOUT)
+            r = self.session.get(img_url, timeout=self.timeouts, stream=True)
 
             if r.status_code == 200:
-                return r.content
+                img = read_response(r)
+                METRICS.record(metrics.DOWNLOAD, time.perf_counter() - start, bytes_in=len(img))
+                return img
 
+            # The body of the error is read so the connection goes back to the pool
+            r.content
+            METRICS.record(metrics.DOWNLOAD, time.perf_counter() - start, error=True)
+
+            note_error(f'HTTP {r.status_code}', r.reason)
             msg = f'Error downloading the image. Status code: {r.status_code}. \
                 URL: {img_url}'
-            if self.log_mng:
-                self.log_mng.log(msg)
-            print(msg)
+            self._log_error(msg)
             return DEFAULT_IMAGE_CONTENT
         except Exception as e:
+            METRICS.record(metrics.DOWNLOAD, time.perf_counter() - start, error=True)
+            note_error(type(e).__name__, str(e))
             msg = f'{e}. Could not download the image. URL: {img_url}'
-            print(msg)
-            if self.log_mng:
-                self.log_mng.log(msg)
+            self._log_error(msg)
             return DEFAULT_IMAGE_CONTENT
 
-    def _apply_watermark(self, img_url: str, trying: bool = False) -> bytes:
+    def _log_error(self, msg: str) -> None:
+        if self.log_mng:
+            self.log_mng.log(msg)
+        else:
+            print(msg)
+
+    def watermark_payload(self, img_url: str) -> dict:
         """
-        Downloads an image from a public url applying the watermark `self.watermark_url` to it. The resource from where the watermark is applied is Watermark.io.
-        It returns a compressed image on success because the watermark service returns an image with a size increased.
+        Get the request to the watermark service that applies `self.watermark_url` to an image.
 
         Args:
             img_url (str): The public url of the image.
-            trying (bool, optional): If it's trying to apply the watermark again. Defaults to False.
         Returns:
-            bytes: The image content with the watermark
+            dict: The JSON payload of the request.
         """
-
         # Preconfigured watermark settings
-        payload = {
+        return {
             "mainImageUrl": img_url,
             "markImageUrl": self.watermark_url,
             "opacity": 1.0,
@@ -80,52 +232,215 @@ class ImageManager:
             "positionY": 0.0
         }
 
-        try:
-            r = requests.post(self.WATERMARK_RESOURCE_ENDPOINT, json=payload,
-                              timeout=self.TIMEOUT, headers={"Content-Type": "application/json", "User-Agent": "insomnia/9.3.3"})
+    def _apply_watermark(self, img_url: str) -> bytes:
+        """
+        Downloads an image from a public url applying the watermark `self.watermark_url` to it. The resource from where the watermark is applied is Watermark.io.
+        The watermark service returns an image with a size increased, so it must be compressed with `process`.
+        The 429, 5xx and timeouts are retried up to `self.N_TRIES` times, see `self.service_control`.
+
+        Args:
+            img_url (str): The public url of the image.
+        Returns:
+            bytes: The image content with the watermark
+        """
+        payload = self.watermark_payload(img_url)
+        control = self.service_control
 
-            if r.status_code != 200:
-                if not trying:
-                    for i in range(self.N_TRIES):
-                        img = self._apply_watermark(img_url, trying=True)
-                        if img:
-                            # Returns a compressed image
-                            return tools.compress_img(img)
+        for attempt in range(self.N_TRIES + 1):
+            last_attempt = attempt == self.N_TRIES
+            if attempt:
+                METRICS.retry(metrics.WATERMARK)
 
+            if not control.breaker.allow():
+                if last_attempt:
+                    note_error('CircuitOpen', 'The watermark service is unavailable')
+                    self._log_error(f"Error applying watermark to the image, the watermark service is unavailable. URL: {img_url}")
+                    return DEFAULT_IMAGE_CONTENT
+                # Waits for the circuit breaker instead of sending the request
+                time.sleep(max(control.breaker.remaining(), control.delay(attempt)))
+                continue
+
+            control.limiter.acquire()
+            start = time.monotonic()
+            try:
+                r = self.session.post(self.WATERMARK_RESOURCE_ENDPOINT, json=payload, timeout=self.timeouts,
+                                      headers=self.WATERMARK_HEADERS, stream=True)
+                img = read_response(r) if r.status_code == 200 else r.content
+            except Exception as e:
+                latency = time.monotonic() - start
+                METRICS.record(metrics.WATERMARK, latency, error=True)
+                control.limiter.release(latency, isinstance(e, (requests.Timeout, requests.ConnectionError)))
+                control.breaker.record_failure()
+                if last_attempt:
+                    note_error(type(e).__name__, str(e))
+                    self._log_error(f"{e}. Could not apply watermark to the image. URL: {img_url}")
+                    return DEFAULT_IMAGE_CONTENT
+                time.sleep(control.delay(attempt))
+                continue
+
+            overloaded = r.status_code == 429 or r.status_code >= 500
+            latency = time.monotonic() - start
+            control.limiter.release(latency, overloaded)
+            METRICS.record(metrics.WATERMARK, latency, bytes_in=len(img) if r.status_code == 200 else 0,
+                           error=r.status_code != 200)
+
+            if r.status_code == 200:
+                control.breaker.record_success()
+                return img
+
+            if overloaded:
+                control.breaker.record_failure()
+            else:
+                # The service is answering, the request itself is wrong
+                control.breaker.record_success()
+            if not overloaded or last_attempt:
+                note_error(f'HTTP {r.status_code}', r.reason)
                 msg = f"Error applying watermark to the image, reason: {r.reason}. Status code: {r.status_code}. \
                     URL: {img_url}"
-                if self.log_mng:
-                    self.log_mng.log(msg)
-                print(msg)
+                self._log_error(msg)
                 return DEFAULT_IMAGE_CONTENT
 
-            return tools.compress_img(r.content)
+            time.sleep(control.delay(attempt, r.headers.get('Retry-After')))
+
+        return DEFAULT_IMAGE_CONTENT
+
+    def fetch(self, img_url: str) -> bytes:
+        """
+        The network-bound part of downloading an image. If the watermark is applied by the watermark service,
+        it returns the image with the watermark, otherwise it returns the original image.
+
+        Args:
+            img_url (str): The public url of the image.
+        Returns:
+            bytes: The image content, `DEFAULT_IMAGE_CONTENT` if an error occurred.
+        """
+        if self.remote:
+            return self._apply_watermark(img_url)
+
+        return self._download_image(img_url)
+
+    def process(self, img: bytes, img_url: str = '') -> bytes:
+        """
+        The CPU-bound part of downloading an image. If a `self.watermark_url` exists, it returns the compressed image,
+        applying the watermark if the local engine is used. Otherwise it returns the image unchanged.
+
+        Args:
+            img (bytes): The image content returned by `fetch`.
+            img_url (str, optional): The public url of the image, used for logging.
+        Returns:
+            bytes: The processed image content, `DEFAULT_IMAGE_CONTENT` if an error occurred.
+        """
+        if img is DEFAULT_IMAGE_CONTENT or not self.watermark_url:
+            return img
 
+        try:
+            return self.encoding.compress(img, self.watermark_engine)
         except Exception as e:
+            note_error(type(e).__name__, str(e))
             msg = f"{e}. Could not apply watermark to the image. URL: {img_url}"
-            print(msg)
-            if self.log_mng:
-                self.log_mng.log(msg)
+            self._log_error(msg)
+            return DEFAULT_IMAGE_CONTENT
+
+    def process_image(self, image: Image.Image, img_url: str = '', in_place: bool = False) -> bytes:
+        """
+        Process an already decoded image, applying the watermark if the local engine is used, and compressing it.
+        Unless `in_place`, the image is not modified.
+
+        Args:
+            image (Image.Image): The decoded image, as returned by `self.encoding.decode`.
+            img_url (str, optional): The public url of the image, used for logging.
+            in_place (bool, optional): Apply the watermark to the image itself instead of a copy, when no other image
+                manager processes it afterwards.
+        Returns:
+            bytes: The processed image content, `DEFAULT_IMAGE_CONTENT` if an error occurred.
+        """
+        try:
+            if self.watermark_engine:
+                image = self.watermark_engine.apply(image if in_place else image.copy())
+            return self.encoding.encode(image)
+        except Exception as e:
+            note_error(type(e).__name__, str(e))
+            msg = f"{e}. Could not apply watermark to the image. URL: {img_url}"
+            self._log_error(msg)
             return DEFAULT_IMAGE_CONTENT
 
-    def download_image(self, img_url: str) -> bytes:
+    def process_image_derivatives(self, image: Image.Image, img_url: str = '',
+                                  in_place: bool = False) -> Tuple[bytes, List[Tuple[Derivative, bytes]]]:
+        """
+        Process an already decoded image like `process_image`, and generate `self.derivatives` from it. The watermark
+        is applied only once, and each derivative is resized from the previous one.
+
+        Args:
+            image (Image.Image): The decoded image, as returned by `self.encoding.decode`.
+            img_url (str, optional): The public url of the image, used for logging.
+            in_place (bool, optional): Apply the watermark to the image itself instead of a copy, as in `process_image`.
+        Returns:
+            Tuple[bytes, List[Tuple[Derivative, bytes]]]: The processed image content and the content of each derivative,
+                `DEFAULT_IMAGE_CONTENT` without derivatives if an error occurred.
+        """
+        try:
+            if self.watermark_engine:
+                image = self.watermark_engine.apply(image if in_place else image.copy())
+            img = self.encoding.encode(image)
+
+            derivatives = []
+            for derivative in self.derivatives:
+                image = derivative.resize(image)
+                derivatives.append((derivative, self.encoding.encode(image)))
+        except Exception as e:
+            note_error(type(e).__name__, str(e))
+            msg = f"{e}. Could not apply watermark to the image. URL: {img_url}"
+            self._log_error(msg)
+            return DEFAULT_IMAGE_CONTENT, []
+
+        return img, derivatives
+
+    def process_derivatives(self, img: bytes, img_url: str = '') -> Tuple[bytes, List[Tuple[Derivative, bytes]]]:
+        """
+        Process an image like `process`, and generate `self.derivatives` from it.
+
+        Args:
+            img (bytes): The image content returned by `fetch`.
+            img_url (str, optional): The public url of the image, used for logging.
+        Returns:
+            Tuple[bytes, List[Tuple[Derivative, bytes]]]: The processed image content and the content of each derivative,
+                `DEFAULT_IMAGE_CONTENT` without derivatives if an error occurred.
+        """
+        if img is DEFAULT_IMAGE_CONTENT or not self.watermark_url:
+            return img, []
+
+        try:
+            image = self.encoding.decode(img)
+        except Exception as e:
+            note_error(type(e).__name__, str(e))
+            msg = f"{e}. Could not apply watermark to the image. URL: {img_url}"
+            self._log_error(msg)
+            return DEFAULT_IMAGE_CONTENT, []
+
+        return self.process_image_derivatives(image, img_url, in_place=True)
+
+    def download_image(self, img_url: str, source_id: Optional[str] = None) -> bytes:
         """
         Download the image, returning the bytes of these. If a `self.watermark_url` exists, then it applies to the image.
+        If the processed image is in `self.cache`, it's returned without downloading or processing it.
 
         Args:
             img_url (str): The public url of the image.
+            source_id (str, optional): The identity of the source image, ex: its md5 hash. Required to use the cache.
         Returns:
             Optional[bytes]: The image content.
         """
+        img = self.get_cached(source_id)
+        if img is not None:
+            return img
 
         try:
-            if self.watermark_url:
-                img = self._apply_watermark(img_url)
-            else:
-                img = self._download_image(img_url)
+            img = self.process(self.fetch(img_url), img_url)
         except Exception as e:
-            print(f'Unexpected error downloading the image. {e}')
+            self._log_error(f'Unexpected error downloading the image. {e}')
+            img = DEFAULT_IMAGE_CONTENT
 
+        self.set_cached(source_id, img)
         return img
 
     def download_images(self, img_urls: List[str]) -> List[bytes]:
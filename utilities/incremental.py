@@ -0,0 +1,131 @@
+import os
+import tempfile
+from typing import Dict, List, Optional
+
+from . import metrics
+from .brokers import Broker
+from .firebase_manager import FirebaseUploaderManager
+from .inventory import classify
+from .journal import FailureJournal, read_failures
+from .manifest import Manifest
+from .pipeline import ImageTask, PipelineConfig, inventory_tasks, unit_key
+
+# The stages whose failures can succeed if the event is delivered again, ex: a timeout of the watermark service
+RETRYABLE_STAGES = (metrics.DOWNLOAD, metrics.WATERMARK, metrics.UPLOAD, metrics.COPY)
+
+
+def is_retryable(failure: Dict) -> bool:
+    """
+    Check if a failure of the journal can succeed if the image is processed again, that is a failure of the requests
+    of `RETRYABLE_STAGES` other than a 4xx (except 408 and 429).
+
+    Args:
+        failure (Dict): The failure, as read from the journal.
+    Returns:
+        bool: If the failure is retryable.
+    """
+    error = failure.get('error') or ''
+    if failure.get('stage') not in RETRYABLE_STAGES:
+        return False
+
+    return not error.startswith('HTTP 4') or error in ('HTTP 408', 'HTTP 429')
+
+
+class IncrementalOnboarding:
+    """
+    Onboard the images of the download bucket one by one as they are created or updated. The group of the changed
+    image is listed again, since a new photo can rename the photos after it, and only the images whose uploaded
+    metadata differs are processed.
+
+    Args:
+        fb_mng (FirebaseUploaderManager): The manager of the buckets, reused by every image.
+        brokers (List[Broker]): The brokers whose images are onboarded, with their watermarks already loaded.
+        config (PipelineConfig, optional): The configuration of the pipeline used for each image.
+    """
+
+    def __init__(self, fb_mng: FirebaseUploaderManager, brokers: List[Broker], config: Optional[PipelineConfig] = None) -> None:
+        self.fb_mng = fb_mng
+        self.brokers = brokers
+        self.config = config or PipelineConfig(threads=2, schedule=PipelineConfig.SCHEDULE_LISTING,
+                                               process_mode=PipelineConfig.PROCESS_THREADS)
+
+    def is_output(self, name: str) -> bool:
+        """
+        Check if a blob is an image uploaded for a broker, when the images are uploaded to the download bucket,
+        so they do not trigger their own processing.
+
+        Args:
+            name (str): The name of the blob.
+        Returns:
+            bool: If the blob is in the folder of a broker.
+        """
+        return self.fb_mng.upload_bucket.name == self.fb_mng.download_bucket.name and \
+            any(name.startswith(f'{broker.name}/') for broker in self.brokers)
+
+    def tasks(self, name: str) -> List[ImageTask]:
+        """
+        Get the tasks of the groups of an image, listing only the folder of the image.
+
+        Args:
+            name (str): The name of the blob of the image.
+        Returns:
+            List[ImageTask]: The tasks of every image of its groups, empty if it's not a photo or a blueprint.
+        """
+        groups = set(classify(name))
+        if not groups:
+            return []
+
+        folder = name[:name.rfind('/') + 1]
+        return list(inventory_tasks(group for group in self.fb_mng.iter_inventory([folder])
+                                    if (group[0], group[1]) in groups))
+
+    def onboard(self, name: str) -> int:
+        """
+        Process and upload an image for every broker, along with the images of its group whose name changed.
+
+        Args:
+            name (str): The name of the blob of the image in the download bucket.
+        Returns:
+            int: The number of images uploaded.
+        Raises:
+            RuntimeError: If an image failed with a retryable error, so the event is delivered again. The other
+                failures are logged, since they would fail again.
+        """
+        if self.is_output(name):
+            return 0
+
+        tasks = self.tasks(name)
+        if not tasks:
+            print(f'-- Not a photo or a blueprint, skipped: {name}')
+            return 0
+
+        # The images already uploaded from the same source are skipped, as in a repeated onboarding
+        folder = name[:name.rfind('/') + 1]
+        manifest = Manifest(':memory:')
+        for broker in self.brokers:
+            self.fb_mng.rebuild_manifest(manifest, broker.name, folder, strict=True)
+
+        with tempfile.TemporaryDirectory() as journal_dir:
+            journal = FailureJournal(os.path.join(journal_dir, 'failures.jsonl'))
+            try:
+                n_uploaded = self.fb_mng.run_pipeline(tasks, self.brokers, config=self.config, manifest=manifest,
+                                                      journal=journal)
+            finally:
+                journal.close()
+                manifest.close()
+            failures = list(read_failures(journal.path)) if journal.n_failures else []
+
+        n_retryable = sum(map(is_retryable, failures))
+        if n_retryable:
+            raise RuntimeError(f'{n_retryable} images of the group of {name} could not be processed')
+        for failure in failures:
+            print(f"-- Could not process {failure['path']} for {failure['broker']}, not retried: "
+                  f"{failure['stage']}, {failure['error']}")
+
+        if n_uploaded:
+            # Only the unit of the image is listed again for the index of each broker
+            units = {unit_key(task.path) for task in tasks}
+            for broker in self.brokers:
+                self.fb_mng.update_broker_index(broker.name, units)
+
+        return n_uploaded
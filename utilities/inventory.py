@@ -0,0 +1,236 @@
+import re
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+PHOTOS = 'fotos'
+BLUEPRINTS = 'planos'
+
+# Only the fields used to build the inventory are requested to the listing
+LIST_FIELDS = 'items(name,size,md5Hash,crc32c,generation),nextPageToken'
+
+
+class SourceImage:
+    """
+    An image listed from the download bucket.
+
+    Args:
+        name (str): The name of the blob.
+        url (str): The public url of the blob.
+        size (int, optional): The size of the blob in bytes.
+        md5_hash (str, optional): The base64 md5 hash of the blob content.
+        crc32c (str, optional): The base64 crc32c checksum of the blob content.
+        generation (int, optional): The generation of the blob.
+    """
+
+    __slots__ = ('name', 'url', 'size', 'md5_hash', 'crc32c', 'generation')
+
+    def __init__(self, name: str, url: str, size: int = 0, md5_hash: Optional[str] = None, crc32c: Optional[str] = None,
+                 generation: Optional[int] = None) -> None:
+        self.name = name
+        self.url = url
+        self.size = size or 0
+        self.md5_hash = md5_hash
+        self.crc32c = crc32c
+        self.generation = generation
+
+    def __repr__(self) -> str:
+        return f'SourceImage({self.name!r}, size={self.size})'
+
+
+def photo_group_key(blob_name: str) -> str:
+    """
+    Get the key of the photos group of a blob, removing the indexing of the name.
+    Ex: 'edificio-parque-andino/local-3/fotos/parque-andino-local-3-01.jpg' returns
+    'edificio-parque-andino/local-3/fotos/parque-andino-local-3-'
+
+    Args:
+        blob_name (str): The name of the blob.
+    Returns:
+        str: The key of the group.
+    """
+    return re.sub(r'\d{2}\.jpg$', '', blob_name)
+
+
+def blueprint_group_key(blob_name: str) -> str:
+    """
+    Get the key of the blueprints group of a blob, that is the path to the folder `planos`.
+    Ex: 'edificio-parque-andino/local-3/planos/plano.jpg' returns 'edificio-parque-andino/local-3/planos'
+
+    Args:
+        blob_name (str): The name of the blob.
+    Returns:
+        str: The key of the group.
+    """
+    return "/".join(blob_name.split('/')[:-1])
+
+
+def classify(blob_name: str) -> List[Tuple[str, str]]:
+    """
+    Get the groups where a blob belongs, as a list of (kind, key). A blob that is not an image
+    of the folders `fotos` or `planos` does not belong to any group.
+
+    Args:
+        blob_name (str): The name of the blob.
+    Returns:
+        List[Tuple[str, str]]: The groups of the blob.
+    """
+    if '.DS_Store' in blob_name:
+        return []
+
+    groups = []
+    if 'fotos/' in blob_name:
+        groups.append((PHOTOS, photo_group_key(blob_name)))
+    if 'planos/' in blob_name:
+        groups.append((BLUEPRINTS, blueprint_group_key(blob_name)))
+
+    return groups
+
+
+def unit_prefix(name: str) -> Optional[str]:
+    """
+    Get the prefix of the unit of a blob or folder, the folder holding the first `fotos/` or `planos/` of its name.
+    Ex: 'edificio-parque-andino/local-3/fotos/parque-andino-local-3-01.jpg' returns 'edificio-parque-andino/local-3/'
+
+    Args:
+        name (str): The name of the blob or folder.
+    Returns:
+        Optional[str]: The prefix of the unit, None if the name does not belong to any group.
+    """
+    matches = [index for index in (name.find('fotos/'), name.find('planos/')) if index >= 0]
+    if not matches:
+        return None
+
+    return name[:name.rfind('/', 0, min(matches)) + 1]
+
+
+def check_prefixes(prefixes: Iterable[str]) -> List[str]:
+    """
+    Check that the prefixes of a listing select whole groups, each one only once, so the photos of a group are
+    numbered together.
+
+    Args:
+        prefixes (Iterable[str]): The prefixes, ex: ['edificio-'].
+    Returns:
+        List[str]: The prefixes.
+    Raises:
+        ValueError: If a prefix ends inside a folder `fotos`, or overlaps another prefix.
+    """
+    prefixes = list(prefixes)
+    for prefix in prefixes:
+        if f'{PHOTOS}/' in prefix and not prefix.endswith('/'):
+            raise ValueError(f"The prefix '{prefix}' ends inside a folder '{PHOTOS}', it must end with '/'")
+    for i, prefix in enumerate(prefixes):
+        for other in prefixes[i + 1:]:
+            if prefix.startswith(other) or other.startswith(prefix):
+                raise ValueError(f"The prefixes '{prefix}' and '{other}' overlap")
+
+    return prefixes
+
+
+def iter_groups(blobs: Iterable, public_url: Callable[[str], str], skipped: Optional[List[str]] = None) -> Iterator[Tuple[str, str, List[SourceImage]]]:
+    """
+    Group the listed blobs in photos and blueprints groups, yielding each group once the listing, in lexicographic
+    order, leaves its folder.
+
+    Args:
+        blobs (Iterable): The listed blobs, in lexicographic order.
+        public_url (Callable[[str], str]): A function that returns the public url of a blob name.
+        skipped (List[str], optional): A list where the names of the blobs not grouped are appended.
+    Yields:
+        Tuple[str, str, List[SourceImage]]: The kind of the group (`PHOTOS` or `BLUEPRINTS`), its key and its images.
+    """
+    # (kind, key) -> (folder prefix, images)
+    open_groups: Dict[Tuple[str, str], Tuple[str, List[SourceImage]]] = {}
+
+    for blob in blobs:
+        name: str = blob.name
+
+        for group, (folder, images) in list(open_groups.items()):
+            if not name.startswith(folder):
+                del open_groups[group]
+                yield group[0], group[1], images
+
+        groups = classify(name)
+        if not groups:
+            if skipped is not None:
+                skipped.append(name)
+            continue
+
+        img = SourceImage(name, public_url(name), size=blob.size, md5_hash=blob.md5_hash,
+                          crc32c=blob.crc32c, generation=blob.generation)
+        folder = name[:name.rfind('/') + 1]
+        for group in groups:
+            if group not in open_groups:
+                open_groups[group] = (folder, [])
+            open_groups[group][1].append(img)
+
+    for group, (_, images) in open_groups.items():
+        yield group[0], group[1], images
+
+
+def as_source_images(imgs: List[Union[str, SourceImage]]) -> List[SourceImage]:
+    """
+    Get the images of a group as `SourceImage`, for the groups that only have their public urls.
+
+    Args:
+        imgs (List[Union[str, SourceImage]]): The public urls or the images of the group.
+    Returns:
+        List[SourceImage]: The images of the group.
+    """
+    return [img if isinstance(img, SourceImage) else SourceImage(None, img) for img in imgs]
+
+
+class Inventory:
+    """
+    The images of the download bucket grouped by folder, for photos and blueprints.
+
+    Attributes:
+        photos (Dict[str, List[SourceImage]]): The photos grouped by name without the indexing.
+        blueprints (Dict[str, List[SourceImage]]): The blueprints grouped by the path to the folder `planos`.
+        skipped (List[str]): The names of the blobs that are not photos nor blueprints.
+    """
+
+    def __init__(self) -> None:
+        self.photos: Dict[str, List[SourceImage]] = {}
+        self.blueprints: Dict[str, List[SourceImage]] = {}
+        self.skipped: List[str] = []
+
+    def add(self, kind: str, key: str, images: List[SourceImage]) -> None:
+        """
+        Add a group of images to the inventory.
+
+        Args:
+            kind (str): The kind of the group, `PHOTOS` or `BLUEPRINTS`.
+            key (str): The key of the group.
+            images (List[SourceImage]): The images of the group.
+        Returns:
+            None
+        """
+        groups = self.photos if kind == PHOTOS else self.blueprints
+        groups.setdefault(key, []).extend(images)
+
+    def consume(self, groups: Iterable[Tuple[str, str, List[SourceImage]]], kind: Optional[str] = None) -> Iterator[Tuple[str, str, List[SourceImage]]]:
+        """
+        Add every group to the inventory while passing through the groups of `kind`.
+
+        Args:
+            groups (Iterable[Tuple[str, str, List[SourceImage]]]): The groups, as yielded by `iter_groups`.
+            kind (str, optional): The kind of the groups to pass through. If it's None, every group is passed.
+        Yields:
+            Tuple[str, str, List[SourceImage]]: The kind, the key and the images of the group.
+        """
+        for group_kind, key, images in groups:
+            self.add(group_kind, key, images)
+            if kind is None or group_kind == kind:
+                yield group_kind, key, images
+
+    @staticmethod
+    def urls(groups: Dict[str, List[SourceImage]]) -> Dict[str, List[str]]:
+        """
+        Get the public urls of the groups.
+
+        Args:
+            groups (Dict[str, List[SourceImage]]): The groups of images.
+        Returns:
+            Dict[str, List[str]]: A dictionary with the public urls of the groups.
+        """
+        return {key: [img.url for img in images] for key, images in groups.items()}
@@ -0,0 +1,154 @@
+import json
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# The error of the last failed operation of each thread, noted by the managers when an operation fails
+_last_error = threading.local()
+
+
+def note_error(error: str, message: str) -> None:
+    """
+    Note the error of an operation that failed in the current thread, so it can be recorded in the journal
+    by whoever handles the failure.
+
+    Args:
+        error (str): The class of the error, ex: `Timeout` or `HTTP 503`.
+        message (str): The message of the error.
+    Returns:
+        None
+    """
+    _last_error.value = (error, message)
+
+
+def take_error() -> Tuple[str, str]:
+    """
+    Get and clear the error of the last failed operation of the current thread.
+
+    Returns:
+        Tuple[str, str]: The class and the message of the error, `Unknown` if no error was noted.
+    """
+    error = getattr(_last_error, 'value', None) or ('Unknown', '')
+    _last_error.value = None
+    return error
+
+
+class FailureJournal:
+    """
+    A journal of the images that failed, written as JSON lines with the source blob, the destination path, the stage
+    that failed, the class of the error and the number of attempts.
+
+    Attributes:
+        n_failures (int): The number of failures recorded.
+    Args:
+        path (str): The path of the journal file.
+        append (bool, optional): Keep the failures of the previous runs, otherwise the journal is started empty.
+    """
+
+    def __init__(self, path: str, append: bool = False) -> None:
+        self.path = path
+        self.n_failures = 0
+        self._file = open(path, 'a' if append else 'w', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def record(self, broker: str, path: str, source: Optional[str], url: str, kind: str, stage: str, error: str, message: str,
+               attempt: int = 1, generation: Optional[int] = None, md5_hash: Optional[str] = None) -> None:
+        """
+        Record a failed image.
+
+        Args:
+            broker (str): The name of the broker.
+            path (str): The destination path of the image, relative to the folder of the broker.
+            source (str, optional): The blob name of the source image.
+            url (str): The public url of the source image.
+            kind (str): The kind of the image, `PHOTOS` or `BLUEPRINTS`.
+            stage (str): The stage that failed, ex: `download` or `upload`.
+            error (str): The class of the error.
+            message (str): The message of the error.
+            attempt (int, optional): The number of times the image was processed.
+            generation (int, optional): The generation of the source image.
+            md5_hash (str, optional): The md5 hash of the source image.
+        Returns:
+            None
+        """
+        entry = {
+            'broker': broker,
+            'path': path,
+            'source': source,
+            'url': url,
+            'kind': kind,
+            'stage': stage,
+            'error': error,
+            'message': message,
+            'attempt': attempt,
+            'generation': generation,
+            'md5_hash': md5_hash,
+            'time': time.time(),
+        }
+        line = json.dumps(entry, ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+            self.n_failures += 1
+
+    def close(self) -> None:
+        """
+        Close the journal file.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._file.close()
+
+
+def read_failures(path: str) -> Iterator[Dict]:
+    """
+    Read the failures of a journal, keeping only the last failure of each image of each broker, so an image that
+    failed several times is retried once.
+
+    Args:
+        path (str): The path of the journal file.
+    Yields:
+        Dict: The last failure of each image, in the order they first failed.
+    """
+    failures: Dict[Tuple[str, str], Dict] = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # A line cut by an interrupted run
+                continue
+
+            key = (entry.get('broker'), entry.get('path'))
+            if key in failures:
+                entry['attempt'] = max(entry.get('attempt', 1), failures[key].get('attempt', 1))
+            failures[key] = entry
+
+    yield from failures.values()
+
+
+def merge_journals(paths: List[str], output: str) -> int:
+    """
+    Merge the journals of the shards of a run in a single journal, that can be retried with `retry_download_imgs.py`.
+
+    Args:
+        paths (List[str]): The paths of the journals.
+        output (str): The path of the merged journal.
+    Returns:
+        int: The number of failures of the merged journal.
+    """
+    n_failures = 0
+    with open(output, 'w', encoding='utf-8') as out:
+        for path in paths:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        out.write(line if line.endswith('\n') else line + '\n')
+                        n_failures += 1
+
+    return n_failures
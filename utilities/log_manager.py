@@ -1,28 +1,206 @@
-import logging
+import atexit
+import json
+import queue
+import threading
+import time
+from datetime import datetime, timezone
 from typing import Optional
 
+# Marks the end of the events in the queue of the writer
+_STOP = object()
+
+
+def format_duration(seconds: float) -> str:
+    """
+    Format a duration for the console, ex: '1h 02m', '3m 05s' or '12s'.
+
+    Args:
+        seconds (float): The duration in seconds.
+    Returns:
+        str: The formatted duration.
+    """
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f'{seconds // 3600}h {seconds % 3600 // 60:02}m'
+    if seconds >= 60:
+        return f'{seconds // 60}m {seconds % 60:02}s'
+
+    return f'{seconds}s'
+
 
 class LogManager:
     """
     A class to handle logging to a file and logging messages.
+    The messages are written to the file as JSON lines by a background thread, and the console shows the progress
+    of the run every `progress_interval` seconds.
 
     Args:
         filename (str): The name of the filename where logs are written.
+        progress_interval (float, optional): The seconds between two progress lines in the console, 0 disables them.
+        max_events (int, optional): The maximum number of messages waiting to be written, the rest are dropped.
     """
 
-    def __init__(self, filename: Optional[str] = 'logs.log') -> None:
+    def __init__(self, filename: Optional[str] = 'logs.log', progress_interval: float = 5.0, max_events: int = 100000) -> None:
         self.filename = filename if filename else 'logs.log'
-        logging.basicConfig(filename=self.filename,
-                            format='%(levelname)s:%(message)s')
-        self.logger = logging.getLogger(__name__)
+        self.progress_interval = progress_interval
+        self.n_dropped = 0
+
+        # The counters of the progress, updated by the workers and read by the writer under `self._lock`
+        self.n_done = 0
+        self.n_errors = 0
+        self.n_total = 0
+        self.n_folders = 0
+        self.listed = False
+
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=max_events)
+        self._started_at: Optional[float] = None
+        self._file = open(self.filename, 'a', encoding='utf-8')
+        self._writer = threading.Thread(target=self._write, daemon=True)
+        self._writer.start()
+        # The messages still in the queue are written if the command ends without closing the log
+        atexit.register(self.close)
 
-    def log(self, message: str) -> None:
+    def _put(self, item) -> None:
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            with self._lock:
+                self.n_dropped += 1
+
+    def log(self, message: str, **fields) -> None:
         """
         Logs a message to the file `self.filename`.
 
         Args:
             message (str): The message to log.
+            **fields: Additional fields of the message, ex: the url of the image.
+        Returns:
+            None
+        """
+        self._put({'level': 'warning', 'event': 'message', 'message': message, **fields})
+
+    def event(self, event: str, **fields) -> None:
+        """
+        Logs an event of the run to the file `self.filename`, ex: a folder completed.
+
+        Args:
+            event (str): The name of the event.
+            **fields: The fields of the event.
         Returns:
             None
         """
-        self.logger.warning(message)
+        self._put({'level': 'info', 'event': event, **fields})
+
+    def progress(self, done: int = 0, errors: int = 0, total: int = 0, folders: int = 0) -> None:
+        """
+        Update the progress shown in the console. The counts are added to the ones of the previous calls.
+
+        Args:
+            done (int, optional): The images processed, successfully or not.
+            errors (int, optional): The images that could not be processed.
+            total (int, optional): The images to process found.
+            folders (int, optional): The folders completed.
+        Returns:
+            None
+        """
+        with self._lock:
+            if self._started_at is None:
+                self._started_at = time.monotonic()
+            self.n_done += done
+            self.n_errors += errors
+            self.n_total += total
+            self.n_folders += folders
+
+    def set_listed(self) -> None:
+        """
+        Mark that every image to process was found, so the ETA of the run can be estimated.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self.listed = True
+
+    def progress_line(self) -> str:
+        """
+        Get the progress of the run, ex: '-- 1520/4000 images (38.2 img/s, ETA 1m 05s), 12 folders, 3 errors'.
+
+        Returns:
+            str: The progress of the run.
+        """
+        with self._lock:
+            started_at, listed, n_dropped = self._started_at, self.listed, self.n_dropped
+            n_done, n_total, n_errors, n_folders = self.n_done, self.n_total, self.n_errors, self.n_folders
+
+        elapsed = time.monotonic() - started_at if started_at is not None else 0.0
+        rate = n_done / elapsed if elapsed > 0 else 0.0
+        if not listed:
+            eta = 'listing'
+        elif rate > 0:
+            eta = f'ETA {format_duration(max(0, n_total - n_done) / rate)}'
+        else:
+            eta = 'ETA -'
+
+        line = f"-- {n_done}/{n_total}{'' if listed else '+'} images ({rate:.1f} img/s, {eta}), " +\
+            f"{n_folders} folders, {n_errors} errors"
+        if n_dropped:
+            line += f', {n_dropped} log messages dropped'
+        return line
+
+    def _state(self) -> Optional[tuple]:
+        # The progress shown in the console, None before the first image
+        with self._lock:
+            if self._started_at is None:
+                return None
+            return self.n_done, self.n_total, self.n_errors
+
+    def _handle(self, item: dict) -> None:
+        line = {'time': datetime.now(timezone.utc).isoformat(timespec='milliseconds'), **item}
+        self._file.write(json.dumps(line, default=str) + '\n')
+
+    def _write(self) -> None:
+        next_progress = time.monotonic() + self.progress_interval
+        shown = None
+        while True:
+            timeout = max(0.0, next_progress - time.monotonic()) if self.progress_interval > 0 else None
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                break
+            if item is not None:
+                self._handle(item)
+                if self._queue.empty():
+                    self._file.flush()
+
+            if self.progress_interval > 0 and time.monotonic() >= next_progress:
+                next_progress = time.monotonic() + self.progress_interval
+                # Only printed while the run is making progress
+                state = self._state()
+                if state is not None and state != shown:
+                    shown = state
+                    print(self.progress_line(), flush=True)
+
+        self._file.flush()
+        state = self._state()
+        if self.progress_interval > 0 and state is not None and state != shown:
+            print(self.progress_line(), flush=True)
+
+    def close(self) -> None:
+        """
+        Write the messages still in the queue and the last progress line, and close the file.
+
+        Returns:
+            None
+        """
+        if self._file.closed:
+            return
+
+        # Waits for the writer, the workers are already done
+        self._queue.put(_STOP)
+        self._writer.join()
+        self._file.close()
+        atexit.unregister(self.close)
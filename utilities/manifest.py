@@ -0,0 +1,178 @@
+import base64
+import hashlib
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+from urllib.request import pathname2url
+
+# Metadata keys saved in the uploaded blobs, so the manifest can be rebuilt from the upload bucket
+META_SOURCE = 'source-name'
+META_GENERATION = 'source-generation'
+META_MD5 = 'source-md5'
+META_VARIANT = 'variant'
+# The name of the derivative of a photo, ex: 'thumb', so the index tells the derivatives from the photos
+META_DERIVATIVE = 'derivative'
+
+
+def md5_base64(data: bytes) -> str:
+    """
+    Get the md5 hash of `data` encoded in base64, the same format used by the storage listing.
+
+    Args:
+        data (bytes): The content to hash.
+    Returns:
+        str: The base64 md5 hash.
+    """
+    return base64.b64encode(hashlib.md5(data).digest()).decode('ascii')
+
+
+class Manifest:
+    """
+    A sqlite record of the images already processed, with the source blob, its generation and md5, the variant of
+    the processing (ex: the watermark) and the md5 of the uploaded image of each destination path.
+
+    Attributes:
+        n_skipped (int): The number of images found already processed.
+    Args:
+        path (str): The path to the database file.
+        commit_every (int, optional): The number of records between two commits.
+        read_only (bool, optional): Open an existing database without modifying it, ex: to plan a run. The records
+            can be checked but not added.
+    """
+
+    def __init__(self, path: str, commit_every: int = 50, read_only: bool = False) -> None:
+        self.path = path
+        self.commit_every = commit_every
+        self.n_skipped = 0
+        self._pending = 0
+        self._lock = threading.Lock()
+
+        if read_only:
+            self._conn = sqlite3.connect(f'file:{pathname2url(path)}?mode=ro', uri=True, check_same_thread=False)
+            return
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS images (
+                path TEXT PRIMARY KEY,
+                source TEXT,
+                generation INTEGER,
+                md5_hash TEXT,
+                variant TEXT,
+                output_md5 TEXT,
+                updated_at REAL
+            )''')
+        self._conn.commit()
+
+    def is_done(self, path: str, source: str, generation: Optional[int], md5_hash: Optional[str], variant: str) -> bool:
+        """
+        Check if the image of `path` was already processed from the same source image and variant. A record
+        without source information is considered done.
+
+        Args:
+            path (str): The destination path of the image.
+            source (str): The blob name of the source image.
+            generation (int, optional): The generation of the source image.
+            md5_hash (str, optional): The md5 hash of the source image.
+            variant (str): The variant of the processing.
+        Returns:
+            bool: If the image was already processed.
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT source, generation, md5_hash, variant FROM images WHERE path = ?',
+                                     (path,)).fetchone()
+        if row is None:
+            return False
+
+        row_source, row_generation, row_md5, row_variant = row
+        if row_source is not None:
+            if row_source != source or row_variant != variant:
+                return False
+            if generation is not None and row_generation is not None and int(row_generation) != int(generation):
+                return False
+            if md5_hash and row_md5 and row_md5 != md5_hash:
+                return False
+
+        with self._lock:
+            self.n_skipped += 1
+        return True
+
+    def record(self, path: str, source: Optional[str], generation: Optional[int], md5_hash: Optional[str], variant: Optional[str],
+               output_md5: Optional[str]) -> None:
+        """
+        Record that the image of `path` was processed.
+
+        Args:
+            path (str): The destination path of the image.
+            source (str, optional): The blob name of the source image.
+            generation (int, optional): The generation of the source image.
+            md5_hash (str, optional): The md5 hash of the source image.
+            variant (str, optional): The variant of the processing.
+            output_md5 (str, optional): The md5 hash of the uploaded image.
+        Returns:
+            None
+        """
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (path, source, generation, md5_hash, variant, output_md5, time.time()))
+            self._pending += 1
+            if self._pending >= self.commit_every:
+                self._conn.commit()
+                self._pending = 0
+
+    def record_blob_metadata(self, path: str, metadata: Optional[Dict[str, str]], output_md5: Optional[str]) -> None:
+        """
+        Record an image from the metadata saved in its uploaded blob. If the blob has no source information, it's recorded
+        as done without it.
+
+        Args:
+            path (str): The name of the uploaded blob.
+            metadata (Dict[str, str], optional): The metadata of the uploaded blob.
+            output_md5 (str, optional): The md5 hash of the uploaded blob.
+        Returns:
+            None
+        """
+        metadata = metadata or {}
+        self.record(path, metadata.get(META_SOURCE), metadata.get(META_GENERATION), metadata.get(META_MD5),
+                    metadata.get(META_VARIANT), output_md5)
+
+    def merge(self, path: str) -> int:
+        """
+        Add the records of another manifest, ex: of a shard of the run, keeping the most recent record of each path.
+
+        Args:
+            path (str): The path to the database file of the other manifest.
+        Returns:
+            int: The number of records added or replaced.
+        """
+        with self._lock:
+            self._conn.commit()
+            self._conn.execute('ATTACH DATABASE ? AS other', (path,))
+            try:
+                cursor = self._conn.execute('''
+                    INSERT OR REPLACE INTO images
+                    SELECT * FROM other.images AS o
+                    WHERE NOT EXISTS (SELECT 1 FROM images AS i WHERE i.path = o.path AND i.updated_at > o.updated_at)''')
+                n_merged = cursor.rowcount
+                self._conn.commit()
+            finally:
+                self._conn.execute('DETACH DATABASE other')
+
+        return n_merged
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM images').fetchone()[0]
+
+    def close(self) -> None:
+        """
+        Commit the pending records and close the database.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
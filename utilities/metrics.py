@@ -0,0 +1,395 @@
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+# The stages of a run
+LIST = 'list'
+DOWNLOAD = 'download'
+WATERMARK = 'watermark_service'
+PROCESS = 'process'
+UPLOAD = 'upload'
+COPY = 'copy'
+DEDUP = 'dedup'
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class LatencyHistogram:
+    """
+    The latencies of a stage, with the quantiles computed from a uniform sample of at most `max_samples` latencies.
+
+    Args:
+        max_samples (int, optional): The maximum number of latencies kept.
+    """
+
+    def __init__(self, max_samples: int = 10000) -> None:
+        self.max_samples = max_samples
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._samples: List[float] = []
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+        if len(self._samples) < self.max_samples:
+            self._samples.append(seconds)
+        else:
+            # Reservoir sampling, every latency has the same probability of being kept
+            index = random.randrange(self.count)
+            if index < self.max_samples:
+                self._samples[index] = seconds
+
+    def quantile(self, q: float) -> float:
+        """
+        Get the latency of the quantile `q`.
+
+        Args:
+            q (float): The quantile (0.0 - 1.0).
+        Returns:
+            float: The latency in seconds, 0 if there are no latencies.
+        """
+        if not self._samples:
+            return 0.0
+
+        samples = sorted(self._samples)
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def summary(self) -> Dict[str, float]:
+        summary = {f'p{round(q * 100)}': self.quantile(q) for q in QUANTILES}
+        summary['mean'] = self.total / self.count if self.count else 0.0
+        summary['max'] = self.max
+        summary['total'] = self.total
+        return summary
+
+
+class StageMetrics:
+    """
+    The metrics of a stage: the operations, their latency, the bytes read and written, the retries and the errors.
+    """
+
+    def __init__(self) -> None:
+        self.latency = LatencyHistogram()
+        self.errors = 0
+        self.retries = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def summary(self) -> dict:
+        return {
+            'count': self.latency.count,
+            'errors': self.errors,
+            'retries': self.retries,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'latency_seconds': self.latency.summary(),
+        }
+
+
+class QueueMetrics:
+    """
+    The depth of a queue, sampled every time a task is taken from it.
+    """
+
+    def __init__(self) -> None:
+        self.samples = 0
+        self.total = 0
+        self.max = 0
+
+    def summary(self) -> dict:
+        return {'max': self.max, 'mean': self.total / self.samples if self.samples else 0.0}
+
+
+class Metrics:
+    """
+    The performance metrics of a run, recorded by every stage and written as a JSON report and optionally as a
+    Prometheus textfile.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Start recording the metrics of a new run.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self.started_at = time.time()
+            self.stages: Dict[str, StageMetrics] = {}
+            self.queues: Dict[str, QueueMetrics] = {}
+            self.gauges: Dict[str, float] = {}
+            self.counters: Dict[str, float] = {}
+
+    def _stage(self, stage: str) -> StageMetrics:
+        if stage not in self.stages:
+            self.stages[stage] = StageMetrics()
+        return self.stages[stage]
+
+    def record(self, stage: str, seconds: float, bytes_in: int = 0, bytes_out: int = 0, error: bool = False) -> None:
+        """
+        Record an operation of a stage.
+
+        Args:
+            stage (str): The name of the stage, ex: `DOWNLOAD`.
+            seconds (float): The latency of the operation.
+            bytes_in (int, optional): The bytes read by the operation.
+            bytes_out (int, optional): The bytes written by the operation.
+            error (bool, optional): If the operation failed.
+        Returns:
+            None
+        """
+        with self._lock:
+            metrics = self._stage(stage)
+            metrics.latency.add(seconds)
+            metrics.bytes_in += bytes_in
+            metrics.bytes_out += bytes_out
+            metrics.errors += error
+
+    @contextmanager
+    def timer(self, stage: str) -> Iterator[dict]:
+        """
+        Time an operation of a stage. The yielded dictionary can be updated with `bytes_in`, `bytes_out`
+        and `error`, and an exception raised by the operation is recorded as an error.
+
+        Args:
+            stage (str): The name of the stage.
+        Yields:
+            dict: The results of the operation.
+        """
+        result = {'bytes_in': 0, 'bytes_out': 0, 'error': False}
+        start = time.perf_counter()
+        try:
+            yield result
+        except Exception:
+            result['error'] = True
+            raise
+        finally:
+            self.record(stage, time.perf_counter() - start, result['bytes_in'], result['bytes_out'], result['error'])
+
+    def retry(self, stage: str) -> None:
+        """
+        Record a retry of an operation of a stage.
+
+        Args:
+            stage (str): The name of the stage.
+        Returns:
+            None
+        """
+        with self._lock:
+            self._stage(stage).retries += 1
+
+    def queue_depth(self, queue_name: str, depth: int) -> None:
+        """
+        Record a sample of the depth of a queue.
+
+        Args:
+            queue_name (str): The name of the queue.
+            depth (int): The number of tasks in the queue.
+        Returns:
+            None
+        """
+        with self._lock:
+            if queue_name not in self.queues:
+                self.queues[queue_name] = QueueMetrics()
+            metrics = self.queues[queue_name]
+            metrics.samples += 1
+            metrics.total += depth
+            metrics.max = max(metrics.max, depth)
+
+    def count(self, name: str, value: float = 1) -> None:
+        """
+        Add `value` to a counter of the run, ex: the images deduplicated.
+
+        Args:
+            name (str): The name of the counter.
+            value (float, optional): The value to add.
+        Returns:
+            None
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name: str, value: float) -> None:
+        """
+        Set a value of the run, ex: the peak of bytes in memory.
+
+        Args:
+            name (str): The name of the value.
+            value (float): The value.
+        Returns:
+            None
+        """
+        with self._lock:
+            self.gauges[name] = value
+
+    def report(self) -> dict:
+        """
+        Get the metrics of the run.
+
+        Returns:
+            dict: The duration of the run, the metrics of each stage and queue, and the counters and values of the run.
+        """
+        with self._lock:
+            duration = time.time() - self.started_at
+            stages = {}
+            for stage, metrics in self.stages.items():
+                stages[stage] = metrics.summary()
+                stages[stage]['per_second'] = metrics.latency.count / duration if duration else 0.0
+
+            return {
+                'started_at': self.started_at,
+                'duration_seconds': duration,
+                'stages': stages,
+                'queues': {name: metrics.summary() for name, metrics in self.queues.items()},
+                'gauges': dict(self.gauges),
+                'counters': dict(self.counters),
+            }
+
+    def write_json(self, path: str, report: Optional[dict] = None) -> None:
+        """
+        Write the report of the run as JSON.
+
+        Args:
+            path (str): The path of the JSON file.
+            report (dict, optional): The report to write, ex: merged with `merge_reports`, defaults to the report of the run.
+        Returns:
+            None
+        """
+        with open(path, 'w') as f:
+            json.dump(report or self.report(), f, indent=2)
+
+    def write_prometheus(self, path: str, prefix: str = 'onboarding', report: Optional[dict] = None) -> None:
+        """
+        Write the report of the run as a Prometheus textfile, for the textfile collector of the node exporter.
+
+        Args:
+            path (str): The path of the textfile, usually with a `.prom` extension.
+            prefix (str, optional): The prefix of the metric names.
+            report (dict, optional): The report to write, ex: merged with `merge_reports`, defaults to the report of the run.
+        Returns:
+            None
+        """
+        report = report or self.report()
+        lines = [
+            f'# TYPE {prefix}_duration_seconds gauge',
+            f'{prefix}_duration_seconds {report["duration_seconds"]:.3f}',
+            f'# TYPE {prefix}_stage_latency_seconds summary',
+        ]
+        for stage, metrics in report['stages'].items():
+            latency = metrics['latency_seconds']
+            for q in QUANTILES:
+                lines.append(f'{prefix}_stage_latency_seconds{{stage="{stage}",quantile="{q}"}} {latency[f"p{round(q * 100)}"]:.6f}')
+            lines.append(f'{prefix}_stage_latency_seconds_sum{{stage="{stage}"}} {latency["total"]:.6f}')
+            lines.append(f'{prefix}_stage_latency_seconds_count{{stage="{stage}"}} {metrics["count"]}')
+
+        for name, key in (('errors', 'errors'), ('retries', 'retries'), ('bytes_in', 'bytes_in'), ('bytes_out', 'bytes_out')):
+            lines.append(f'# TYPE {prefix}_stage_{name}_total counter')
+            for stage, metrics in report['stages'].items():
+                lines.append(f'{prefix}_stage_{name}_total{{stage="{stage}"}} {metrics[key]}')
+
+        lines.append(f'# TYPE {prefix}_queue_depth_max gauge')
+        for name, metrics in report['queues'].items():
+            lines.append(f'{prefix}_queue_depth_max{{queue="{name}"}} {metrics["max"]}')
+        for name, value in report['gauges'].items():
+            lines.append(f'# TYPE {prefix}_{name} gauge')
+            lines.append(f'{prefix}_{name} {value}')
+        for name, value in report['counters'].items():
+            lines.append(f'# TYPE {prefix}_{name}_total counter')
+            lines.append(f'{prefix}_{name}_total {value}')
+
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, path)
+
+    def summary(self, report: Optional[dict] = None) -> str:
+        """
+        Get a table with the main metrics of each stage, to print at the end of the run.
+
+        Args:
+            report (dict, optional): The report to summarize, ex: merged with `merge_reports`, defaults to the report of the run.
+        Returns:
+            str: The table.
+        """
+        report = report or self.report()
+        lines = [f"{'stage':<19}{'count':>8}{'errors':>8}{'retries':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'MB in':>9}{'MB out':>9}"]
+        for stage, metrics in report['stages'].items():
+            latency = metrics['latency_seconds']
+            lines.append(f"{stage:<19}{metrics['count']:>8}{metrics['errors']:>8}{metrics['retries']:>8}"
+                         f"{latency['p50'] * 1000:>9.0f}{latency['p95'] * 1000:>9.0f}{latency['p99'] * 1000:>9.0f}"
+                         f"{metrics['bytes_in'] / (1024 * 1024):>9.1f}{metrics['bytes_out'] / (1024 * 1024):>9.1f}")
+        for name, value in report['counters'].items():
+            lines.append(f'{name}: {value:g}')
+
+        return '\n'.join(lines)
+
+
+def merge_reports(reports: List[dict]) -> dict:
+    """
+    Merge the reports of the shards of a run, executed at the same time. The quantiles of the latencies are
+    approximated by the mean of the quantiles of the shards, weighted by their count.
+
+    Args:
+        reports (List[dict]): The reports of the shards, as written by `Metrics.write_json`.
+    Returns:
+        dict: The report of the whole run.
+    """
+    started_at = min((report['started_at'] for report in reports), default=time.time())
+    duration = max((report['started_at'] + report['duration_seconds'] for report in reports), default=started_at) - started_at
+
+    stages: Dict[str, dict] = {}
+    queues: Dict[str, dict] = {}
+    gauges: Dict[str, float] = {}
+    counters: Dict[str, float] = {}
+    for report in reports:
+        for stage, metrics in report['stages'].items():
+            merged = stages.setdefault(stage, {'count': 0, 'errors': 0, 'retries': 0, 'bytes_in': 0, 'bytes_out': 0,
+                                               'latency_seconds': {f'p{round(q * 100)}': 0.0 for q in QUANTILES}})
+            for key in ('count', 'errors', 'retries', 'bytes_in', 'bytes_out'):
+                merged[key] += metrics[key]
+            latency, merged_latency = metrics['latency_seconds'], merged['latency_seconds']
+            for q in QUANTILES:
+                merged_latency[f'p{round(q * 100)}'] += latency[f'p{round(q * 100)}'] * metrics['count']
+            merged_latency['max'] = max(merged_latency.get('max', 0.0), latency['max'])
+            merged_latency['total'] = merged_latency.get('total', 0.0) + latency['total']
+
+        for name, metrics in report['queues'].items():
+            merged = queues.setdefault(name, {'max': 0, 'mean': 0.0})
+            merged['max'] = max(merged['max'], metrics['max'])
+            merged['mean'] += metrics['mean'] / len(reports)
+        for name, value in report['gauges'].items():
+            gauges[name] = max(gauges.get(name, value), value)
+        for name, value in report['counters'].items():
+            counters[name] = counters.get(name, 0) + value
+
+    for metrics in stages.values():
+        latency = metrics['latency_seconds']
+        for q in QUANTILES:
+            latency[f'p{round(q * 100)}'] = latency[f'p{round(q * 100)}'] / metrics['count'] if metrics['count'] else 0.0
+        latency['mean'] = latency['total'] / metrics['count'] if metrics['count'] else 0.0
+        metrics['per_second'] = metrics['count'] / duration if duration else 0.0
+
+    return {
+        'started_at': started_at,
+        'duration_seconds': duration,
+        'shards': len(reports),
+        'stages': stages,
+        'queues': queues,
+        'gauges': gauges,
+        'counters': counters,
+    }
+
+
+# The metrics of the current run, shared by every module
+METRICS = Metrics()
+
@@ -0,0 +1,916 @@
+import re
+import heapq
+import queue
+import threading
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from . import tools, DEFAULT_IMAGE_CONTENT
+from .brokers import Broker
+from .encoding import Derivative
+from .inventory import BLUEPRINTS, PHOTOS, SourceImage, unit_prefix
+from . import metrics, processing
+from .metrics import METRICS
+from .journal import FailureJournal, take_error
+from .manifest import META_DERIVATIVE, META_GENERATION, META_MD5, META_SOURCE, META_VARIANT, Manifest, md5_base64
+from .buffers import heap_estimate, heap_size, spool
+
+# Marks the end of the tasks in a stage queue
+_DONE = object()
+
+
+class ImageTask:
+    """
+    An image that goes through the pipeline, processed once and uploaded to the folder of each broker.
+
+    Args:
+        url (str): The public url of the source image.
+        path (str): The blob name where the processed image is uploaded, relative to the folder of the broker.
+        size (int, optional): The size in bytes of the source image, if it's known from the listing.
+        kind (str, optional): The kind of the image, `PHOTOS` or `BLUEPRINTS`.
+        group (str, optional): The folder of the image relative to the folder of the broker, used to report when a folder is completed.
+        group_size (int, optional): The number of images in the group.
+        name (str, optional): The blob name of the source image, if it's not given it's obtained from `url`.
+        generation (int, optional): The generation of the source image.
+        md5_hash (str, optional): The md5 hash of the source image.
+        crc32c (str, optional): The crc32c checksum of the source image.
+        attempt (int, optional): The number of times the image is processed, greater than 1 when it's retried.
+        targets (Set[str], optional): The names of the brokers the image is processed for, None for every broker.
+    """
+
+    __slots__ = ('url', 'path', 'size', 'kind', 'group', 'group_size', 'name', 'generation', 'md5_hash', 'crc32c', 'attempt',
+                 'targets', 'brokers', 'data', 'outputs', 'ready', 'derivatives', 'failures')
+
+    def __init__(self, url: str, path: str, size: int = 0, kind: str = PHOTOS, group: Optional[str] = None, group_size: int = 0,
+                 name: Optional[str] = None, generation: Optional[int] = None, md5_hash: Optional[str] = None,
+                 crc32c: Optional[str] = None, attempt: int = 1, targets: Optional[Set[str]] = None) -> None:
+        self.url = url
+        self.name = name or tools.get_blob_name_from_url(url)
+        self.generation = generation
+        self.md5_hash = md5_hash
+        self.crc32c = crc32c
+        self.path = path
+        self.size = size or 0
+        self.kind = kind
+        self.group = group
+        self.group_size = group_size
+        self.attempt = attempt
+        self.targets = targets
+        # The brokers whose image is still pending
+        self.brokers: List[Broker] = []
+        # The source image, downloaded once for all the brokers
+        self.data: Optional[bytes] = None
+        # The image of each broker, None if it's copied server-side
+        self.outputs: List[Tuple[Broker, Optional[bytes]]] = []
+        # The image of each broker already processed, ex: found in the cache
+        self.ready: List[Tuple[Broker, bytes]] = []
+        # The derivatives of the image of each broker
+        self.derivatives: List[Tuple[Broker, Derivative, bytes]] = []
+        # The failure of each broker whose image could not be processed, as broker name -> (stage, error class, message)
+        self.failures: Dict[str, Tuple[str, str, str]] = {}
+
+    def __repr__(self) -> str:
+        return f'ImageTask({self.path!r})'
+
+    @property
+    def source_id(self) -> Optional[str]:
+        """
+        The identity of the content of the source image, used as the key of the processed images cache.
+        None if the source image is not known from the listing.
+        """
+        if self.md5_hash:
+            return self.md5_hash
+        if self.name and self.generation is not None:
+            return f'{self.name}#{self.generation}'
+
+        return None
+
+    @property
+    def content_key(self) -> Optional[str]:
+        """
+        The identity of the content of the source image from the checksums of the listing, the same for identical
+        images under different paths. None if the checksums are not known.
+        """
+        if self.md5_hash:
+            return self.md5_hash
+        if self.crc32c and self.size:
+            return f'crc32c:{self.crc32c}:{self.size}'
+
+        return None
+
+    def n_bytes(self) -> int:
+        """
+        Get the bytes held in the heap by the task.
+
+        Returns:
+            int: The number of bytes.
+        """
+        n_bytes = heap_size(self.data)
+        n_bytes += sum(heap_size(data) for _, data in self.ready)
+        n_bytes += sum(heap_size(data) for _, _, data in self.derivatives)
+        return n_bytes + sum(heap_size(data) for _, data in self.outputs)
+
+
+def photo_tasks(groups: Iterable[Tuple[str, List[SourceImage]]]) -> Iterator[ImageTask]:
+    """
+    Get the tasks of the photos groups. The photos are named as the original ones, indexing them by
+    their position in the group, ex: `{group}01.jpg` inside the folder of each broker.
+
+    Args:
+        groups (Iterable[Tuple[str, List[SourceImage]]]): The photos groups as (key, images).
+    Yields:
+        ImageTask: The task of each photo.
+    """
+    for key, images in groups:
+        for index, img in enumerate(images):
+            index = index + 1
+            yield ImageTask(img.url, f'{key}{index:02}.jpg', img.size, PHOTOS, key, len(images),
+                            img.name, img.generation, img.md5_hash, img.crc32c)
+
+
+def blueprint_tasks(groups: Iterable[Tuple[str, List[SourceImage]]]) -> Iterator[ImageTask]:
+    """
+    Get the tasks of the blueprints groups. The blueprints keep the name of the original ones,
+    ex: `{path}/{filename}` inside the folder of each broker.
+
+    Args:
+        groups (Iterable[Tuple[str, List[SourceImage]]]): The blueprints groups as (path to folder planos, images).
+    Yields:
+        ImageTask: The task of each blueprint.
+    """
+    for path, images in groups:
+        for img in images:
+            yield ImageTask(img.url, f'{path}/{tools.get_file_name_from_url(img.url)}', img.size, BLUEPRINTS, path, len(images),
+                            img.name, img.generation, img.md5_hash, img.crc32c)
+
+
+def inventory_tasks(groups: Iterable[Tuple[str, str, List[SourceImage]]]) -> Iterator[ImageTask]:
+    """
+    Get the tasks of the photos and blueprints groups of the inventory, in the order they are listed,
+    so both kinds of images are processed by the same pipeline.
+
+    Args:
+        groups (Iterable[Tuple[str, str, List[SourceImage]]]): The groups as (kind, key, images), as yielded by `iter_groups`.
+    Yields:
+        ImageTask: The task of each image.
+    """
+    for kind, key, images in groups:
+        if kind == BLUEPRINTS:
+            yield from blueprint_tasks([(key, images)])
+        else:
+            yield from photo_tasks([(key, images)])
+
+
+def unit_key(path: str) -> str:
+    """
+    Get the unit of an image, that is the folder holding its folders `fotos` and `planos`.
+    Ex: 'edificio-parque-andino/local-3/fotos/parque-andino-local-3-01.jpg' returns 'edificio-parque-andino/local-3'
+
+    Args:
+        path (str): The path of the image.
+    Returns:
+        str: The path of the unit.
+    """
+    prefix = unit_prefix(path)
+    if prefix is not None:
+        return prefix[:-1]
+
+    return path.rsplit('/', 1)[0]
+
+
+def by_unit() -> Callable[[ImageTask], int]:
+    """
+    Get a priority that keeps the images of a unit together, so the photos and blueprints of a unit are
+    finished at the same time. The units are prioritized in the order they are first seen.
+
+    Returns:
+        Callable[[ImageTask], int]: The priority of each task, lower first.
+    """
+    units: Dict[str, int] = {}
+
+    def priority(task: ImageTask) -> int:
+        return units.setdefault(unit_key(task.path), len(units))
+
+    return priority
+
+
+def prioritized(tasks: Iterable[ImageTask], window: int = 0,
+                priority: Optional[Callable[[ImageTask], int]] = None) -> Iterator[ImageTask]:
+    """
+    Reorder the tasks by `priority`, and by size among the tasks with the same priority, see `largest_first`.
+
+    Args:
+        tasks (Iterable[ImageTask]): The tasks to reorder.
+        window (int, optional): The number of tasks reordered at a time.
+        priority (Callable[[ImageTask], int], optional): The priority of each task, lower first. If it's None,
+            every task has the same priority.
+    Yields:
+        ImageTask: The tasks, from the highest priority to the lowest one inside the window.
+    """
+    heap = []
+    for seq, task in enumerate(tasks):
+        # The sequence keeps the listing order for images of the same priority and size
+        heapq.heappush(heap, (priority(task) if priority else 0, -task.size, seq, task))
+        if 0 < window <= len(heap):
+            yield heapq.heappop(heap)[3]
+
+    while heap:
+        yield heapq.heappop(heap)[3]
+
+
+def largest_first(tasks: Iterable[ImageTask], window: int = 0) -> Iterator[ImageTask]:
+    """
+    Reorder the tasks so the largest images are dispatched first, using the sizes from the listing. The tasks
+    are sorted in windows of `window` tasks, or all at once if it's 0.
+
+    Args:
+        tasks (Iterable[ImageTask]): The tasks to reorder.
+        window (int, optional): The number of tasks reordered at a time.
+    Yields:
+        ImageTask: The tasks, from the largest image to the smallest one inside the window.
+    """
+    return prioritized(tasks, window)
+
+
+def report_group(task: ImageTask, broker_name: str, log_mng=None) -> None:
+    """
+    Report that every image of the group of `task` was uploaded for the broker `broker_name`.
+
+    Args:
+        task (ImageTask): The last task of the group.
+        broker_name (str): The name of the broker.
+        log_mng (LogManager, optional): The log where the folder is recorded, if it's None the folder is printed.
+    Returns:
+        None
+    """
+    if task.kind == BLUEPRINTS:
+        folder = f'{broker_name}/{task.group}'
+        msg = f'---- Blueprint images uploaded to folder: {folder}'
+    else:
+        folder = f"{broker_name}/{re.sub(r'fotos/.*', '', task.group)}"
+        msg = f'---- Images uploaded to folder: {folder}'
+
+    if log_mng:
+        log_mng.event('folder_uploaded', message=msg, broker=broker_name, folder=folder, kind=task.kind)
+    else:
+        print(msg)
+
+
+def _spool(data: Optional[bytes]) -> Optional[bytes]:
+    # The default image keeps its identity, it marks the images that failed
+    return data if data is None or data is DEFAULT_IMAGE_CONTENT else spool(data)
+
+
+class ByteBudget:
+    """
+    A budget of the bytes held in memory by the images in flight. An image larger than the budget is allowed
+    when nothing else is in flight.
+
+    Args:
+        max_bytes (int): The maximum number of bytes in flight.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self.peak = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, n_bytes: int) -> None:
+        """
+        Reserve `n_bytes`, waiting until they fit in the budget.
+
+        Args:
+            n_bytes (int): The number of bytes to reserve.
+        Returns:
+            None
+        """
+        with self._cond:
+            while self.in_flight and self.in_flight + n_bytes > self.max_bytes:
+                self._cond.wait()
+            self.in_flight += n_bytes
+            self.peak = max(self.peak, self.in_flight)
+
+    def adjust(self, old_bytes: int, new_bytes: int) -> None:
+        """
+        Update a reservation once the real size of an image is known, without waiting.
+
+        Args:
+            old_bytes (int): The number of bytes reserved.
+            new_bytes (int): The number of bytes actually held.
+        Returns:
+            None
+        """
+        with self._cond:
+            self.in_flight += new_bytes - old_bytes
+            self.peak = max(self.peak, self.in_flight)
+            if new_bytes < old_bytes:
+                self._cond.notify_all()
+
+    def release(self, n_bytes: int) -> None:
+        """
+        Release `n_bytes` from the budget.
+
+        Args:
+            n_bytes (int): The number of bytes to release.
+        Returns:
+            None
+        """
+        self.adjust(n_bytes, 0)
+
+
+class ContentGroup:
+    """
+    The images with the same source content. The first one is processed, and the rest, the duplicates, are copied
+    from its uploaded images.
+
+    Args:
+        original (ImageTask): The first image of the group.
+    """
+
+    __slots__ = ('original', 'uploaded', 'done', 'duplicates')
+
+    def __init__(self, original: ImageTask) -> None:
+        self.original = original
+        # The checksum of the uploaded image of each broker, None if it's not known
+        self.uploaded: Dict[str, Optional[str]] = {}
+        # If the original image is done, so the duplicates can be copied
+        self.done = False
+        # The duplicates waiting for the original image
+        self.duplicates: List[ImageTask] = []
+
+
+class PipelineConfig:
+    """
+    The configuration of the pipeline.
+
+    Args:
+        threads (int, optional): The default number of workers for the fetch and upload stages.
+        fetch_workers (int, optional): The number of workers that download the images.
+        process_workers (int, optional): The number of workers that apply the watermark and compress the images.
+        upload_workers (int, optional): The number of workers that upload the images.
+        queue_size (int, optional): The maximum number of tasks waiting between two stages.
+        max_inflight_mb (int, optional): The maximum megabytes of images held in memory.
+        default_image_size (int, optional): The bytes reserved for an image whose size is unknown before downloading it.
+        schedule (str, optional): The order the images are dispatched: `listing`, `largest` first or by `unit`.
+        schedule_window (int, optional): The number of images reordered at a time by the `largest` and `unit` schedules,
+            0 sorts all of them.
+        server_copy (bool, optional): Copy the images of the brokers without watermark server-side.
+        copy_workers (int, optional): The number of server-side copies in flight, defaults to 4 times `threads`.
+        process_mode (str, optional): Where the images are processed, in `threads` or in a pool of `processes`.
+        dedup (bool, optional): Process only once the images with the same source content.
+        io_engine (str, optional): How the network requests are sent, from `threads` or from an event loop with `async`.
+        async_concurrency (int, optional): The maximum number of images in flight, and of connections, of the `async` engine.
+        host_connections (int, optional): The maximum number of connections to the same host of the `async` engine.
+    """
+
+    SCHEDULE_LISTING = 'listing'
+    SCHEDULE_LARGEST = 'largest'
+    SCHEDULE_UNIT = 'unit'
+    SCHEDULES = [SCHEDULE_LISTING, SCHEDULE_LARGEST, SCHEDULE_UNIT]
+    PROCESS_THREADS = 'threads'
+    PROCESS_POOL = 'processes'
+    PROCESS_MODES = [PROCESS_THREADS, PROCESS_POOL]
+    IO_THREADS = 'threads'
+    IO_ASYNC = 'async'
+    IO_ENGINES = [IO_THREADS, IO_ASYNC]
+
+    def __init__(self, threads: int = 5, fetch_workers: Optional[int] = None, process_workers: Optional[int] = None,
+                 upload_workers: Optional[int] = None, queue_size: Optional[int] = None, max_inflight_mb: int = 256,
+                 default_image_size: int = 1024 * 1024, schedule: str = SCHEDULE_LARGEST, schedule_window: int = 2000,
+                 server_copy: bool = True, copy_workers: Optional[int] = None, process_mode: str = PROCESS_THREADS,
+                 dedup: bool = True, io_engine: str = IO_THREADS, async_concurrency: int = 1000,
+                 host_connections: int = 100) -> None:
+        self.fetch_workers = fetch_workers or threads
+        self.process_workers = process_workers or processing.available_cores()
+        self.upload_workers = upload_workers or threads
+        self.queue_size = queue_size or 2 * max(self.fetch_workers, self.process_workers, self.upload_workers)
+        self.max_inflight_bytes = max_inflight_mb * 1024 * 1024
+        self.default_image_size = default_image_size
+        self.schedule = schedule
+        self.schedule_window = schedule_window
+        self.server_copy = server_copy
+        # A copy only waits for the storage, so many of them can be in flight
+        self.copy_workers = copy_workers or 4 * threads
+        self.process_mode = process_mode
+        self.dedup = dedup
+        self.io_engine = io_engine
+        self.async_concurrency = async_concurrency
+        self.host_connections = host_connections
+
+    @property
+    def service_concurrency(self) -> int:
+        """
+        The maximum number of requests in flight to the watermark service, one per fetch worker, or the connections
+        per host of the `async` engine.
+        """
+        return self.host_connections if self.io_engine == self.IO_ASYNC else self.fetch_workers
+
+
+class Pipeline:
+    """
+    A staged pipeline that downloads, processes and uploads images, with bounded queues between the stages:
+
+    tasks -> fetch -> process (watermark/compress) -> upload
+
+    Each image is downloaded and decoded once for all the brokers. If no broker has a watermark, the images are
+    copied server-side instead:
+
+    tasks -> copy
+
+    The duplicates of an image are copied from it once it's uploaded:
+
+    duplicates -> copy
+
+    Args:
+        img_mng (ImageManager): The image manager used to download the images.
+        uploader (FirebaseUploaderManager): The manager used to upload the images.
+        brokers (List[Broker]): The brokers whose images are processed.
+        config (PipelineConfig, optional): The configuration of the pipeline.
+        on_uploaded (Callable[[ImageTask, str], None], optional): Called with each task and its public url once uploaded
+            for a broker.
+        manifest (Manifest, optional): The manifest of the images already processed, which are skipped. The images
+            uploaded successfully are recorded in it.
+        journal (FailureJournal, optional): The journal where the images that could not be processed are recorded,
+            with the stage that failed, so they can be retried.
+    """
+
+    def __init__(self, img_mng, uploader, brokers: List[Broker], config: Optional[PipelineConfig] = None,
+                 on_uploaded: Optional[Callable[[ImageTask, str], None]] = None, manifest: Optional[Manifest] = None,
+                 journal: Optional[FailureJournal] = None) -> None:
+        self.img_mng = img_mng
+        self.uploader = uploader
+        self.brokers = brokers
+        self.config = config or PipelineConfig()
+        self.on_uploaded = on_uploaded
+        self.manifest = manifest
+        self.journal = journal
+        self.budget = ByteBudget(self.config.max_inflight_bytes)
+        self.n_uploaded = 0
+
+        self._pending_groups: Dict[str, int] = {}
+        self._contents: Dict[Tuple[str, str], ContentGroup] = {}
+        self._duplicates_q: Optional[queue.Queue] = None
+        self._process_pool: Optional[processing.ImageProcessPool] = None
+        self._lock = threading.Lock()
+
+    @property
+    def server_copy(self) -> bool:
+        """
+        If the images are only copied with server-side copies, that is when no broker has a watermark.
+        """
+        return self.config.server_copy and not any(broker.img_mng.watermark_url for broker in self.brokers)
+
+    def _log(self, msg: str) -> None:
+        if self.img_mng.log_mng:
+            self.img_mng.log_mng.log(msg)
+        else:
+            print(msg)
+
+    def _progress(self, **counts) -> None:
+        if self.img_mng.log_mng:
+            self.img_mng.log_mng.progress(**counts)
+
+    def _with_derivatives(self, task: ImageTask, broker: Broker) -> bool:
+        # Only the photos are shown in different sizes
+        return task.kind == PHOTOS and bool(broker.img_mng.derivatives)
+
+    def _get_cached(self, task: ImageTask, broker: Broker) -> bool:
+        img = broker.img_mng.get_cached(task.source_id)
+        if img is None:
+            return False
+
+        derivatives = []
+        if self._with_derivatives(task, broker):
+            for derivative in broker.img_mng.derivatives:
+                derivative_img = broker.img_mng.get_cached(task.source_id, derivative)
+                if derivative_img is None:
+                    return False
+                derivatives.append((broker, derivative, derivative_img))
+
+        task.ready.append((broker, img))
+        task.derivatives.extend(derivatives)
+        return True
+
+    def _uncached_brokers(self, task: ImageTask) -> List[Broker]:
+        # The brokers whose image is in the cache are neither downloaded nor processed
+        return [broker for broker in task.brokers if not self._get_cached(task, broker)]
+
+    def _needs_source(self, broker: Broker) -> bool:
+        # The brokers using the watermark service get their own image from it, the rest share the source image,
+        # except the brokers without watermark whose image is copied server-side
+        return bool(broker.img_mng.watermark_engine) or (not broker.img_mng.watermark_url and not self.config.server_copy)
+
+    def _fetch(self, task: ImageTask) -> ImageTask:
+        task.brokers = self._uncached_brokers(task)
+
+        remote = [broker for broker in task.brokers if broker.img_mng.remote]
+        sharing = [broker for broker in task.brokers if self._needs_source(broker)]
+
+        reserved = heap_estimate(task.size or self.config.default_image_size) * (len(remote) + bool(sharing))
+        self.budget.acquire(reserved)
+        try:
+            if sharing:
+                task.data = self.img_mng._download_image(task.url)
+                if task.data is DEFAULT_IMAGE_CONTENT:
+                    error = take_error()
+                    for broker in sharing:
+                        task.failures[broker.name] = (metrics.DOWNLOAD, *error)
+            for broker in remote:
+                data = broker.img_mng.fetch(task.url)
+                if data is DEFAULT_IMAGE_CONTENT:
+                    task.failures[broker.name] = (metrics.WATERMARK, *take_error())
+                task.outputs.append((broker, data))
+        except Exception:
+            self.budget.release(reserved)
+            task.data = None
+            task.outputs = []
+            task.ready = []
+            task.derivatives = []
+            raise
+        self.budget.adjust(reserved, task.n_bytes())
+
+        return task
+
+    def _process(self, task: ImageTask) -> ImageTask:
+        n_bytes = task.n_bytes()
+        local = [broker.name for broker in task.brokers if broker.img_mng.watermark_engine]
+        fetched = [(broker.name, data) for broker, data in task.outputs]
+
+        with METRICS.timer(metrics.PROCESS) as result:
+            if self._process_pool is not None and (local or fetched):
+                named_outputs, named_derivatives, errors, messages = self._process_pool.render(
+                    task.kind, task.url, task.data if local else None, fetched, local)
+                for msg in messages:
+                    self._log(msg)
+            else:
+                managers = {broker.name: broker.img_mng for broker in task.brokers}
+                named_outputs, named_derivatives, errors = processing.render(task.kind, task.url, task.data, fetched, local,
+                                                                             managers, self._log)
+
+            result['bytes_in'] = (len(task.data) if local and task.data is not None else 0) + sum(len(data) for _, data in fetched)
+            result['bytes_out'] = sum(len(data) for _, data in named_outputs) + sum(len(data) for _, _, data in named_derivatives)
+            result['error'] = any(data is DEFAULT_IMAGE_CONTENT for _, data in named_outputs)
+
+        for name, error in errors.items():
+            task.failures.setdefault(name, (metrics.PROCESS, *error))
+
+        # The large outputs wait for the upload in a temporary file instead of the heap
+        brokers = {broker.name: broker for broker in task.brokers}
+        outputs = [(brokers[name], _spool(data)) for name, data in named_outputs]
+        derivatives = [(brokers[name], derivative, _spool(data)) for name, derivative, data in named_derivatives]
+
+        source_id = task.source_id
+        for broker, data in outputs:
+            broker.img_mng.set_cached(source_id, data)
+        for broker, derivative, data in derivatives:
+            broker.img_mng.set_cached(source_id, data, derivative)
+
+        for broker in task.brokers:
+            if not broker.img_mng.watermark_url:
+                # Without watermark the source image is copied server-side, or uploaded as is
+                outputs.append((broker, None if self.config.server_copy else task.data))
+
+        task.data = None
+        task.outputs = task.ready + outputs
+        task.ready = []
+        task.derivatives.extend(derivatives)
+        self.budget.adjust(n_bytes, task.n_bytes())
+
+        return task
+
+    def _metadata(self, task: ImageTask, broker: Broker) -> Dict[str, str]:
+        metadata = {META_SOURCE: task.name, META_VARIANT: broker.img_mng.variant}
+        if task.generation is not None:
+            metadata[META_GENERATION] = str(task.generation)
+        if task.md5_hash:
+            metadata[META_MD5] = task.md5_hash
+
+        return metadata
+
+    @staticmethod
+    def _derivative_metadata(metadata: Dict[str, str], derivative: Derivative) -> Dict[str, str]:
+        return {**metadata, META_DERIVATIVE: derivative.name}
+
+    @staticmethod
+    def _path(task: ImageTask, broker: Broker) -> str:
+        return f'{broker.name}/{broker.img_mng.output_path(task.path)}'
+
+    @staticmethod
+    def _content_type(broker: Broker, data: bytes) -> str:
+        return 'image/jpeg' if data is DEFAULT_IMAGE_CONTENT else broker.img_mng.content_type
+
+    def _upload(self, task: ImageTask) -> None:
+        for broker, data in task.outputs:
+            path = self._path(task, broker)
+            if data is None:
+                self._copy_output(task, broker)
+                continue
+
+            content_type = self._content_type(broker, data)
+            metadata = self._metadata(task, broker)
+            url = self.uploader._upload_img(path, data, metadata, content_type)
+
+            # The derivatives are uploaded next to the image, and the image is only recorded as done with all of them
+            uploaded = bool(url)
+            for derivative_broker, derivative, derivative_data in task.derivatives:
+                if derivative_broker is broker:
+                    uploaded = bool(self.uploader._upload_img(derivative.rename(path), derivative_data,
+                                                              self._derivative_metadata(metadata, derivative),
+                                                              content_type)) and uploaded
+
+            self._output_uploaded(task, broker, data, url, None if uploaded else take_error())
+
+        self._finish(task)
+
+    def _output_uploaded(self, task: ImageTask, broker: Broker, data: bytes, url: str,
+                         error: Optional[Tuple[str, str]]) -> None:
+        # The default image is uploaded so the image is not missing, but it's not recorded as done
+        if data is DEFAULT_IMAGE_CONTENT:
+            self._failed(task, broker, *task.failures.get(broker.name, (metrics.PROCESS, 'Unknown', '')))
+        elif error is not None:
+            self._failed(task, broker, metrics.UPLOAD, *error)
+        else:
+            output_md5 = md5_base64(data) if self.manifest is not None else None
+            if output_md5:
+                self._record(task, broker, output_md5)
+            group = self._content_group(task)
+            if group is not None:
+                group.uploaded[broker.name] = output_md5
+        self._uploaded(task, url)
+
+    def _finish(self, task: ImageTask) -> None:
+        self._done(task)
+        self._group_progress(task)
+        self._release_duplicates(task)
+
+    def _copy_output(self, task: ImageTask, broker: Broker) -> None:
+        url = self.uploader._copy_img(task.name, self._path(task, broker), self._metadata(task, broker))
+        if not url:
+            self._failed(task, broker, metrics.COPY, *take_error())
+        elif self.manifest is not None:
+            # The copy keeps the content of the source image
+            self._record(task, broker, task.md5_hash)
+        self._uploaded(task, url)
+
+    def _copy(self, task: ImageTask) -> None:
+        for broker in task.brokers:
+            self._copy_output(task, broker)
+        self._group_progress(task)
+
+    def _content_group(self, task: ImageTask) -> Optional[ContentGroup]:
+        # The group of the content of `task`, only if it's the original image of the group
+        group = self._contents.get((task.content_key, task.kind))
+        return group if group is not None and group.original is task else None
+
+    def _is_duplicate(self, task: ImageTask) -> bool:
+        if self._duplicates_q is None or not task.content_key:
+            return False
+
+        # The derivatives depend on the kind, so a photo and a blueprint are not duplicates
+        key = (task.content_key, task.kind)
+        with self._lock:
+            group = self._contents.get(key)
+            if group is None:
+                self._contents[key] = ContentGroup(task)
+                return False
+            if not group.done:
+                group.duplicates.append(task)
+                return True
+
+        self._duplicates_q.put(task)
+        return True
+
+    def _release_duplicates(self, task: ImageTask) -> None:
+        group = self._content_group(task)
+        if group is None:
+            return
+
+        with self._lock:
+            group.done = True
+            duplicates, group.duplicates = group.duplicates, []
+        for duplicate in duplicates:
+            self._duplicates_q.put(duplicate)
+
+    def _copy_duplicate(self, task: ImageTask) -> None:
+        pending = self._copy_duplicate_outputs(task)
+        if pending:
+            # The original image failed for these brokers, so the duplicate is processed by itself
+            task.brokers = pending
+            self._upload(self._process(self._fetch(task)))
+        else:
+            self._group_progress(task)
+
+    def _copy_duplicate_outputs(self, task: ImageTask) -> List[Broker]:
+        # Copies the images of the original image, returning the brokers whose original image failed
+        group = self._contents[(task.content_key, task.kind)]
+        original = group.original
+
+        pending = []
+        n_copied = n_remote = 0
+        for broker in task.brokers:
+            if not broker.img_mng.watermark_url and self.config.server_copy:
+                # The source image is copied as for the original image
+                self._copy_output(task, broker)
+            elif broker.name in group.uploaded:
+                self._copy_uploaded(original, task, broker, group.uploaded[broker.name])
+                n_copied += 1
+                n_remote += broker.img_mng.remote
+            else:
+                pending.append(broker)
+
+        if n_copied:
+            METRICS.count('dedup_images', n_copied)
+            METRICS.count('dedup_watermark_calls_saved', n_remote)
+            if not pending:
+                METRICS.count('dedup_download_bytes_saved', task.size)
+
+        return pending
+
+    def _copy_uploaded(self, original: ImageTask, task: ImageTask, broker: Broker, output_md5: Optional[str]) -> None:
+        source = self._path(original, broker)
+        path = self._path(task, broker)
+        metadata = self._metadata(task, broker)
+        content_type = broker.img_mng.content_type
+        url = self.uploader._copy_uploaded_img(source, path, metadata, content_type)
+
+        copied = bool(url)
+        if self._with_derivatives(task, broker):
+            for derivative in broker.img_mng.derivatives:
+                copied = bool(self.uploader._copy_uploaded_img(derivative.rename(source), derivative.rename(path),
+                                                               self._derivative_metadata(metadata, derivative),
+                                                               content_type)) and copied
+
+        if not copied:
+            self._failed(task, broker, metrics.DEDUP, *take_error())
+        elif self.manifest is not None and output_md5:
+            self._record(task, broker, output_md5)
+        self._uploaded(task, url)
+
+    def _record(self, task: ImageTask, broker: Broker, output_md5: Optional[str]) -> None:
+        self.manifest.record(self._path(task, broker), task.name, task.generation, task.md5_hash,
+                             broker.img_mng.variant, output_md5)
+
+    def _failed(self, task: ImageTask, broker: Broker, stage: str, error: str, message: str) -> None:
+        self._progress(errors=1)
+        if self.journal is not None:
+            self.journal.record(broker.name, task.path, task.name, task.url, task.kind, stage, error, message,
+                                task.attempt, task.generation, task.md5_hash)
+
+    def _pending_brokers(self, task: ImageTask) -> List[Broker]:
+        brokers = [broker for broker in self.brokers if task.targets is None or broker.name in task.targets]
+        if self.manifest is None:
+            return brokers
+
+        return [broker for broker in brokers
+                if not self.manifest.is_done(self._path(task, broker), task.name, task.generation, task.md5_hash,
+                                             broker.img_mng.variant)]
+
+    def _pending(self, tasks: Iterable[ImageTask]) -> Iterator[ImageTask]:
+        for task in tasks:
+            task.brokers = self._pending_brokers(task)
+            if not task.brokers:
+                self._group_progress(task)
+                continue
+
+            self._progress(total=len(task.brokers))
+            if not self._is_duplicate(task):
+                yield task
+
+        if self.img_mng.log_mng:
+            self.img_mng.log_mng.set_listed()
+
+    def _uploaded(self, task: ImageTask, url: str) -> None:
+        with self._lock:
+            self.n_uploaded += 1
+        self._progress(done=1)
+
+        if self.on_uploaded:
+            self.on_uploaded(task, url)
+
+    def _group_progress(self, task: ImageTask) -> None:
+        with self._lock:
+            group_done = False
+            if task.group:
+                pending = self._pending_groups.get(task.group, task.group_size) - 1
+                self._pending_groups[task.group] = pending
+                group_done = pending <= 0
+                if group_done:
+                    del self._pending_groups[task.group]
+
+        if group_done:
+            self._progress(folders=1)
+            for broker in self.brokers:
+                report_group(task, broker.name, self.img_mng.log_mng)
+
+    def _done(self, task: ImageTask) -> None:
+        self.budget.release(task.n_bytes())
+        task.data = None
+        task.outputs = []
+        task.ready = []
+        task.derivatives = []
+        task.failures = {}
+
+    def _worker(self, stage: str, inbox: queue.Queue, outbox: Optional[queue.Queue],
+                handler: Callable[[ImageTask], Optional[ImageTask]]) -> None:
+        while True:
+            task = inbox.get()
+            if task is _DONE:
+                return
+            METRICS.queue_depth(stage, inbox.qsize())
+
+            try:
+                task = handler(task)
+            except Exception as e:
+                self._unexpected_error(task, stage, e)
+                continue
+
+            if outbox is not None:
+                outbox.put(task)
+
+    def _unexpected_error(self, task: ImageTask, stage: str, e: Exception) -> None:
+        self._done(task)
+        self._log(f'{e}. Unexpected error processing the image. URL: {task.url}')
+        for broker in task.brokers:
+            self._failed(task, broker, stage, type(e).__name__, str(e))
+        self._progress(done=len(task.brokers))
+        self._release_duplicates(task)
+
+    def _start_process_pool(self) -> None:
+        if self.config.process_mode == PipelineConfig.PROCESS_POOL and any(broker.img_mng.watermark_url for broker in self.brokers):
+            self._process_pool = processing.ImageProcessPool(
+                {broker.name: broker.img_mng for broker in self.brokers}, self.config.process_workers)
+
+    def _close_process_pool(self) -> None:
+        if self._process_pool is not None:
+            self._process_pool.close()
+            self._process_pool = None
+
+    def _scheduled(self, tasks: Iterable[ImageTask]) -> Iterable[ImageTask]:
+        # The order is irrelevant for server-side copies
+        if self.config.schedule == PipelineConfig.SCHEDULE_LARGEST and not self.server_copy:
+            return largest_first(tasks, self.config.schedule_window)
+        if self.config.schedule == PipelineConfig.SCHEDULE_UNIT and not self.server_copy:
+            return prioritized(tasks, self.config.schedule_window, by_unit())
+
+        return tasks
+
+    def _start_stage(self, stage: str, n_workers: int, inbox: queue.Queue, outbox: Optional[queue.Queue], handler) -> List[threading.Thread]:
+        workers = [threading.Thread(target=self._worker, args=(stage, inbox, outbox, handler), daemon=True)
+                   for _ in range(n_workers)]
+        for worker in workers:
+            worker.start()
+
+        return workers
+
+    @staticmethod
+    def _stop_stage(workers: List[threading.Thread], inbox: queue.Queue) -> None:
+        for _ in workers:
+            inbox.put(_DONE)
+        for worker in workers:
+            worker.join()
+
+    def run(self, tasks: Iterable[ImageTask]) -> int:
+        """
+        Run every task through the pipeline, skipping the images already recorded in the manifest.
+
+        Args:
+            tasks (Iterable[ImageTask]): The tasks to process.
+        Returns:
+            int: The number of images uploaded, counting the image of each broker.
+        """
+        config = self.config
+        fetch_q = queue.Queue(maxsize=config.queue_size)
+
+        if self.server_copy:
+            # The images are not modified, so they are copied without leaving the storage
+            stages = [
+                (self._start_stage(metrics.COPY, config.copy_workers, fetch_q, None, self._copy), fetch_q),
+            ]
+        else:
+            self._start_process_pool()
+            process_q = queue.Queue(maxsize=config.queue_size)
+            upload_q = queue.Queue(maxsize=config.queue_size)
+            stages = [
+                (self._start_stage(metrics.DOWNLOAD, config.fetch_workers, fetch_q, process_q, self._fetch), fetch_q),
+                (self._start_stage(metrics.PROCESS, config.process_workers, process_q, upload_q, self._process), process_q),
+                (self._start_stage(metrics.UPLOAD, config.upload_workers, upload_q, None, self._upload), upload_q),
+            ]
+            if config.dedup:
+                # The duplicates wait for their original image to be uploaded, so their queue is not bounded and
+                # releasing them never blocks the uploads
+                self._duplicates_q = queue.Queue()
+                stages.append((self._start_stage(metrics.DEDUP, config.copy_workers, self._duplicates_q, None,
+                                                 self._copy_duplicate), self._duplicates_q))
+
+        try:
+            for task in self._pending(self._scheduled(tasks)):
+                fetch_q.put(task)
+
+            # Each stage is stopped once the previous one has finished
+            for workers, inbox in stages:
+                self._stop_stage(workers, inbox)
+        finally:
+            self._close_process_pool()
+            METRICS.gauge('peak_inflight_bytes', max(self.budget.peak, METRICS.gauges.get('peak_inflight_bytes', 0)))
+
+        return self.n_uploaded
@@ -0,0 +1,333 @@
+import json
+import math
+import os
+import time
+from typing import Dict, Iterable, List, Optional
+
+from .brokers import Broker
+from .inventory import BLUEPRINTS, PHOTOS
+from .log_manager import format_duration
+from .manifest import Manifest
+from . import metrics, processing
+from .pipeline import ImageTask, Pipeline, PipelineConfig, unit_key
+
+# The objects of a page of the listing of the bucket
+LIST_PAGE_SIZE = 1000
+# The previous runs used to estimate the throughput of each stage
+HISTORY_RUNS = 10
+
+
+def record_run(path: str, report: dict, config: PipelineConfig, brokers: List[Broker], n_uploaded: int,
+               shard: Optional[str] = None) -> None:
+    """
+    Append the throughput of each stage of a run to the history of runs, used by `RunPlan.estimate`.
+
+    Args:
+        path (str): The path of the history, a JSON lines file.
+        report (dict): The report of the run, as returned by `Metrics.report`.
+        config (PipelineConfig): The configuration of the pipeline of the run.
+        brokers (List[Broker]): The brokers of the run.
+        n_uploaded (int): The number of images uploaded, counting the image of each broker.
+        shard (str, optional): The shard of the run, ex: '2/4'.
+    Returns:
+        None
+    """
+    run = {
+        'finished_at': time.time(),
+        'duration_seconds': report['duration_seconds'],
+        'images': n_uploaded,
+        'shard': shard,
+        'config': {
+            'fetch_workers': config.fetch_workers, 'process_workers': config.process_workers,
+            'upload_workers': config.upload_workers, 'copy_workers': config.copy_workers,
+            'process_mode': config.process_mode, 'io_engine': config.io_engine,
+            'async_concurrency': config.async_concurrency, 'host_connections': config.host_connections,
+            'cores': processing.available_cores(),
+        },
+        'engines': sorted({broker.img_mng.engine if broker.img_mng.watermark_url else 'copy' for broker in brokers}),
+        'stages': {stage: {'count': stage_metrics['count'], 'busy_seconds': stage_metrics['latency_seconds']['total'],
+                           'bytes_in': stage_metrics['bytes_in'], 'bytes_out': stage_metrics['bytes_out']}
+                   for stage, stage_metrics in report['stages'].items()},
+    }
+    # A single line is appended, so the shards executed on the same machine can share the history
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(run) + '\n')
+
+
+def read_runs(path: str, io_engine: Optional[str] = None, limit: int = HISTORY_RUNS) -> List[dict]:
+    """
+    Read the last runs of the history, preferring the runs with the same I/O engine.
+
+    Args:
+        path (str): The path of the history.
+        io_engine (str, optional): The I/O engine of the run to estimate.
+        limit (int, optional): The maximum number of runs.
+    Returns:
+        List[dict]: The runs, from the oldest one.
+    """
+    if not os.path.exists(path):
+        return []
+
+    runs = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                run = json.loads(line)
+            except ValueError:
+                continue
+            # The lines cut by an interrupted run, or written by hand
+            if isinstance(run, dict) and isinstance(run.get('config'), dict):
+                runs.append(run)
+
+    same_engine = [run for run in runs if run['config'].get('io_engine') == io_engine]
+    return (same_engine or runs)[-limit:]
+
+
+class RunPlan:
+    """
+    The plan of a run from the inventory of the bucket: the photos and blueprints per building and per unit, and
+    the work of each stage for the brokers, without the images already recorded in the manifest.
+
+    Args:
+        brokers (List[Broker]): The brokers of the run.
+        config (PipelineConfig): The configuration of the pipeline of the run.
+        manifest (Manifest, optional): The manifest of the images already processed.
+    """
+
+    def __init__(self, brokers: List[Broker], config: PipelineConfig, manifest: Optional[Manifest] = None) -> None:
+        self.brokers = brokers
+        self.config = config
+        self.manifest = manifest
+
+        # kind -> [images, bytes]
+        self.kinds: Dict[str, List[int]] = {PHOTOS: [0, 0], BLUEPRINTS: [0, 0]}
+        # building -> {kind: images}
+        self.buildings: Dict[str, Dict[str, int]] = {}
+        # unit -> [images, bytes]
+        self.units: Dict[str, List[int]] = {}
+        self.skipped: List[str] = []
+
+        self.n_done = 0
+        self.n_duplicates = 0
+        self.n_downloads = 0
+        self.download_bytes = 0
+        self.n_process = 0
+        self.process_bytes = 0
+        self.n_watermark_calls = 0
+        self.watermark_bytes = 0
+        self.n_uploads = 0
+        self.n_copies = 0
+        self._contents = set()
+
+    @property
+    def n_images(self) -> int:
+        return self.kinds[PHOTOS][0] + self.kinds[BLUEPRINTS][0]
+
+    @property
+    def n_bytes(self) -> int:
+        return self.kinds[PHOTOS][1] + self.kinds[BLUEPRINTS][1]
+
+    @property
+    def egress_bytes(self) -> int:
+        """
+        The bytes read from the download bucket, by this machine and by the watermark service.
+        """
+        return self.download_bytes + self.watermark_bytes
+
+    def _outputs(self, task: ImageTask, broker: Broker) -> int:
+        # The image and its derivatives
+        return 1 + (len(broker.img_mng.derivatives) if task.kind == PHOTOS else 0)
+
+    def _is_copied(self, broker: Broker) -> bool:
+        return not broker.img_mng.watermark_url and self.config.server_copy
+
+    def add(self, task: ImageTask) -> None:
+        """
+        Add an image of the inventory to the plan.
+
+        Args:
+            task (ImageTask): The task of the image.
+        Returns:
+            None
+        """
+        self.kinds[task.kind][0] += 1
+        self.kinds[task.kind][1] += task.size
+        building = task.path.split('/', 1)[0]
+        counts = self.buildings.setdefault(building, {PHOTOS: 0, BLUEPRINTS: 0})
+        counts[task.kind] += 1
+        unit = self.units.setdefault(unit_key(task.path), [0, 0])
+        unit[0] += 1
+        unit[1] += task.size
+
+        brokers = [broker for broker in self.brokers
+                   if self.manifest is None or not self.manifest.is_done(Pipeline._path(task, broker), task.name, task.generation,
+                                                                       task.md5_hash, broker.img_mng.variant)]
+        if not brokers:
+            self.n_done += 1
+            return
+
+        copied = [broker for broker in brokers if self._is_copied(broker)]
+        processed = [broker for broker in brokers if not self._is_copied(broker)]
+        self.n_copies += len(copied)
+
+        key = (task.content_key, task.kind)
+        if processed and self.config.dedup and task.content_key:
+            if key in self._contents:
+                # Copied server-side from the images of the first image with the same content
+                self.n_duplicates += 1
+                self.n_copies += sum(self._outputs(task, broker) for broker in processed)
+                return
+            self._contents.add(key)
+
+        remote = [broker for broker in processed if broker.img_mng.remote]
+        if len(remote) < len(processed):
+            self.n_downloads += 1
+            self.download_bytes += task.size
+        if processed:
+            self.n_process += 1
+            self.process_bytes += task.size
+        # The watermark service downloads the image by itself
+        self.n_watermark_calls += len(remote)
+        self.watermark_bytes += task.size * len(remote)
+        self.n_uploads += sum(self._outputs(task, broker) for broker in processed)
+
+    def add_all(self, tasks: Iterable[ImageTask]) -> 'RunPlan':
+        """
+        Add the images of the inventory to the plan.
+
+        Args:
+            tasks (Iterable[ImageTask]): The tasks of the images.
+        Returns:
+            RunPlan: The plan.
+        """
+        for task in tasks:
+            self.add(task)
+        return self
+
+    def estimate(self, runs: List[dict], config: Optional[PipelineConfig] = None, n_shards: int = 1) -> Optional[dict]:
+        """
+        Estimate the duration of the run from the throughput of each stage in previous runs, as the duration of the
+        slowest stage.
+
+        Args:
+            runs (List[dict]): The previous runs, as read by `read_runs`.
+            config (PipelineConfig, optional): The configuration to estimate, defaults to the configuration of the plan.
+            n_shards (int, optional): The number of shards the run is split in, executed at the same time.
+        Returns:
+            Optional[dict]: The estimated seconds of each stage and of the run, and the slowest stage. None if there
+            are no previous runs.
+        """
+        if not runs:
+            return None
+
+        config = config or self.config
+        totals: Dict[str, Dict[str, float]] = {}
+        for run in runs:
+            for stage, stage_metrics in run['stages'].items():
+                total = totals.setdefault(stage, {'count': 0, 'busy_seconds': 0.0, 'bytes_in': 0})
+                for key in total:
+                    total[key] += stage_metrics.get(key, 0)
+
+        def per_call(stage: str) -> float:
+            total = totals.get(stage)
+            return total['busy_seconds'] / total['count'] if total and total['count'] else 0.0
+
+        # The processing and the uploads take longer for larger images
+        download = totals.get(metrics.DOWNLOAD, {})
+        mean_size = self.process_bytes / self.n_process if self.n_process else 0
+        past_mean_size = download['bytes_in'] / download['count'] if download.get('count') else 0
+        scale = mean_size / past_mean_size if mean_size and past_mean_size else 1.0
+        if download.get('bytes_in'):
+            download_busy = self.download_bytes * download['busy_seconds'] / download['bytes_in']
+        else:
+            download_busy = self.n_downloads * per_call(metrics.DOWNLOAD)
+
+        cores = processing.available_cores()
+        if config.io_engine == PipelineConfig.IO_ASYNC:
+            requests = min(config.async_concurrency, config.host_connections)
+            stages = {
+                metrics.DOWNLOAD: download_busy / requests,
+                metrics.WATERMARK: self.n_watermark_calls * per_call(metrics.WATERMARK) / requests,
+                metrics.UPLOAD: self.n_uploads * per_call(metrics.UPLOAD) * scale / requests,
+            }
+        else:
+            # The fetch workers download the images and wait for the watermark service
+            watermark_busy = self.n_watermark_calls * per_call(metrics.WATERMARK)
+            fetch_stage = metrics.WATERMARK if watermark_busy > download_busy else metrics.DOWNLOAD
+            stages = {
+                fetch_stage: (download_busy + watermark_busy) / config.fetch_workers,
+                metrics.UPLOAD: self.n_uploads * per_call(metrics.UPLOAD) * scale / config.upload_workers,
+            }
+        stages[metrics.PROCESS] = self.n_process * per_call(metrics.PROCESS) * scale / min(config.process_workers, cores)
+        stages[metrics.COPY] = self.n_copies * per_call(metrics.COPY) / config.copy_workers
+        # The listing is paged while the images are processed
+        n_objects = self.n_images + len(self.skipped)
+        stages[metrics.LIST] = math.ceil(n_objects / LIST_PAGE_SIZE) * per_call(metrics.LIST)
+
+        stages = {stage: seconds / n_shards for stage, seconds in stages.items()}
+        slowest = max(stages, key=stages.get)
+        return {'seconds': stages[slowest], 'slowest_stage': slowest, 'stages': stages}
+
+    def summary(self, runs: List[dict], top: int = 10) -> str:
+        """
+        Get the plan to print: the inventory, the work for the brokers and the estimated durations.
+
+        Args:
+            runs (List[dict]): The previous runs, as read by `read_runs`.
+            top (int, optional): The number of buildings and units listed.
+        Returns:
+            str: The plan.
+        """
+        mb = 1024 * 1024
+        photos, blueprints = self.kinds[PHOTOS], self.kinds[BLUEPRINTS]
+        lines = [
+            f'Photos: {photos[0]} ({photos[1] / mb:.1f} MB), blueprints: {blueprints[0]} ({blueprints[1] / mb:.1f} MB), '
+            f'total: {self.n_images} images ({self.n_bytes / mb:.1f} MB) in {len(self.buildings)} buildings and {len(self.units)} units',
+        ]
+
+        ds_store = sum('.DS_Store' in name for name in self.skipped)
+        lines.append(f'Skipped objects: {len(self.skipped)} ({ds_store} .DS_Store, {len(self.skipped) - ds_store} outside fotos/planos)')
+        lines.extend(f'  {name}' for name in self.skipped[:top])
+
+        lines.append(f"\n{'building':<40}{'photos':>8}{'planos':>8}")
+        buildings = sorted(self.buildings.items(), key=lambda item: -sum(item[1].values()))
+        for building, counts in buildings[:top]:
+            lines.append(f'{building:<40}{counts[PHOTOS]:>8}{counts[BLUEPRINTS]:>8}')
+        if len(buildings) > top:
+            lines.append(f'... {len(buildings) - top} more buildings')
+
+        lines.append(f"\n{'largest units':<40}{'images':>8}{'MB':>8}")
+        for unit, (n_images, n_bytes) in sorted(self.units.items(), key=lambda item: -item[1][1])[:top]:
+            lines.append(f'{unit:<40}{n_images:>8}{n_bytes / mb:>8.1f}')
+
+        lines.append(f'\nImages already processed (manifest): {self.n_done}, duplicates copied: {self.n_duplicates}')
+        lines.append(f'Downloads: {self.n_downloads}, watermark service calls: {self.n_watermark_calls}, '
+                     f'processed: {self.n_process}, uploads: {self.n_uploads}, server-side copies: {self.n_copies}')
+        lines.append(f'Egress from the download bucket: {self.egress_bytes / mb:.1f} MB '
+                     f'({self.download_bytes / mb:.1f} MB downloaded, {self.watermark_bytes / mb:.1f} MB read by the watermark service)')
+
+        if not runs:
+            lines.append('\nNo previous runs recorded, the duration is estimated once a run is executed with the same history file')
+            return '\n'.join(lines)
+
+        lines.append(f'\nEstimated duration, from the throughput of the last {len(runs)} runs:')
+        lines.append(f"{'threads':>8}{'shards':>8}{'duration':>12}  slowest stage")
+        config = self.config
+        threads = max(config.fetch_workers, config.upload_workers)
+        options = [(1, 1), (2, 1), (4, 1), (1, 2), (1, 4)]
+        for factor, n_shards in options:
+            scaled = self._scaled(config, factor)
+            estimate = self.estimate(runs, scaled, n_shards)
+            lines.append(f"{threads * factor:>8}{n_shards:>8}{format_duration(estimate['seconds']):>12}  {estimate['slowest_stage']}")
+
+        lines.append('More threads or shards only help until the watermark service or the storage are saturated')
+        return '\n'.join(lines)
+
+    @staticmethod
+    def _scaled(config: PipelineConfig, factor: int) -> PipelineConfig:
+        # The same configuration with `factor` times the workers of the network-bound stages
+        return PipelineConfig(fetch_workers=config.fetch_workers * factor, process_workers=config.process_workers,
+                              upload_workers=config.upload_workers * factor, copy_workers=config.copy_workers * factor,
+                              process_mode=config.process_mode, io_engine=config.io_engine,
+                              async_concurrency=config.async_concurrency * factor,
+                              host_connections=config.host_connections * factor)
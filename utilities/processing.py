@@ -0,0 +1,287 @@
+import os
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from . import DEFAULT_IMAGE_CONTENT
+from .buffers import spool_chunks
+from .encoding import Derivative
+from .image_manager import ImageManager
+from .inventory import PHOTOS
+from .journal import take_error
+
+# The outputs of each broker, as (broker name, image) and (broker name, derivative, image)
+Outputs = List[Tuple[str, bytes]]
+Derivatives = List[Tuple[str, Derivative, bytes]]
+# The error of each broker whose image could not be processed, as broker name -> (error class, message)
+Errors = Dict[str, Tuple[str, str]]
+
+# A reference to an image in the shared memory, as (offset, length). The images that do not fit in the shared
+# memory are passed as bytes, and the default image is passed as `_DEFAULT_REF` to keep its identity
+Ref = Union[Tuple[int, int], bytes, str, None]
+_DEFAULT_REF = 'default'
+
+
+def available_cores() -> int:
+    """
+    Get the number of cores available to the process, that can be less than the cores of the machine,
+    ex: in a container limited to some cores.
+
+    Returns:
+        int: The number of cores.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0)) or 1
+
+    return os.cpu_count() or 1
+
+
+def render(kind: str, url: str, data: Optional[bytes], fetched: Outputs, local: List[str], managers: Dict[str, ImageManager],
+           log: Callable[[str], None]) -> Tuple[Outputs, Derivatives, Errors]:
+    """
+    The CPU-bound work of an image: compress the images with the watermark applied by the watermark service, and
+    apply the watermark of the brokers using the local engine to the source image, decoding it only once for all
+    the brokers with the same encoding. The derivatives of the photos are generated along with them.
+
+    Args:
+        kind (str): The kind of the image, `PHOTOS` or `BLUEPRINTS`.
+        url (str): The public url of the source image, used for logging.
+        data (bytes, optional): The source image, required if there are brokers using the local engine.
+        fetched (List[Tuple[str, bytes]]): The images returned by the watermark service for each broker.
+        local (List[str]): The names of the brokers using the local engine.
+        managers (Dict[str, ImageManager]): The image manager of each broker.
+        log (Callable[[str], None]): Called with the errors to log.
+    Returns:
+        Tuple[Outputs, Derivatives, Errors]: The processed image of each broker, their derivatives and the errors
+            of the images that could not be processed. The images that failed before, ex: downloading them, are not
+            in the errors.
+    """
+    outputs = []
+    derivatives = []
+    errors = {}
+
+    for name, img in fetched:
+        img_mng = managers[name]
+        failed = img is DEFAULT_IMAGE_CONTENT
+        if kind == PHOTOS and img_mng.derivatives:
+            img, img_derivatives = img_mng.process_derivatives(img, url)
+            derivatives.extend((name, derivative, derivative_img) for derivative, derivative_img in img_derivatives)
+        else:
+            img = img_mng.process(img, url)
+        if img is DEFAULT_IMAGE_CONTENT and not failed:
+            errors[name] = take_error()
+        outputs.append((name, img))
+
+    images = {}
+    decode_errors = {}
+    # The last broker of each encoding applies its watermark to the decoded image itself instead of a copy
+    last = {managers[name].encoding.key: name for name in local}
+    for name in local:
+        img_mng = managers[name]
+        encoding = img_mng.encoding
+        if encoding.key not in images:
+            images[encoding.key] = None
+            if data is not DEFAULT_IMAGE_CONTENT:
+                try:
+                    images[encoding.key] = encoding.decode(data)
+                except Exception as e:
+                    decode_errors[encoding.key] = (type(e).__name__, str(e))
+                    log(f'{e}. Could not decode the image. URL: {url}')
+
+        image = images[encoding.key]
+        if image is None:
+            img = DEFAULT_IMAGE_CONTENT
+            if encoding.key in decode_errors:
+                errors[name] = decode_errors[encoding.key]
+        else:
+            if kind == PHOTOS and img_mng.derivatives:
+                img, img_derivatives = img_mng.process_image_derivatives(image, url, in_place=last[encoding.key] == name)
+                derivatives.extend((name, derivative, derivative_img) for derivative, derivative_img in img_derivatives)
+            else:
+                img = img_mng.process_image(image, url, in_place=last[encoding.key] == name)
+            if img is DEFAULT_IMAGE_CONTENT:
+                errors[name] = take_error()
+        outputs.append((name, img))
+
+    return outputs, derivatives, errors
+
+
+class _MessageLog:
+    """
+    Collects the messages logged in a worker process, so they are written to the log file by the main process.
+    """
+
+    def __init__(self) -> None:
+        self.messages: List[str] = []
+
+    def log(self, message: str) -> None:
+        self.messages.append(message)
+
+
+# The image managers of the worker process, one per broker
+_managers: Dict[str, ImageManager] = {}
+_log = _MessageLog()
+
+
+def _init_worker(specs: Dict[str, dict]) -> None:
+    for name, spec in specs.items():
+        img_mng = ImageManager(watermark_url=spec['watermark_url'], engine=spec['engine'], log_mng=_log,
+                               encoding=spec['encoding'], derivatives=spec['derivatives'])
+        if img_mng.watermark_engine:
+            # The watermark is not fetched again by every process
+            img_mng.watermark_engine.load_content(spec['watermark'])
+        _managers[name] = img_mng
+
+
+def _read(buf: memoryview, ref: Ref, spooled: bool = False) -> Optional[bytes]:
+    if ref == _DEFAULT_REF:
+        return DEFAULT_IMAGE_CONTENT
+    if ref is None or isinstance(ref, bytes):
+        return ref
+
+    offset, length = ref
+    if not spooled:
+        return bytes(buf[offset:offset + length])
+
+    # The large outputs are written from the shared memory to the spool, without copying them to the heap first
+    with buf[offset:offset + length] as view:
+        return spool_chunks([view], length)
+
+
+def _render_shared(shm_name: str, kind: str, url: str, data_ref: Ref, fetched_refs: List[Tuple[str, Ref]], local: List[str],
+                   out_offset: int) -> Tuple[List[Tuple[str, Ref]], List[Tuple[str, Derivative, Ref]], Errors, List[str]]:
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        data = _read(shm.buf, data_ref)
+        fetched = [(name, _read(shm.buf, ref)) for name, ref in fetched_refs]
+        _log.messages = []
+        outputs, derivatives, errors = render(kind, url, data, fetched, local, _managers, _log.log)
+
+        # The outputs are written after the inputs, those that do not fit are returned as bytes
+        position = out_offset
+
+        def write(img: bytes) -> Ref:
+            nonlocal position
+            if img is DEFAULT_IMAGE_CONTENT:
+                return _DEFAULT_REF
+            if position + len(img) > shm.size:
+                return img
+
+            shm.buf[position:position + len(img)] = img
+            position += len(img)
+            return position - len(img), len(img)
+
+        output_refs = [(name, write(img)) for name, img in outputs]
+        derivative_refs = [(name, derivative, write(img)) for name, derivative, img in derivatives]
+    finally:
+        shm.close()
+
+    return output_refs, derivative_refs, errors, _log.messages
+
+
+class ImageProcessPool:
+    """
+    A pool of processes for the CPU-bound work of the images, which are passed to the processes through shared memory.
+    If a process dies, ex: killed by the OOM killer, the pool is started again and the image is processed once more.
+
+    Args:
+        managers (Dict[str, ImageManager]): The image manager of each broker.
+        workers (int, optional): The number of processes, defaults to the number of available cores.
+    """
+
+    def __init__(self, managers: Dict[str, ImageManager], workers: Optional[int] = None) -> None:
+        specs = {}
+        for name, img_mng in managers.items():
+            if img_mng.watermark_engine:
+                img_mng.watermark_engine.load()
+            specs[name] = {
+                'watermark_url': img_mng.watermark_url,
+                'engine': img_mng.engine,
+                'watermark': img_mng.watermark_engine.content if img_mng.watermark_engine else None,
+                'encoding': img_mng.encoding,
+                'derivatives': img_mng.derivatives,
+            }
+
+        self.workers = workers or available_cores()
+        self._specs = specs
+        self._lock = threading.Lock()
+        self._executor = self._start()
+
+    def _start(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=_init_worker, initargs=(self._specs,))
+
+    def _submit(self, *args):
+        for attempt in range(2):
+            executor = self._executor
+            try:
+                return executor.submit(_render_shared, *args).result()
+            except BrokenProcessPool:
+                with self._lock:
+                    # Only the first thread that finds the pool broken starts it again
+                    if self._executor is executor:
+                        executor.shutdown(wait=False)
+                        self._executor = self._start()
+                if attempt:
+                    raise
+
+    def render(self, kind: str, url: str, data: Optional[bytes], fetched: Outputs,
+               local: List[str]) -> Tuple[Outputs, Derivatives, Errors, List[str]]:
+        """
+        Run `render` in one of the processes.
+
+        Args:
+            kind (str): The kind of the image, `PHOTOS` or `BLUEPRINTS`.
+            url (str): The public url of the source image, used for logging.
+            data (bytes, optional): The source image, required if there are brokers using the local engine.
+            fetched (List[Tuple[str, bytes]]): The images returned by the watermark service for each broker.
+            local (List[str]): The names of the brokers using the local engine.
+        Returns:
+            Tuple[Outputs, Derivatives, Errors, List[str]]: The processed image of each broker, their derivatives,
+                the errors of the images that could not be processed and the messages logged by the process.
+        """
+        inputs = [img for img in [data] + [img for _, img in fetched]
+                  if img is not None and img is not DEFAULT_IMAGE_CONTENT]
+        in_size = sum(map(len, inputs))
+        # The processed images are usually smaller than the source images, with room for the derivatives
+        shm = shared_memory.SharedMemory(create=True, size=2 * in_size + 1024 * 1024)
+        try:
+            position = 0
+
+            def write(img: Optional[bytes]) -> Ref:
+                nonlocal position
+                if img is None:
+                    return None
+                if img is DEFAULT_IMAGE_CONTENT:
+                    return _DEFAULT_REF
+
+                shm.buf[position:position + len(img)] = img
+                position += len(img)
+                return position - len(img), len(img)
+
+            data_ref = write(data)
+            fetched_refs = [(name, write(img)) for name, img in fetched]
+
+            output_refs, derivative_refs, errors, messages = self._submit(shm.name, kind, url, data_ref, fetched_refs,
+                                                                          local, position)
+
+            outputs = [(name, _read(shm.buf, ref, spooled=True)) for name, ref in output_refs]
+            derivatives = [(name, derivative, _read(shm.buf, ref, spooled=True)) for name, derivative, ref in derivative_refs]
+        finally:
+            shm.close()
+            shm.unlink()
+
+        return outputs, derivatives, errors, messages
+
+    def close(self) -> None:
+        """
+        Stop the processes once the pending work is done.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._executor.shutdown()
@@ -0,0 +1,284 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 30.0) -> float:
+    """
+    Get the delay before retrying a request, growing exponentially with the attempt and with full jitter.
+
+    Args:
+        attempt (int): The number of the attempt that failed, starting at 0.
+        base (float, optional): The delay of the first retry in seconds.
+        cap (float, optional): The maximum delay in seconds.
+    Returns:
+        float: The delay in seconds.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def retry_after_seconds(value: Optional[str]) -> Optional[float]:
+    """
+    Parse the `Retry-After` header of a response, given as seconds or as an HTTP date.
+
+    Args:
+        value (str, optional): The value of the header.
+    Returns:
+        Optional[float]: The seconds to wait, None if the header is missing or invalid.
+    """
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveLimiter:
+    """
+    A limit of requests in flight that adapts to the service (AIMD). The limit grows by one for every `limit`
+    successful requests, and it's halved at most once per round trip when the service is overloaded: a 429, a 5xx,
+    a timeout or a latency much higher than the average.
+
+    Args:
+        initial (int): The initial number of requests in flight.
+        max_limit (int): The maximum number of requests in flight.
+        min_limit (int, optional): The minimum number of requests in flight.
+        backoff_ratio (float, optional): The factor applied to the limit when the service is overloaded.
+        latency_tolerance (float, optional): How many times the average latency a response can take before it's
+            considered a sign of overload.
+        latency_smoothing (float, optional): The weight of each response in the moving average of the latency.
+        probe_interval (float, optional): The seconds before the limit can reach again the limit that overloaded the service.
+    """
+
+    def __init__(self, initial: int, max_limit: int, min_limit: int = 1, backoff_ratio: float = 0.5,
+                 latency_tolerance: float = 3.0, latency_smoothing: float = 0.1, probe_interval: float = 10.0) -> None:
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self.backoff_ratio = backoff_ratio
+        self.latency_tolerance = latency_tolerance
+        self.latency_smoothing = latency_smoothing
+        self.probe_interval = probe_interval
+        self.in_flight = 0
+        self.latency: Optional[float] = None
+        self.ceiling: Optional[float] = None
+
+        self._decreased_at = float('-inf')
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self) -> None:
+        """
+        Wait until a request can be sent, that is when the requests in flight are under the limit
+        and the service did not ask to wait with `Retry-After`.
+
+        Returns:
+            None
+        """
+        with self._cond:
+            while True:
+                wait = self.try_acquire()
+                if wait is None:
+                    break
+                self._cond.wait(wait or None)
+
+    def try_acquire(self) -> Optional[float]:
+        """
+        Take a slot for a request without waiting, ex: from an event loop that cannot block.
+
+        Returns:
+            Optional[float]: None if the request can be sent, otherwise the seconds to wait because of `Retry-After`,
+                or 0 if the requests in flight are at the limit until one of them is released.
+        """
+        with self._cond:
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                return pause
+            if self.in_flight >= int(self.limit):
+                return 0.0
+            self.in_flight += 1
+            return None
+
+    def release(self, latency: Optional[float] = None, overloaded: bool = False) -> None:
+        """
+        Release a request, adapting the limit to its outcome.
+
+        Args:
+            latency (float, optional): The seconds the request took, None if it's unknown.
+            overloaded (bool, optional): If the response shows the service is overloaded.
+        Returns:
+            None
+        """
+        with self._cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+
+            if latency is not None and not overloaded:
+                overloaded = self.latency is not None and latency > self.latency * self.latency_tolerance
+                if self.latency is None:
+                    self.latency = latency
+                else:
+                    self.latency += self.latency_smoothing * (latency - self.latency)
+
+            if overloaded:
+                sent_at = now - (latency if latency is not None else self.latency or 0.0)
+                if sent_at >= self._decreased_at:
+                    self.ceiling = self.limit
+                    self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
+                    self._decreased_at = now
+            else:
+                max_limit = self.max_limit
+                if self.ceiling is not None and now - self._decreased_at < self.probe_interval:
+                    max_limit = max(self.limit, min(max_limit, self.ceiling - 1))
+                self.limit = min(max_limit, self.limit + 1 / self.limit)
+
+            self._cond.notify_all()
+
+    def pause(self, seconds: float) -> None:
+        """
+        Stop sending requests for `seconds`, ex: when the service answers with `Retry-After`.
+
+        Args:
+            seconds (float): The seconds to wait.
+        Returns:
+            None
+        """
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class CircuitBreaker:
+    """
+    A circuit breaker that stops sending requests to a service after `failure_threshold` consecutive failures,
+    allowing a single trial request every `reset_timeout` seconds.
+
+    Args:
+        failure_threshold (int, optional): The number of consecutive failures that opens the circuit.
+        reset_timeout (float, optional): The seconds the circuit stays open before a trial request.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold: int = 10, reset_timeout: float = 30.0) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.n_opened = 0
+
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """
+        Check if a request can be sent to the service.
+
+        Returns:
+            bool: If the request can be sent.
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                # Only the first request after the timeout is the trial
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def remaining(self) -> float:
+        """
+        Get the seconds until the next trial request is allowed.
+
+        Returns:
+            float: The seconds to wait, 0 if the circuit is closed.
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return 0.0
+            return max(0.0, self._opened_at + self.reset_timeout - time.monotonic())
+
+    def record_success(self) -> None:
+        """
+        Record a successful request, closing the circuit.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._failures = 0
+            self.state = self.CLOSED
+
+    def record_failure(self) -> None:
+        """
+        Record a failed request, opening the circuit after `failure_threshold` consecutive failures or
+        if the trial request failed.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self._failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                self.n_opened += 1
+
+
+class ServiceControl:
+    """
+    The rate control of a remote service shared by all the threads using it: an adaptive limit of requests
+    in flight, the backoff between retries and a circuit breaker.
+
+    Args:
+        max_concurrency (int): The maximum number of requests in flight.
+        initial_concurrency (int, optional): The initial number of requests in flight, defaults to a quarter of `max_concurrency`.
+        failure_threshold (int, optional): The consecutive failures that open the circuit breaker.
+        reset_timeout (float, optional): The seconds the circuit breaker stays open.
+        backoff_base (float, optional): The delay of the first retry in seconds.
+        backoff_cap (float, optional): The maximum delay between retries in seconds.
+    """
+
+    def __init__(self, max_concurrency: int, initial_concurrency: Optional[int] = None, failure_threshold: int = 10,
+                 reset_timeout: float = 30.0, backoff_base: float = 0.5, backoff_cap: float = 30.0) -> None:
+        self.limiter = AdaptiveLimiter(initial_concurrency or max(1, max_concurrency // 4), max_concurrency)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+
+    def delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """
+        Get the delay before retrying a failed request, honoring the `Retry-After` of the service.
+
+        Args:
+            attempt (int): The number of the attempt that failed, starting at 0.
+            retry_after (str, optional): The `Retry-After` header of the response.
+        Returns:
+            float: The delay in seconds.
+        """
+        seconds = retry_after_seconds(retry_after)
+        if seconds is not None:
+            self.limiter.pause(seconds)
+            return seconds
+
+        return backoff_delay(attempt, self.backoff_base, self.backoff_cap)
+
+    def stats(self) -> str:
+        """
+        Get a summary of the state of the rate control.
+
+        Returns:
+            str: The current limit and the times the circuit was opened.
+        """
+        return f'Watermark service: concurrency limit {int(self.limiter.limit)}/{self.limiter.max_limit}, ' +\
+            f'circuit breaker opened {self.breaker.n_opened} times'
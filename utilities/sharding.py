@@ -0,0 +1,83 @@
+import glob
+import hashlib
+import os
+from typing import List
+
+
+class Shard:
+    """
+    A slice of the units of the bucket (the folders `edificio/local`), partitioned by a hash of their path.
+
+    Args:
+        index (int): The number of the shard, from 1 to `count`.
+        count (int): The number of shards.
+    """
+
+    def __init__(self, index: int, count: int) -> None:
+        if count <= 0:
+            raise ValueError(f'Invalid number of shards: {count}')
+        if not 1 <= index <= count:
+            raise ValueError(f'Invalid shard: {index}, it must be between 1 and {count}')
+
+        self.index = index
+        self.count = count
+
+    def __repr__(self) -> str:
+        return f'Shard({self.index}, {self.count})'
+
+    def __str__(self) -> str:
+        return f'{self.index}/{self.count}'
+
+    @classmethod
+    def parse(cls, value: str) -> 'Shard':
+        """
+        Parse a shard given as `i/N`, ex: `2/4` is the second of four shards.
+
+        Args:
+            value (str): The shard.
+        Returns:
+            Shard: The parsed shard.
+        """
+        index, sep, count = value.partition('/')
+        if not sep or not index.strip().isdigit() or not count.strip().isdigit():
+            raise ValueError(f'Invalid shard: {value}, the format is i/N, ex: 2/4')
+
+        return cls(int(index), int(count))
+
+    def owns(self, unit: str) -> bool:
+        """
+        Check if a unit belongs to the shard.
+
+        Args:
+            unit (str): The path of the unit, ex: 'edificio-parque-andino/local-3'.
+        Returns:
+            bool: If the unit belongs to the shard.
+        """
+        digest = hashlib.md5(unit.strip('/').encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big') % self.count == self.index - 1
+
+    def path(self, path: str) -> str:
+        """
+        Get the path of a file of the shard, ex: 'manifest.db' returns 'manifest.shard-2-of-4.db'.
+
+        Args:
+            path (str): The path of the file of a run without shards.
+        Returns:
+            str: The path of the file of the shard.
+        """
+        root, ext = os.path.splitext(path)
+        return f'{root}.shard-{self.index}-of-{self.count}{ext}'
+
+
+def shard_files(path: str) -> List[str]:
+    """
+    Find the files written by the shards for the file `path` of a run without shards,
+    ex: 'manifest.db' finds 'manifest.shard-1-of-4.db', 'manifest.shard-2-of-4.db', ...
+
+    Args:
+        path (str): The path of the file of a run without shards.
+    Returns:
+        List[str]: The paths of the files of the shards, sorted.
+    """
+    root, ext = os.path.splitext(path)
+    return sorted(glob.glob(f'{glob.escape(root)}.shard-*-of-*{glob.escape(ext)}'))
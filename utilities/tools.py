@@ -1,6 +1,18 @@
+import os
+import math
+import requests
 from PIL import Image
+from requests.adapters import HTTPAdapter
 from io import BytesIO
-from urllib.parse import quote
+from urllib.parse import quote, unquote
+from typing import Optional, Tuple
+from .watermark_engine import WatermarkEngine
+from .buffers import open_buffer
+
+# The base of the public urls of the blobs, it can be replaced with the environment variable `PUBLIC_URL_ENV`,
+# ex: to use a local stand-in of the storage
+DEFAULT_PUBLIC_URL = 'https://firebasestorage.googleapis.com'
+PUBLIC_URL_ENV = 'FIREBASE_STORAGE_PUBLIC_URL'
 
 
 def format_name(name: str) -> str:
@@ -21,36 +33,78 @@ def format_name(name: str) -> str:
     return formatted_name.lower()
 
 
-def compress_img(img: bytes, quality: int = 20) -> bytes:
+def decode_img(img: bytes, max_size: Optional[Tuple[int, int]] = None) -> Image.Image:
     """
-    Compress an image to a certain quality
+    Decode an image, converting it to RGB mode. If `max_size` is given, the image is shrunk to fit in it,
+    decoding it at a reduced scale with the JPEG draft mode.
 
     Args:
-        img (bytes): The image to compress
-        quality (int, optional): The quality of the compressed image
+        img (bytes): The image to decode, or an image spooled to a temporary file, which is read without copying it
+        max_size (Tuple[int, int], optional): The maximum width and height of the decoded image
 
     Returns:
-        bytes: The compressed image
+        Image.Image: The decoded image
     """
 
-    image = Image.open(BytesIO(img))
+    image = Image.open(open_buffer(img))
+
+    scale = min(max_size[0] / image.width, max_size[1] / image.height) if max_size else 1
+    if scale < 1:
+        # The draft is requested with the final size, keeping the aspect ratio, so the decoder can pick the
+        # smallest scale (1/2, 1/4 or 1/8) that is still larger than it. Only JPEG supports it
+        image.draft('RGB', (math.ceil(image.width * scale), math.ceil(image.height * scale)))
+        image.thumbnail(max_size, Image.LANCZOS)
 
     # Convert the image to RGB mode if it has an alpha channel or is in a different mode
     if image.mode != 'RGB':
         image = image.convert('RGB')
 
-    try:
-        # Compress the image and save to a BytesIO object
-        output_buffer = BytesIO()
-        # Adjust quality as needed (0-100)
-        image.save(output_buffer, "JPEG", quality=quality)
+    return image
+
+
+def encode_img(image: Image.Image, quality: int = 20, format: str = 'JPEG', **options) -> bytes:
+    """
+    Encode an image as JPEG to a certain quality
+
+    Args:
+        image (Image.Image): The image to encode
+        quality (int, optional): The quality of the encoded image
+        format (str, optional): The format of the encoded image, ex: JPEG, WEBP or AVIF
+        **options: The options of the encoder, ex: `progressive` and `optimize` for JPEG
+
+    Returns:
+        bytes: The encoded image
+    """
+
+    # Compress the image and save to a BytesIO object, the errors are logged by the caller
+    output_buffer = BytesIO()
+    # Adjust quality as needed (0-100)
+    image.save(output_buffer, format, quality=quality, **options)
+
+    # Get the bytes of the compressed image
+    return output_buffer.getvalue()
+
+
+def compress_img(img: bytes, quality: int = 20, watermark: Optional[WatermarkEngine] = None) -> bytes:
+    """
+    Compress an image to a certain quality, optionally applying a watermark before encoding it,
+    so the image is decoded and encoded only once.
+
+    Args:
+        img (bytes): The image to compress
+        quality (int, optional): The quality of the compressed image
+        watermark (WatermarkEngine, optional): The watermark engine used to apply the watermark
+
+    Returns:
+        bytes: The compressed image
+    """
+
+    image = decode_img(img)
 
-        # Get the bytes of the compressed image
-        compressed_image_bytes = output_buffer.getvalue()
-    except Exception as e:
-        print(f'(compress_img) Error compressing image. {e}')
+    if watermark:
+        image = watermark.apply(image)
 
-    return compressed_image_bytes
+    return encode_img(image, quality)
 
 
 def replace_domain_url(url: str) -> str:
@@ -93,3 +147,55 @@ def get_file_name_from_url(url: str) -> str:
     """
     url_parts = url.split('/')
     return url_parts[-1].split('?')[0].split("%2F")[-1]
+
+
+def get_public_url(bucket_name: str, blob_name: str) -> str:
+    """Return the firebase storage public url of a blob.
+    Ex: 'edificio-angular/local-7/planos/angular-local-7-plano-ubicacion.jpg' in the bucket 'duvify-brokers-fotos-unidades'
+
+    returns 'https://firebasestorage.googleapis.com/v0/b/duvify-brokers-fotos-unidades/o/edificio-angular%2Flocal-7%2Fplanos%2Fangular-local-7-plano-ubicacion.jpg?alt=media'
+
+    Args:
+        bucket_name (str): The name of the bucket.
+        blob_name (str): The name of the blob.
+
+    Returns:
+        str: The public url of the blob.
+    """
+    base_url = os.environ.get(PUBLIC_URL_ENV) or DEFAULT_PUBLIC_URL
+    return f"{base_url.rstrip('/')}/v0/b/" +\
+        f"{bucket_name}/o/{quote(blob_name, safe='')}?alt=media"
+
+
+def mount_pool(session: requests.Session, pool_size: int) -> requests.Session:
+    """
+    Mount a keep-alive connection pool of `pool_size` connections per host in a session.
+
+    Args:
+        session (requests.Session): The session where the pool is mounted.
+        pool_size (int): The maximum number of connections kept alive per host, typically the number of threads.
+
+    Returns:
+        requests.Session: The same session.
+    """
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size, pool_block=False)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    return session
+
+
+def get_blob_name_from_url(url: str) -> str:
+    """Return the blob name of a firebase storage public url.
+    Ex: https://firebasestorage.googleapis.com/v0/b/duvify-brokers-fotos-unidades/o/edificio-angular%2Flocal-7%2Fplanos%2Fangular-local-7-plano-ubicacion.jpg?alt=media
+
+    returns 'edificio-angular/local-7/planos/angular-local-7-plano-ubicacion.jpg'
+
+    Args:
+        url (str): The public url of the blob.
+
+    Returns:
+        str: The name of the blob.
+    """
+    return unquote(url.split('/o/', 1)[-1].split('?')[0])
@@ -0,0 +1,179 @@
+import hashlib
+import threading
+import requests
+
+from io import BytesIO
+from typing import Dict, Optional, Tuple, Union
+from PIL import Image
+
+
+class WatermarkEngine:
+    """
+    A local watermark engine that composites the watermark in-process with Pillow, with the same semantics as the
+    payload sent to the watermark service:
+    - `mark_ratio`: The width of the watermark relative to the width of the main image.
+    - `opacity`: The opacity of the watermark (0.0 - 1.0).
+    - `position`: Where the watermark is placed, ex: `bottomMiddle`.
+    - `position_x`, `position_y`: If any of them is not 0, the watermark is placed at these pixel coordinates instead.
+
+    Args:
+        watermark_url (str): The url of the watermark image.
+        opacity (float, optional): The opacity of the watermark.
+        mark_ratio (float, optional): The width of the watermark relative to the main image.
+        position (str, optional): The position of the watermark in the main image.
+        position_x (float, optional): The x coordinate of the watermark.
+        position_y (float, optional): The y coordinate of the watermark.
+        timeout (Union[float, Tuple[float, float]], optional): The timeout for downloading the watermark image.
+        session (requests.Session, optional): The session used to download the watermark image.
+    """
+
+    POSITIONS = {
+        'topLeft': (0.0, 0.0),
+        'topMiddle': (0.5, 0.0),
+        'topRight': (1.0, 0.0),
+        'middleLeft': (0.0, 0.5),
+        'center': (0.5, 0.5),
+        'middleRight': (1.0, 0.5),
+        'bottomLeft': (0.0, 1.0),
+        'bottomMiddle': (0.5, 1.0),
+        'bottomRight': (1.0, 1.0),
+    }
+
+    def __init__(self, watermark_url: str, opacity: float = 1.0, mark_ratio: float = 1.0, position: str = 'bottomMiddle',
+                 position_x: float = 0.0, position_y: float = 0.0, timeout: Union[float, Tuple[float, float]] = 10,
+                 session: Optional[requests.Session] = None) -> None:
+        if position not in self.POSITIONS:
+            raise ValueError(f'Unknown watermark position: {position}')
+
+        self.watermark_url = watermark_url
+        self.opacity = opacity
+        self.mark_ratio = mark_ratio
+        self.position = position
+        self.position_x = position_x
+        self.position_y = position_y
+        self.timeout = timeout
+        self.session = session or requests.Session()
+
+        # The watermark image and its md5, that identifies the watermark once it's loaded
+        self.content: Optional[bytes] = None
+        self.digest: Optional[str] = None
+        self._mark: Image.Image = None
+        self._scaled_marks: Dict[Tuple[int, int], Image.Image] = {}
+        self._lock = threading.Lock()
+
+    def load(self) -> None:
+        """
+        Fetch and decode the watermark image, applying the opacity to its alpha channel.
+        It does nothing if the watermark was already loaded.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            if self._mark is not None:
+                return
+
+            r = self.session.get(self.watermark_url, timeout=self.timeout)
+            r.raise_for_status()
+            self._load_content(r.content)
+
+    def load_content(self, content: bytes) -> None:
+        """
+        Load the watermark from the content of the watermark image, instead of fetching it from `self.watermark_url`.
+
+        Args:
+            content (bytes): The watermark image content.
+        Returns:
+            None
+        """
+        with self._lock:
+            self._load_content(content)
+
+    def _load_content(self, content: bytes) -> None:
+        self._mark = self._prepare_mark(content)
+        self._scaled_marks = {}
+        self.content = content
+        self.digest = hashlib.md5(content).hexdigest()
+
+    def _prepare_mark(self, content: bytes) -> Image.Image:
+        """
+        Decode the watermark image to RGBA, applying `self.opacity` to its alpha channel.
+
+        Args:
+            content (bytes): The watermark image content.
+        Returns:
+            Image.Image: The watermark ready to be composited.
+        """
+        mark = Image.open(BytesIO(content))
+        mark.load()
+        mark = mark.convert('RGBA')
+
+        if self.opacity < 1.0:
+            alpha = mark.getchannel('A').point(
+                lambda a: int(a * max(self.opacity, 0.0)))
+            mark.putalpha(alpha)
+
+        return mark
+
+    def _scaled_mark(self, width: int, height: int) -> Image.Image:
+        """
+        Get the watermark scaled for a main image of `width`x`height`, cached by size.
+
+        Args:
+            width (int): The width of the main image.
+            height (int): The height of the main image.
+        Returns:
+            Image.Image: The scaled watermark.
+        """
+        key = (width, height)
+        mark = self._scaled_marks.get(key)
+        if mark is not None:
+            return mark
+
+        if self._mark is None:
+            self.load()
+
+        mark_w, mark_h = self._mark.size
+        scale = (width * self.mark_ratio) / mark_w
+        # The watermark never overflows the main image
+        scale = min(scale, height / mark_h)
+        size = (max(1, round(mark_w * scale)), max(1, round(mark_h * scale)))
+
+        mark = self._mark.resize(size, Image.LANCZOS)
+        with self._lock:
+            self._scaled_marks[key] = mark
+
+        return mark
+
+    def _mark_origin(self, img_size: Tuple[int, int], mark_size: Tuple[int, int]) -> Tuple[int, int]:
+        """
+        Get the top left coordinates where the watermark will be placed.
+
+        Args:
+            img_size (Tuple[int, int]): The size of the main image.
+            mark_size (Tuple[int, int]): The size of the watermark.
+        Returns:
+            Tuple[int, int]: The coordinates of the watermark.
+        """
+        if self.position_x or self.position_y:
+            return int(self.position_x), int(self.position_y)
+
+        anchor_x, anchor_y = self.POSITIONS[self.position]
+        x = round((img_size[0] - mark_size[0]) * anchor_x)
+        y = round((img_size[1] - mark_size[1]) * anchor_y)
+
+        return x, y
+
+    def apply(self, image: Image.Image) -> Image.Image:
+        """
+        Composite the watermark on an image. The image is modified in place.
+
+        Args:
+            image (Image.Image): The main image, in RGB or RGBA mode.
+        Returns:
+            Image.Image: The image with the watermark.
+        """
+        mark = self._scaled_mark(*image.size)
+        image.paste(mark, self._mark_origin(image.size, mark.size), mark)
+
+        return image